@@ -0,0 +1,163 @@
+"""Handler benchmark: full shopping journeys through main.py's handlers against a fake Bot API.
+
+    python benchmarks/bench_handlers.py [--users 200] [--journeys 2] [--concurrency 50]
+                                        [--api-latency-ms 0] [--output bench-handlers.json] [--compare old.json]
+
+Each virtual user taps through browse → customize → checkout → finalize_order; users run side
+by side, each one's updates in order. Results are written as JSON so two versions can be diffed.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import fakebot
+
+bot = fakebot.import_bot("bench-handlers-")
+
+from telegram.ext import Application
+
+# Compared by --compare: (path in the results, True when higher is better)
+HEADLINE_METRICS = [
+    (("updates_per_sec",), True),
+    (("latency", "p50_ms"), False),
+    (("latency", "p95_ms"), False),
+    (("latency", "p99_ms"), False),
+    (("api_calls_per_order",), False),
+    (("memory", "growth_per_order_bytes"), False),
+]
+
+async def benchmark(args):
+    request = fakebot.FakeRequest(latency=args.api_latency_ms / 1000)
+    application = bot.build_application(request=request)
+    errors = []
+
+    async def count_error(update, context):
+        errors.append(repr(context.error))
+
+    application.add_error_handler(count_error)
+    await application.initialize()
+    bot.order_writer.start()
+
+    factory = fakebot.UpdateFactory(application.bot)
+    rng = random.Random(args.seed)
+    # One unmeasured journey warms imports, render caches and the order store
+    for _, update in fakebot.journey(bot, factory, 1, rng):
+        await Application.process_update(application, update)
+    bot.order_writer.flush()
+
+    users = [10_000 + i for i in range(args.users)]
+    streams = {user_id: [step for _ in range(args.journeys) for step in fakebot.journey(bot, factory, user_id, rng)] for user_id in users}
+    request.calls.clear()
+    request.durations.clear()
+    orders_before = bot.order_writer.written
+    samples, by_step = [], defaultdict(list)
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def run_user(steps):
+        async with limit:
+            for step, update in steps:
+                start = time.perf_counter()
+                await Application.process_update(application, update)
+                elapsed = time.perf_counter() - start
+                samples.append(elapsed)
+                by_step[step].append(elapsed)
+
+    gc.collect()
+    rss_start = fakebot.rss_kib()
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(steps) for steps in streams.values()))
+    duration = time.perf_counter() - started
+    bot.order_writer.flush()
+    gc.collect()
+    rss_end = fakebot.rss_kib()
+    orders = bot.order_writer.written - orders_before
+
+    await application.shutdown()
+    bot.order_writer.stop()
+
+    api_calls = sum(request.calls.values())
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "revision": fakebot.git_revision(),
+            "python": platform.python_version(),
+            "args": vars(args),
+        },
+        "updates": len(samples),
+        "orders": orders,
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "duration_s": round(duration, 3),
+        "updates_per_sec": round(len(samples) / duration, 1),
+        "latency": {"mean_ms": round(sum(samples) / len(samples) * 1000, 3), **fakebot.percentiles(samples)},
+        "latency_by_step": {step: {"count": len(times), **fakebot.percentiles(times)} for step, times in sorted(by_step.items())},
+        "api_calls": api_calls,
+        "api_calls_per_order": round(api_calls / orders, 2) if orders else None,
+        "api_calls_by_method": dict(request.calls.most_common()),
+        "api_latency": fakebot.percentiles(request.durations),
+        "memory": {
+            "rss_start_kib": rss_start,
+            "rss_end_kib": rss_end,
+            "growth_kib": rss_end - rss_start,
+            "growth_per_order_bytes": round((rss_end - rss_start) * 1024 / orders) if orders else None,
+        },
+    }
+
+def lookup(results, path):
+    for key in path:
+        results = (results or {}).get(key)
+    return results
+
+def compare(old, new):
+    print(f"\nvs {old['meta'].get('revision') or '?'} ({old['meta']['timestamp']}):")
+    for path, higher_is_better in HEADLINE_METRICS:
+        before, after = lookup(old, path), lookup(new, path)
+        if not isinstance(before, (int, float)) or not isinstance(after, (int, float)):
+            continue
+        change = (after - before) / before * 100 if before else 0.0
+        worse = change < 0 if higher_is_better else change > 0
+        flag = " ⚠️" if worse and abs(change) >= 10 else ""
+        print(f"  {'.'.join(path):<30} {before:>12} → {after:<12} ({change:+.1f}%){flag}")
+
+def report(results):
+    latency = results["latency"]
+    print(f"{results['updates']} updates, {results['orders']} orders, {results['errors']} errors in {results['duration_s']} s")
+    print(f"  throughput  {results['updates_per_sec']} updates/s")
+    print(f"  latency     p50 {latency['p50_ms']} ms · p95 {latency['p95_ms']} ms · p99 {latency['p99_ms']} ms")
+    print(f"  api calls   {results['api_calls_per_order']} per order {results['api_calls_by_method']}")
+    print(f"  memory      {results['memory']['growth_kib']:+} KiB RSS ({results['memory']['growth_per_order_bytes']} bytes/order)")
+    for step, stats in results["latency_by_step"].items():
+        print(f"    {step:<17} p50 {stats['p50_ms']:>8} ms · p99 {stats['p99_ms']:>8} ms")
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--journeys", type=int, default=2, help="journeys per user")
+    parser.add_argument("--concurrency", type=int, default=50, help="users active at once")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="simulated Bot API round trip")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default="bench-handlers.json")
+    parser.add_argument("--compare", help="earlier results file to diff against")
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args))
+    report(results)
+    if args.compare:
+        with open(fakebot.output_path(args.compare)) as f:
+            compare(json.load(f), results)
+    if args.output:
+        path = fakebot.output_path(args.output)
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\nResults saved to {path}")
+    return 1 if results["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(run())
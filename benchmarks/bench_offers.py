@@ -0,0 +1,101 @@
+"""Offers engine benchmark: 1,000 compiled rules against a 50-line cart.
+
+    python benchmarks/bench_offers.py [--rules 1000] [--lines 50] [--rounds 2000]
+"""
+import argparse
+import itertools
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# main.py keeps its state files relative to the working directory
+os.chdir(tempfile.mkdtemp(prefix="bench-offers-"))
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+
+import main as bot
+
+logging.disable(logging.INFO)
+
+def make_offers(count, catalog, rng):
+    categories = list(catalog.categories)
+    products = [f"{cat}/{prod}" for cat, prod in catalog.products]
+    offers = {}
+    for i in range(count):
+        offer = {"description": f"Bench offer {i}", "min_order": rng.choice([0, 500, 1000, 5000, 20000, 100000])}
+        if i % 2:
+            offer["discount"] = rng.randint(5, 40)
+            if i % 3 == 0:
+                offer["max_discount"] = rng.randint(100, 2000)
+        else:
+            offer["discount_amount"] = rng.randint(50, 2000)
+        kind = i % 5
+        if kind == 1:
+            offer["categories"] = rng.sample(categories, rng.randint(1, 2))
+        elif kind == 2:
+            offer["products"] = rng.sample(products, rng.randint(1, 4))
+        elif kind == 3:
+            offer["per_user_limit"] = 1
+        elif kind == 4:
+            offer["expires"] = "2000-01-01" if i % 10 == 4 else "2099-12-31"
+        offers[f"BENCH{i:04d}"] = offer
+    return offers
+
+def make_cart(lines, catalog):
+    cart = bot.Cart()
+    keys = itertools.cycle(catalog.products)
+    for i in range(lines):
+        cat, prod = next(keys)
+        product = catalog.products[(cat, prod)]
+        # Distinct customizations keep every add on its own line
+        customs = bot.customization_key({"size": str(i)})
+        for _ in range(1 + i % 3):
+            cart.add(cat, prod, product["name"], product["price"], customs)
+    return cart
+
+def timed(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        "mean_us": round(sum(samples) / rounds * 1e6, 1),
+        "p50_us": round(samples[rounds // 2] * 1e6, 1),
+        "p99_us": round(samples[min(rounds - 1, int(rounds * 0.99))] * 1e6, 1),
+    }
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rules", type=int, default=1000)
+    parser.add_argument("--lines", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    catalog = bot.catalog
+    offers = make_offers(args.rules, catalog, random.Random(args.seed))
+    start = time.perf_counter()
+    engine = bot.OfferEngine(offers, catalog)
+    compile_ms = (time.perf_counter() - start) * 1000
+    cart = make_cart(args.lines, catalog)
+    uses = lambda: {code: 1 for code in engine.capped_codes[::2]}
+
+    eligible = engine.evaluate(cart, uses)
+    print(f"{len(engine)} rules, {len(cart)} cart lines (₹{cart.total:.2f}), compiled in {compile_ms:.1f} ms")
+    print(f"{len(eligible)} offers apply; best: {eligible[0][1].code} saves ₹{eligible[0][0] / 100:.2f}")
+    for name, fn in (
+        ("evaluate", lambda: engine.evaluate(cart, uses)),
+        ("best", lambda: engine.best(cart, uses)),
+        ("check", lambda: engine.check("BENCH0500", cart, uses)),
+    ):
+        print(f"  {name:<9}", timed(fn, args.rounds))
+    bot.order_writer.stop()
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,92 @@
+"""Product search benchmark: a synthetic catalog (50,000 products by default) and a fixed query mix.
+
+    python benchmarks/bench_search.py [--products 50000] [--rounds 200]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# main.py keeps its state files relative to the working directory
+os.chdir(tempfile.mkdtemp(prefix="bench-search-"))
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+
+import main as bot
+
+logging.disable(logging.INFO)
+
+ADJECTIVES = ["classic", "premium", "slim", "rugged", "vintage", "modern", "compact", "deluxe", "organic", "wireless",
+              "portable", "handmade", "ergonomic", "waterproof", "minimal", "luxury", "everyday", "smart", "travel", "heritage"]
+MATERIALS = ["leather", "cotton", "canvas", "steel", "bamboo", "ceramic", "denim", "linen", "walnut", "silicone",
+             "wool", "brass", "glass", "suede", "nylon", "marble", "copper", "jute", "velvet", "oak"]
+NOUNS = ["wallet", "backpack", "tshirt", "jacket", "sneakers", "headphones", "watch", "lamp", "mug", "vase",
+         "keyboard", "speaker", "notebook", "bottle", "belt", "scarf", "cushion", "planter", "charger", "sunglasses"]
+FILLER = ["designed", "for", "daily", "use", "with", "durable", "finish", "and", "comfortable", "feel", "made", "in",
+          "india", "gift", "ready", "premium", "quality", "lightweight", "easy", "care"]
+
+QUERIES = {
+    "one word": "wallet",
+    "prefix": "head",
+    "two words": "leather wallet",
+    "three words": "premium leather wallet",
+    "common words": "premium quality",
+    "typo": "walet",
+    "typo, two words": "lether backpak",
+    "no match": "zzzz qqqq",
+}
+
+def make_catalog(count, rng):
+    base = json.load(open(os.path.join(ROOT, "catalog.json"), encoding="utf-8"))
+    options = base["customization_options"]
+    categories = {}
+    for i in range(count):
+        cat_id = f"cat{i % 40}"
+        category = categories.setdefault(cat_id, {"name": f"{rng.choice(NOUNS).title()} Store {i % 40}", "products": {}})
+        name = f"{rng.choice(ADJECTIVES).title()} {rng.choice(MATERIALS).title()} {rng.choice(NOUNS).title()} {i}"
+        category["products"][f"p{i}"] = {
+            "name": name,
+            "price": rng.randint(99, 99999),
+            "description": " ".join(rng.choice(FILLER + MATERIALS + ADJECTIVES) for _ in range(12)),
+            "customizable": rng.sample(list(options), rng.randint(0, 2)),
+        }
+    return {"categories": categories, "customization_options": options}
+
+def timed(fn, rounds):
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        "mean_ms": round(sum(samples) / rounds * 1000, 3),
+        "p50_ms": round(samples[rounds // 2] * 1000, 3),
+        "p99_ms": round(samples[min(rounds - 1, int(rounds * 0.99))] * 1000, 3),
+    }
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--products", type=int, default=50000)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    data = make_catalog(args.products, random.Random(args.seed))
+    start = time.perf_counter()
+    catalog = bot.Catalog(data)
+    build_s = time.perf_counter() - start
+    index = catalog.search_index
+    print(f"{len(catalog.products)} products, {len(index.vocabulary)} tokens, catalog built in {build_s:.2f}s")
+    for label, query in QUERIES.items():
+        found = len(index.search(query, limit=bot.SEARCH_MAX_RESULTS))
+        print(f"  {label:<16} {query!r:<26} {found:>4} results", timed(lambda: index.search(query, limit=bot.SEARCH_MAX_RESULTS), args.rounds))
+    bot.order_writer.stop()
+
+if __name__ == "__main__":
+    run()
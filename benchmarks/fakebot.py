@@ -0,0 +1,144 @@
+"""In-process stand-in for the Telegram Bot API, shared by the handler benchmarks.
+
+Import main through import_bot() so its state files land in a scratch directory.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INVOKED_FROM = os.getcwd()
+
+def import_bot(prefix="bench-"):
+    sys.path.insert(0, ROOT)
+    os.chdir(tempfile.mkdtemp(prefix=prefix))
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+    # The fake Bot API has no flood limits; pass real values in the environment to measure them
+    for name in ("SEND_GLOBAL_RATE", "SEND_CHAT_RATE", "SEND_CHAT_BURST", "SEND_GROUP_RATE"):
+        os.environ.setdefault(name, "1000000")
+    import main
+    logging.disable(logging.INFO)
+    return main
+
+def output_path(path):
+    # Relative paths are taken from where the benchmark was started, not the scratch directory
+    return os.path.join(INVOKED_FROM, path)
+
+class FakeRequest(BaseRequest):
+    # Answers every Bot API method with a plausible result and records what was called
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.durations = []
+        self._message_ids = itertools.count(1000)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        start = time.perf_counter()
+        endpoint = url.rsplit("/", 1)[1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif endpoint in ("sendMessage", "editMessageText"):
+            chat_id = params.get("chat_id", 1)
+            result = {"message_id": params.get("message_id") or next(self._message_ids), "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        else:
+            result = True
+        self.durations.append(time.perf_counter() - start)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def message(self, user_id, text):
+        data = {"message_id": next(self._message_ids), "date": int(time.time()), "text": text,
+                "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id)}
+        if text.startswith("/"):
+            data["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.de_json({"update_id": next(self._update_ids), "message": data}, self.bot)
+
+    def callback(self, user_id, data):
+        query = {"id": str(next(self._update_ids)), "chat_instance": str(user_id), "from": self._user(user_id), "data": data,
+                 "message": {"message_id": next(self._message_ids), "date": int(time.time()), "text": "…",
+                             "chat": {"id": user_id, "type": "private"}, "from": {"id": 1, "is_bot": True, "first_name": "Bench"}}}
+        return Update.de_json({"update_id": next(self._update_ids), "callback_query": query}, self.bot)
+
+def journey(bot, factory, user_id, rng, promo_code="SKIP"):
+    # browse → customize → checkout → finalize_order as one user taps through it, as (step, update) pairs
+    encode = bot.encode_callback
+    cat_id, prod_id = rng.choice(bot.catalog.product_keys)
+    product = bot.catalog.product(cat_id, prod_id)
+    steps = [
+        ("start", factory.message(user_id, "/start")),
+        ("browse", factory.message(user_id, "🛒 Browse Products")),
+        ("category", factory.callback(user_id, encode("category", cat_id))),
+        ("product", factory.callback(user_id, encode("product", cat_id, prod_id))),
+    ]
+    if product.get("customizable"):
+        steps.append(("customize", factory.callback(user_id, encode("customize", cat_id, prod_id))))
+        for option in product["customizable"]:
+            steps.append(("select", factory.callback(user_id, encode("select", option, rng.choice(bot.catalog.options[option])))))
+    else:
+        steps.append(("add_cart", factory.callback(user_id, encode("add_cart", cat_id, prod_id))))
+    steps += [
+        ("view_cart", factory.callback(user_id, encode("view_cart"))),
+        ("start_checkout", factory.callback(user_id, encode("start_checkout"))),
+        ("checkout_name", factory.message(user_id, f"Bench User {user_id}")),
+        ("checkout_phone", factory.message(user_id, f"9{user_id % 10 ** 9:09d}")),
+        ("checkout_address", factory.message(user_id, "12 Anna Salai, Chennai 600017")),
+        ("confirm_details", factory.callback(user_id, encode("confirm_details"))),
+        ("pay_cod", factory.callback(user_id, encode("pay_cod"))),
+        ("checkout_promo", factory.message(user_id, promo_code)),
+    ]
+    return steps
+
+def percentiles(samples, points=(50, 95, 99)):
+    if not samples:
+        return {f"p{p}_ms": 0.0 for p in points}
+    ordered = sorted(samples)
+    return {f"p{p}_ms": round(ordered[min(len(ordered) - 1, len(ordered) * p // 100)] * 1000, 3) for p in points}
+
+def rss_kib():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # Peak rather than current RSS, and in bytes on macOS
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
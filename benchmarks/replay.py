@@ -0,0 +1,176 @@
+"""Replay a recorded update stream (UPDATE_RECORD_FILE) through main.py's handlers against a fake Bot API.
+
+    python benchmarks/replay.py updates.jsonl.gz [--speed 1|10|max] [--api-latency-ms 0] [--output replay.json]
+
+Updates go through the same scheduler as production, so per-user ordering and worker
+concurrency match; latency is measured from hand-off to the scheduler until the handlers finish.
+"""
+import argparse
+import asyncio
+import base64
+import gzip
+import json
+import platform
+import sys
+import time
+from datetime import datetime
+
+import fakebot
+
+bot = fakebot.import_bot("bench-replay-")
+
+from telegram.ext import Application
+
+def read_recording(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(next(f))
+        if header.get("format") != bot.UPDATE_RECORD_FORMAT:
+            raise SystemExit(f"{path}: unsupported recording format {header.get('format')}")
+        records = [json.loads(line) for line in f if line.strip()]
+    return header, records
+
+def retarget_callback(data, recorded_version):
+    # Callback data carries the low byte of the catalog version it was built for; point the
+    # buttons recorded under the then-current catalog at the catalog loaded here
+    try:
+        raw = bytearray(base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)))
+    except ValueError:
+        return data
+    if len(raw) < 3 or raw[0] != bot.CALLBACK_FORMAT_VERSION or raw[2] != recorded_version & 0xFF:
+        return data
+    raw[2] = bot.catalog.version & 0xFF
+    return base64.urlsafe_b64encode(bytes(raw)).rstrip(b"=").decode("ascii")
+
+def parse_speed(value):
+    value = value.lower()
+    if value == "max":
+        return None
+    try:
+        speed = float(value[:-1] if value.endswith("x") else value)
+    except ValueError:
+        speed = 0
+    if speed <= 0:
+        raise argparse.ArgumentTypeError(f"expected a positive multiplier or 'max', got {value!r}")
+    return speed
+
+async def replay(args):
+    header, records = read_recording(args.recording)
+    if args.limit:
+        records = records[:args.limit]
+    request = fakebot.FakeRequest(latency=args.api_latency_ms / 1000)
+    application = bot.build_application(request=request)
+    errors = []
+
+    async def count_error(update, context):
+        errors.append(repr(context.error))
+
+    application.add_error_handler(count_error)
+    await application.initialize()
+    bot.order_writer.start()
+    bot.update_scheduler.start()
+
+    factory = fakebot.UpdateFactory(application.bot)
+    speed = args.speed
+    recorded_version = header.get("catalog_version", bot.catalog.version)
+    latencies, service_times, feed_lag = [], [], []
+    users = set()
+
+    def timed(queued_at):
+        async def process(update):
+            started = time.perf_counter()
+            try:
+                await Application.process_update(application, update)
+            finally:
+                finished = time.perf_counter()
+                service_times.append(finished - started)
+                latencies.append(finished - queued_at)
+        return process
+
+    request.calls.clear()
+    orders_before = bot.order_writer.written
+    started = time.perf_counter()
+    for kind, offset_ms, user_id, value in records:
+        if kind == "v":
+            recorded_version = value
+            continue
+        if speed is not None:
+            due = started + offset_ms / 1000 / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            feed_lag.append(max(time.perf_counter() - due, 0.0))
+        users.add(user_id)
+        if kind == "c":
+            update = factory.callback(user_id, retarget_callback(value, recorded_version))
+        else:
+            update = factory.message(user_id, value)
+        queued_at = time.perf_counter()
+        await bot.update_scheduler.submit(update, timed(queued_at))
+    await bot.update_scheduler.join()
+    duration = time.perf_counter() - started
+    scheduler = bot.update_scheduler.report()
+
+    await bot.update_scheduler.stop()
+    await application.shutdown()
+    bot.order_writer.stop()
+
+    recorded_span = records[-1][1] / 1000 if records else 0.0
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "revision": fakebot.git_revision(),
+            "python": platform.python_version(),
+            "recording": {**header, "updates": len(latencies), "users": len(users), "span_s": recorded_span},
+            "args": vars(args),
+        },
+        "updates": len(latencies),
+        "errors": len(errors) + scheduler["failed"],
+        "error_samples": errors[:5],
+        "orders": bot.order_writer.written - orders_before,
+        "duration_s": round(duration, 3),
+        "updates_per_sec": round(len(latencies) / duration, 1) if duration else 0.0,
+        "latency": {**fakebot.percentiles(latencies), "max_ms": round(max(latencies, default=0) * 1000, 3)},
+        "service_time": fakebot.percentiles(service_times),
+        "feed_lag": {**fakebot.percentiles(feed_lag), "max_ms": round(max(feed_lag, default=0) * 1000, 3)} if feed_lag else None,
+        "scheduler": {key: scheduler[key] for key in ("workers", "max_depth", "throttled", "avg_wait_ms")},
+        "api_calls": sum(request.calls.values()),
+        "api_calls_by_method": dict(request.calls.most_common()),
+    }
+
+def speed_label(speed):
+    return "max speed" if speed is None else f"{speed:g}×"
+
+def report(results):
+    recording = results["meta"]["recording"]
+    latency = results["latency"]
+    print(f"Replayed {results['updates']} updates from {recording['users']} users "
+          f"({recording['span_s']:.1f} s recorded) at {speed_label(results['meta']['args']['speed'])} in {results['duration_s']} s")
+    print(f"  throughput  {results['updates_per_sec']} updates/s, {results['orders']} orders")
+    print(f"  latency     p50 {latency['p50_ms']} ms · p95 {latency['p95_ms']} ms · p99 {latency['p99_ms']} ms · max {latency['max_ms']} ms")
+    print(f"  handlers    p50 {results['service_time']['p50_ms']} ms · p99 {results['service_time']['p99_ms']} ms")
+    print(f"  scheduler   {results['scheduler']}")
+    if results["feed_lag"]:
+        print(f"  feed lag    p99 {results['feed_lag']['p99_ms']} ms · max {results['feed_lag']['max_ms']} ms")
+    print(f"  errors      {results['errors']}")
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("recording", help="file written by the bot with UPDATE_RECORD_FILE set")
+    parser.add_argument("--speed", type=parse_speed, default=1.0, help="playback speed: 1, 10, ... or max")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="simulated Bot API round trip")
+    parser.add_argument("--limit", type=int, help="replay only the first N updates")
+    parser.add_argument("--output", default="replay.json")
+    args = parser.parse_args()
+    args.recording = fakebot.output_path(args.recording)
+
+    results = asyncio.run(replay(args))
+    report(results)
+    if args.output:
+        path = fakebot.output_path(args.output)
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\nResults saved to {path}")
+    return 1 if results["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(run())
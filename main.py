@@ -1,94 +1,1109 @@
 # main.py - TrustyLads E-commerce Bot with Product Customization (Indian Version)
 
 import asyncio
+import atexit
+import base64
+import contextvars
+import functools
+import gzip
+import hashlib
+import hmac
+import itertools
+import bisect
+import heapq
 import os
 import logging
+import logging.handlers
 import json
 import re
-from datetime import datetime
-from threading import Thread
-from flask import Flask, jsonify
+import queue
+import random
+import socket
+import sqlite3
+import sys
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
+from threading import BoundedSemaphore, Condition, Event, Thread, Lock, get_ident
+from flask import Flask, Response, jsonify, request
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from telegram.error import Conflict, TimedOut, NetworkError
+from telegram.ext import Application, ApplicationBuilder, BaseRateLimiter, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes
+from telegram.error import BadRequest, Conflict, NetworkError, RetryAfter, TimedOut
 from dotenv import load_dotenv
 
 # --- LOGGING ---
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Records are put on a queue and written by a listener thread, so the bot loop never waits on
+# stderr. Output is one JSON object per line (LOG_FORMAT=text for the classic format).
+# Per-update events are sampled by category (LOG_SAMPLE_RATES, "category=fraction,...");
+# warnings, errors and the order category are always written in full.
+load_dotenv()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_SAMPLE_RATES = {
+    category.strip(): float(rate)
+    for category, rate in (pair.split("=", 1) for pair in os.getenv("LOG_SAMPLE_RATES", "callback=0.05,customization=0.05,session=0.25,http=0.02").split(",") if "=" in pair)
+}
+LOG_ALWAYS_KEEP = {"order", "error"}
+# Records from these libraries get a category so their per-request lines can be sampled too
+LOG_LOGGER_CATEGORIES = {"httpx": "http", "httpcore": "http"}
+
+class LogSampler:
+    def __init__(self, rates):
+        self.rates = rates
+        self.dropped = {}
+
+    def keep(self, category):
+        rate = self.rates.get(category)
+        if rate is None or rate >= 1 or random.random() < rate:
+            return True
+        self.dropped[category] = self.dropped.get(category, 0) + 1
+        return False
+
+class SamplingFilter(logging.Filter):
+    def filter(self, record):
+        category = getattr(record, "category", None)
+        if category is not None:
+            # Tagged by the caller (log_event), which has already made the sampling decision
+            return True
+        record.category = LOG_LOGGER_CATEGORIES.get(record.name.split(".", 1)[0], "app")
+        return record.levelno >= logging.WARNING or log_sampler.keep(record.category)
+
+class JsonFormatter(logging.Formatter):
+    _RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "category"}
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "category": getattr(record, "category", "app"),
+            "msg": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in self._RESERVED)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # Only the message is rendered on the calling thread; JSON encoding, tracebacks and the
+    # write itself happen on the listener
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+log_sampler = LogSampler(LOG_SAMPLE_RATES)
+log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+_log_handler = DeferredQueueHandler(log_queue)
+_log_handler.addFilter(SamplingFilter())
+logging.basicConfig(level=LOG_LEVEL, handlers=[_log_handler])
+log_listener = logging.handlers.QueueListener(log_queue, _log_output)
+log_listener.start()
+
+@atexit.register
+def stop_log_listener():
+    # Drains whatever is still queued when the process exits
+    if log_listener._thread is not None:
+        log_listener.stop()
+
 logger = logging.getLogger(__name__)
 
+def log_event(category, message, *args, level=logging.INFO, **fields):
+    # For per-update events: the level check and the sampling decision come before a record is built
+    if not logger.isEnabledFor(level):
+        return
+    if level < logging.WARNING and category not in LOG_ALWAYS_KEEP and not log_sampler.keep(category):
+        return
+    logger.log(level, message, *args, extra={"category": category, **fields})
+
 # --- ENVIRONMENT SETUP ---
-load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-logger.info(f"🔍 BOT_TOKEN found: {'Yes' if BOT_TOKEN else 'No'}")
+logger.info("🔍 BOT_TOKEN found: %s", "Yes" if BOT_TOKEN else "No")
+# "polling" (default) or "webhook"; in webhook mode Telegram POSTs updates to WEBHOOK_PATH on PORT
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+DATA_DIR = os.getenv("DATA_DIR", "data")
+SESSION_TTL = float(os.getenv("SESSION_TTL", 6 * 3600))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", 50000))
+CART_IDLE_TTL = float(os.getenv("CART_IDLE_TTL", 1800))
+CART_MAX_ENTRIES = int(os.getenv("CART_MAX_ENTRIES", 50000))
+# Several webhook workers can share one token: each owns the users with user_id % WORKER_COUNT == WORKER_INDEX
+# and forwards everyone else's updates to WORKER_URLS[owner] (comma-separated, indexed by worker)
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", 1))
+WORKER_URLS = [u.strip().rstrip("/") for u in os.getenv("WORKER_URLS", "").split(",") if u.strip()]
+SHARD_FORWARD_TIMEOUT = float(os.getenv("SHARD_FORWARD_TIMEOUT", 10))
+
+# --- SHARED STATE BACKEND ---
+# "local" keeps state on this machine (one worker): spilled sessions and carts and the order ID
+# counter are files under STATE_LOCAL_DIR. redis://[:password@]host:port/db speaks RESP to Redis
+# or anything compatible, so sessions, carts, orders and counters are visible to every worker.
+STATE_BACKEND_URL = os.getenv("STATE_BACKEND_URL", "local")
+STATE_LOCAL_DIR = os.path.join(DATA_DIR, "state")
+STATE_KEY_PREFIX = os.getenv("STATE_KEY_PREFIX", "trustylads:")
+STATE_BACKEND_TTL = float(os.getenv("STATE_BACKEND_TTL", 30 * 86400))
+STATE_BACKEND_POOL_SIZE = int(os.getenv("STATE_BACKEND_POOL_SIZE", 8))
+STATE_BACKEND_TIMEOUT = float(os.getenv("STATE_BACKEND_TIMEOUT", 5))
+
+class StateBackendError(Exception):
+    pass
+
+def state_key(*parts):
+    return STATE_KEY_PREFIX + ":".join(str(p) for p in parts)
+
+class LocalBackend:
+    # The backend interface for a single process: each key is a JSON file under directory
+    # (state_key parts become subdirectories), written atomically. ttl is ignored; the disk
+    # tier holds only what BoundedStore spills, and rewrites or removes it on the next eviction.
+    # A local install's SQLite store is also its order index, so the sorted-set and set
+    # commands SharedOrderIndex needs are only implemented by shared backends.
+    shared = False
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = Lock()
+
+    def _path(self, key):
+        if key.startswith(STATE_KEY_PREFIX):
+            key = key[len(STATE_KEY_PREFIX):]
+        return os.path.join(self.directory, *key.split(":")) + ".json"
+
+    def _write(self, key, value, durable=False):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set_many(self, values, ttl=None):
+        for key, value in values.items():
+            self._write(key, value)
+
+    def set(self, key, value, ttl=None):
+        self._write(key, value)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def incr(self, key, amount=1):
+        # Counters hand out order IDs, so the new value is on disk before it is returned
+        with self._lock:
+            value = int(self.get(key) or 0) + amount
+            self._write(key, value, durable=True)
+        return value
+
+    def keys(self, prefix):
+        # Every key under prefix, which must end at a ":" boundary (state_key(name, ""))
+        directory = os.path.dirname(self._path(prefix + "x"))
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        return [prefix + name[:-5] for name in names if name.endswith(".json")]
+
+    def close(self):
+        pass
+
+class RespBackend:
+    shared = True
+
+    def __init__(self, url, pool_size=STATE_BACKEND_POOL_SIZE, timeout=STATE_BACKEND_TIMEOUT):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def _encode(command):
+        out = [b"*%d\r\n" % len(command)]
+        for arg in command:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(out)
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("state backend closed the connection")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            return StateBackendError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            return None if size < 0 else reader.read(size + 2)[:-2]
+        if kind == b"*":
+            size = int(rest)
+            return None if size < 0 else [self._read_reply(reader) for _ in range(size)]
+        raise ConnectionError(f"unexpected reply from state backend: {line[:40]!r}")
+
+    def _call(self, conn, commands):
+        # Commands are pipelined: one write, then every reply is read so the connection stays usable
+        sock, reader = conn
+        sock.sendall(b"".join(self._encode(c) for c in commands))
+        replies = [self._read_reply(reader) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, StateBackendError):
+                raise reply
+        return replies
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = (sock, sock.makefile("rb"))
+        setup = ([("AUTH", self.password)] if self.password else []) + ([("SELECT", self.db)] if self.db else [])
+        if setup:
+            self._call(conn, setup)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.pool_size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                conn = self._pool.get()
+        reusable = False
+        try:
+            yield conn
+            reusable = True
+        except StateBackendError:
+            # An error reply leaves the connection in sync; anything else may not
+            reusable = True
+            raise
+        finally:
+            if reusable:
+                self._pool.put(conn)
+            else:
+                conn[0].close()
+                with self._lock:
+                    self._created -= 1
+
+    def pipeline(self, commands, retry=True):
+        # A pooled connection may have gone stale; idempotent commands get one retry on a fresh one
+        try:
+            with self.connection() as conn:
+                return self._call(conn, commands)
+        except OSError:
+            if not retry:
+                raise
+        with self.connection() as conn:
+            return self._call(conn, commands)
+
+    def get(self, key):
+        raw = self.pipeline([("GET", key)])[0]
+        return None if raw is None else json.loads(raw)
+
+    def mget(self, keys):
+        if not keys:
+            return []
+        return [None if raw is None else json.loads(raw) for raw in self.pipeline([("MGET", *keys)])[0]]
+
+    def set_many(self, values, ttl=None):
+        expiry = ("PX", int(ttl * 1000)) if ttl else ()
+        commands = [("SET", key, json.dumps(value, ensure_ascii=False), *expiry) for key, value in values.items()]
+        if commands:
+            self.pipeline(commands)
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def delete(self, key):
+        self.pipeline([("DEL", key)])
+
+    def incr(self, key, amount=1):
+        return self.pipeline([("INCRBY", key, amount)], retry=False)[0]
+
+    def rpush(self, key, *values):
+        return self.pipeline([("RPUSH", key, *(json.dumps(v, ensure_ascii=False) for v in values))], retry=False)[0]
+
+    def llen(self, key):
+        return self.pipeline([("LLEN", key)])[0]
+
+    def lrange(self, key, start, stop):
+        return [json.loads(raw) for raw in self.pipeline([("LRANGE", key, start, stop)])[0]]
+
+    def zadd(self, key, scores):
+        if scores:
+            self.pipeline([("ZADD", key, *(part for member, score in scores.items() for part in (score, member)))])
+
+    def zcard(self, key):
+        return self.pipeline([("ZCARD", key)])[0]
+
+    def zrevrange(self, key, start, stop):
+        return [member.decode() for member in self.pipeline([("ZREVRANGE", key, start, stop)])[0]]
+
+    def sadd(self, key, *members):
+        if members:
+            self.pipeline([("SADD", key, *members)])
+
+    def scard_many(self, keys):
+        return self.pipeline([("SCARD", key) for key in keys]) if keys else []
+
+    def keys(self, prefix):
+        # SCAN rather than KEYS so a large keyspace never blocks the server
+        pattern = re.sub(r"([*?\[\]\\])", r"\\\1", prefix) + "*"
+        found, cursor = [], b"0"
+        while True:
+            cursor, batch = self.pipeline([("SCAN", cursor, "MATCH", pattern, "COUNT", 1000)])[0]
+            found.extend(key.decode() for key in batch)
+            if cursor == b"0":
+                return found
+
+    def close(self):
+        while True:
+            try:
+                sock, reader = self._pool.get_nowait()
+            except queue.Empty:
+                return
+            sock.close()
+
+def open_state_backend(url=STATE_BACKEND_URL):
+    if url == "local":
+        return LocalBackend(STATE_LOCAL_DIR)
+    if urlparse(url).scheme in ("redis", "resp"):
+        return RespBackend(url)
+    raise ValueError(f"Unsupported STATE_BACKEND_URL: {url}")
+
+state_backend = open_state_backend()
+
+# --- BOUNDED SESSION & CART STORE ---
+class BoundedStore:
+    # A dict-like LRU keyed by user_id in front of the state backend. Entries idle for longer
+    # than ttl, or pushed out by max_entries, are written to the backend when should_spill()
+    # says they carry state worth keeping, and read back on the user's next interaction.
+    # With a shared backend entries are also written through after each update (persist), so
+    # whichever worker sees the user next has them. Backend I/O never runs on the bot loop:
+    # spills go through one writer thread per store (so writes to a key land in order), and an
+    # entry is served from memory until its spill has landed. Entries pinned by load() for an
+    # update being handled are never evicted, so nothing a handler writes is lost.
+    def __init__(self, name, ttl, max_entries, should_spill, backend, encode=None, decode=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.should_spill = should_spill
+        self.backend = backend
+        # Values are stored as JSON; encode/decode convert to and from it for non-dict values
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda data: data)
+        self._data = OrderedDict()
+        self._touched = {}
+        # Keys load() found nothing for, so get() can answer for them without asking again
+        self._absent = set()
+        self._pins = {}
+        # key -> (value, future) while its spill is being written; _spill_order reaps them in order
+        self._spilling = {}
+        self._spill_order = deque()
+        self._spill_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"spill-{name}")
+        self.metrics = {"hits": 0, "misses": 0, "rehydrated": 0, "evictions": 0, "expirations": 0, "spilled": 0}
+
+    def _key(self, key):
+        return state_key(self.name, key)
+
+    def _write_spill(self, key, value, keep):
+        # On the store's writer thread. Nothing touches value meanwhile: taking it back waits for this
+        try:
+            if keep:
+                self.backend.set(self._key(key), self.encode(value), STATE_BACKEND_TTL)
+            else:
+                self.backend.delete(self._key(key))
+        except (OSError, StateBackendError) as e:
+            logger.error("Error spilling %s for user %s: %s", self.name, key, e)
+
+    def _evict(self, key, expired):
+        value = self._data.pop(key)
+        self._touched.pop(key, None)
+        self.metrics["expirations" if expired else "evictions"] += 1
+        keep = self.should_spill(value)
+        if keep:
+            self.metrics["spilled"] += 1
+        future = self._spill_writer.submit(self._write_spill, key, value, keep)
+        self._spilling[key] = (value, future)
+        self._spill_order.append((key, future))
+
+    def _reap_spills(self):
+        # The writer finishes spills in submission order, so the landed ones are at the head
+        while self._spill_order and self._spill_order[0][1].done():
+            key, future = self._spill_order.popleft()
+            pending = self._spilling.get(key)
+            if pending is not None and pending[1] is future:
+                del self._spilling[key]
+
+    def _sweep(self):
+        self._reap_spills()
+        # Entries are kept in access order, so only the stale or surplus head needs checking
+        deadline = time.monotonic() - self.ttl
+        for _ in range(len(self._data)):
+            key = next(iter(self._data))
+            expired = self._touched[key] <= deadline
+            if not expired and len(self._data) <= self.max_entries:
+                break
+            if key in self._pins:
+                # A handler is using it right now; it counts as just touched
+                self._touch(key)
+                continue
+            self._evict(key, expired)
+
+    def _touch(self, key):
+        self._data.move_to_end(key)
+        self._touched[key] = time.monotonic()
+
+    def _rehydrate(self, key, value):
+        self.metrics["rehydrated"] += 1
+        self[key] = value
+        if not self.backend.shared:
+            # The copy in memory is now the only one; a stale stored copy would come back after a
+            # restart (an emptied cart, a checkout already finished). Shared backends are
+            # rewritten by persist() after every update instead.
+            self._spill_order.append((key, self._spill_writer.submit(self._write_spill, key, None, False)))
+        return value
+
+    def load_stored(self, key):
+        # Blocking backend read; the bot loop goes through load()
+        try:
+            data = self.backend.get(self._key(key))
+        except (OSError, ValueError, StateBackendError) as e:
+            logger.error("Error rehydrating %s for user %s: %s", self.name, key, e)
+            return None
+        return None if data is None else self.decode(data)
+
+    def _take_back(self, key, pending):
+        # An entry whose spill has landed; the copy in memory is as new as the stored one
+        if self._spilling.get(key) is pending:
+            del self._spilling[key]
+        return self._rehydrate(key, pending[0])
+
+    async def load(self, key):
+        # Pins the user's entry and brings it in off the loop before their update is handled,
+        # so get() hits; release() unpins it afterwards
+        self._pins[key] = self._pins.get(key, 0) + 1
+        if key in self._data:
+            return
+        self.metrics["misses"] += 1
+        pending = self._spilling.get(key)
+        if pending is not None:
+            await asyncio.wrap_future(pending[1])
+            if key not in self._data:
+                self._take_back(key, pending)
+            return
+        value = await asyncio.to_thread(self.load_stored, key)
+        if key in self._data:
+            return
+        if value is None:
+            self._absent.add(key)
+        else:
+            self._rehydrate(key, value)
+
+    def release(self, key):
+        # The update that load() was for has been handled
+        self._absent.discard(key)
+        pins = self._pins.pop(key, 0) - 1
+        if pins > 0:
+            self._pins[key] = pins
+
+    def get(self, key, default=None):
+        if key in self._data:
+            self.metrics["hits"] += 1
+            value = self._data[key]
+            self._touch(key)
+            self._sweep()
+            return value
+        if key in self._absent:
+            return default
+        # Only reached without load() first (startup, benchmarks); from here on it blocks
+        self.metrics["misses"] += 1
+        pending = self._spilling.get(key)
+        if pending is not None:
+            pending[1].result()
+            return self._take_back(key, pending)
+        value = self.load_stored(key)
+        return default if value is None else self._rehydrate(key, value)
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._absent.discard(key)
+        self._touch(key)
+        self._sweep()
+
+    def __contains__(self, key):
+        # In memory or on its way out; what the backend holds only load() asks
+        return key in self._data or key in self._spilling
+
+    def cached(self, key):
+        return key in self._data
+
+    def persist(self, key):
+        if self.backend.shared and key in self._data:
+            self.backend.set(self._key(key), self.encode(self._data[key]), STATE_BACKEND_TTL)
+
+    def setdefault(self, key, default):
+        value = self.get(key, self)
+        if value is self:
+            self[key] = value = default
+        return value
+
+    def __len__(self):
+        return len(self._data)
+
+    def items(self):
+        return list(self._data.items())
+
+    def values(self):
+        return list(self._data.values())
+
+    def spilled_values(self, batch_size=500):
+        # Entries the backend holds that are not in memory right now, read in batches
+        prefix = self._key("")
+        live = {str(key) for key in self._data}
+        keys = [key for key in self.backend.keys(prefix) if key[len(prefix):] not in live]
+        for start in range(0, len(keys), batch_size):
+            for data in self.backend.mget(keys[start:start + batch_size]):
+                if data is not None:
+                    yield self.decode(data)
+
+    def flush(self):
+        # Used on shutdown so nothing worth keeping is lost with the process
+        for _, future in list(self._spill_order):
+            future.result()
+        items = self.items()
+        self.backend.set_many({self._key(k): self.encode(v) for k, v in items if self.should_spill(v)}, STATE_BACKEND_TTL)
+        # Entries with nothing worth keeping must not leave an older stored copy behind
+        for key, value in items:
+            if not self.should_spill(value):
+                self.backend.delete(self._key(key))
+
+    def report(self):
+        return {"size": len(self._data), "max_entries": self.max_entries, "ttl_seconds": self.ttl,
+                "pinned": len(self._pins), "spilling": len(self._spilling), **self.metrics}
+
+def session_has_state(session):
+    return bool(session.get("customization_data") or session.get("checkout_data")
+                or session.get("current_context") not in (None, "main_menu"))
+
+# --- CART MODEL ---
+def customization_key(customizations):
+    # Sorted (option, value) pairs, so the same choices made in any order land on the same line
+    return tuple(sorted((sys.intern(k), sys.intern(v)) for k, v in (customizations or {}).items()))
+
+class CartLine:
+    __slots__ = ("category", "product_id", "name", "price", "quantity", "customizations")
+
+    def __init__(self, category, product_id, name, price, quantity=0, customizations=()):
+        self.category = category
+        self.product_id = product_id
+        self.name = name
+        self.price = price
+        self.quantity = quantity
+        self.customizations = customizations
+
+    @property
+    def key(self):
+        # The price is part of the key, so a repriced product goes on a line of its own
+        return (self.category, self.product_id, self.customizations, self.price)
+
+    @property
+    def line_total(self):
+        return round(self.price * self.quantity, 2)
+
+    def to_json(self):
+        return [self.category, self.product_id, self.name, self.price, self.quantity, self.customizations]
+
+    @classmethod
+    def from_json(cls, data):
+        if isinstance(data, dict):
+            # Item dicts from before the Cart model
+            return cls(sys.intern(data["category"]), sys.intern(data["product_id"]), data["name"], data["price"],
+                       data["quantity"], customization_key(data.get("customizations")))
+        category, product_id, name, price, quantity, customizations = data
+        return cls(sys.intern(category), sys.intern(product_id), name, price, quantity,
+                   tuple((sys.intern(k), sys.intern(v)) for k, v in customizations))
+
+class Cart:
+    # Item count and subtotal (in paise, so repeated adds and removes never drift) are kept up to
+    # date on every change; revision lets stale cart buttons be detected.
+    __slots__ = ("lines", "count", "subtotal_paise", "revision")
+
+    def __init__(self):
+        self.lines = {}
+        self.count = 0
+        self.subtotal_paise = 0
+        self.revision = 0
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines.values())
+
+    @property
+    def total(self):
+        return self.subtotal_paise / 100
+
+    def set_quantity(self, line, quantity):
+        delta = quantity - line.quantity
+        line.quantity = quantity
+        self.count += delta
+        self.subtotal_paise += delta * round(line.price * 100)
+        self.revision += 1
+        if quantity <= 0:
+            self.lines.pop(line.key, None)
+        else:
+            self.lines.setdefault(line.key, line)
+        return line
+
+    def add(self, category, product_id, name, price, customizations=()):
+        line = self.lines.get((category, product_id, customizations, price))
+        if line is None:
+            line = CartLine(category, product_id, name, price, 0, customizations)
+        return self.set_quantity(line, line.quantity + 1)
+
+    def apply(self, saved):
+        # Journal replay: the saved line carries its absolute quantity (0 means removed)
+        line, quantity = self.lines.get(saved.key), saved.quantity
+        if line is None:
+            if quantity <= 0:
+                return
+            line = saved
+            line.quantity = 0
+        self.set_quantity(line, quantity)
+
+    def line_at(self, index):
+        return next(itertools.islice(self.lines.values(), index, None), None)
+
+    def clear(self):
+        self.lines.clear()
+        self.count = 0
+        self.subtotal_paise = 0
+        self.revision += 1
+
+    def to_json(self):
+        return {"revision": self.revision, "lines": [line.to_json() for line in self.lines.values()]}
+
+    def to_legacy(self):
+        # The item dicts carts were before the Cart model, keyed the way add_to_cart keyed them then
+        items = {}
+        for line in self.lines.values():
+            key = f"{line.category}_{line.product_id}" + "".join(f"_{k}-{v}" for k, v in line.customizations)
+            if key in items:
+                # A repriced product has a line of its own; the old keys could not tell them apart
+                key += f"@{line.price}"
+            items[key] = {"name": line.name, "price": line.price, "quantity": line.quantity, "category": line.category,
+                          "product_id": line.product_id, "customizations": dict(line.customizations)}
+        return items
+
+    @classmethod
+    def from_json(cls, data):
+        cart = cls()
+        if isinstance(data, dict) and "lines" in data:
+            items = data["lines"]
+        else:
+            # Carts saved before the Cart model: a dict of item dicts keyed by strings
+            items = data.values() if isinstance(data, dict) else data
+        for item in items:
+            cart.apply(CartLine.from_json(item))
+        cart.revision = data.get("revision", 0) if isinstance(data, dict) else 0
+        return cart
+
+def format_customizations(customizations):
+    return ", ".join(f"{k.title()}: {v}" for k, v in customizations)
+
+# --- OFFERS ENGINE ---
+# Offers from catalog.json are compiled once per catalog version: scope, validity window and
+# discount are resolved up front, so checking a cart is plain integer arithmetic (in paise).
+def parse_offer_time(value, end_of_day=False):
+    if value is None:
+        return None
+    moment = datetime.fromisoformat(str(value))
+    # A bare date as an expiry means the offer runs through the whole of that day
+    if end_of_day and len(str(value)) == 10:
+        moment += timedelta(days=1)
+    return moment.timestamp()
+
+class CartView:
+    # One pass over the cart gives every rule its base: the whole cart, or its scoped part
+    __slots__ = ("subtotal", "by_category", "by_product")
+
+    def __init__(self, cart):
+        by_category, by_product = {}, {}
+        for line in cart:
+            paise = round(line.price * 100) * line.quantity
+            by_category[line.category] = by_category.get(line.category, 0) + paise
+            key = (line.category, line.product_id)
+            by_product[key] = by_product.get(key, 0) + paise
+        self.subtotal = cart.subtotal_paise
+        self.by_category = by_category
+        self.by_product = by_product
+
+class OfferRule:
+    __slots__ = ("code", "description", "min_order", "percent", "amount", "max_discount", "starts", "expires",
+                 "per_user_limit", "categories", "products", "advertise")
+
+    def __init__(self, code, offer, catalog):
+        self.code = code
+        self.description = offer.get("description", "")
+        self.min_order = round(float(offer.get("min_order", 0)) * 100)
+        # A fixed amount wins over a percentage, as it always has
+        if "discount_amount" in offer:
+            self.percent, self.amount = None, round(float(offer["discount_amount"]) * 100)
+        elif "discount" in offer:
+            self.percent, self.amount = float(offer["discount"]), None
+        else:
+            raise ValueError(f"Offer {code} has neither 'discount' nor 'discount_amount'")
+        self.max_discount = round(float(offer["max_discount"]) * 100) if "max_discount" in offer else None
+        self.starts = parse_offer_time(offer.get("starts"))
+        self.expires = parse_offer_time(offer.get("expires"), end_of_day=True)
+        self.per_user_limit = int(offer.get("per_user_limit", 0))
+        self.advertise = bool(offer.get("advertise", False))
+
+        categories = frozenset(offer.get("categories", ()))
+        unknown = set(categories.difference(catalog.categories))
+        products = set()
+        for ref in offer.get("products", ()):
+            key = tuple(ref.split("/", 1))
+            if key not in catalog.products:
+                unknown.add(ref)
+            elif key[0] not in categories:
+                products.add(key)
+        if unknown:
+            raise ValueError(f"Offer {code} is scoped to unknown categories/products {sorted(unknown)}")
+        # None means the whole cart
+        self.categories = categories or None
+        self.products = frozenset(products) or None
+        if self.products and not self.categories:
+            self.categories = frozenset()
+
+    def active(self, now):
+        return (self.starts is None or now >= self.starts) and (self.expires is None or now < self.expires)
+
+    def base(self, view):
+        if self.categories is None:
+            return view.subtotal
+        base = 0
+        for category in self.categories:
+            base += view.by_category.get(category, 0)
+        if self.products:
+            for key in self.products:
+                base += view.by_product.get(key, 0)
+        return base
+
+    def discount(self, base):
+        amount = self.amount if self.percent is None else round(base * self.percent / 100)
+        if self.max_discount is not None and amount > self.max_discount:
+            amount = self.max_discount
+        return min(amount, base)
+
+class OfferEngine:
+    def __init__(self, offers, catalog):
+        self.rules = {code.upper(): OfferRule(code.upper(), offer, catalog) for code, offer in offers.items()}
+        # Sorted by minimum order: a rule's base never exceeds the cart subtotal, so everything past
+        # the first rule the whole cart is too small for can be skipped with one bisect
+        self._ordered = sorted(self.rules.values(), key=lambda rule: rule.min_order)
+        self._min_orders = [rule.min_order for rule in self._ordered]
+        self.capped_codes = [rule.code for rule in self._ordered if rule.per_user_limit]
+
+    def __len__(self):
+        return len(self.rules)
+
+    def _candidates(self, view, now):
+        end = bisect.bisect_right(self._min_orders, view.subtotal)
+        for rule in itertools.islice(self._ordered, end):
+            if rule.active(now):
+                base = rule.base(view)
+                if base and base >= rule.min_order:
+                    yield rule.discount(base), rule
+
+    def evaluate(self, cart, uses=None, now=None):
+        # Every offer the cart qualifies for as (discount in paise, rule), best first.
+        # uses is a callable returning {code: times used}, called only if a capped rule qualifies.
+        now = time.time() if now is None else now
+        results = list(self._candidates(CartView(cart), now))
+        if uses is not None and any(rule.per_user_limit for _, rule in results):
+            used = uses()
+            results = [(d, rule) for d, rule in results if not rule.per_user_limit or used.get(rule.code, 0) < rule.per_user_limit]
+        results.sort(key=lambda result: (-result[0], result[1].code))
+        return results
+
+    def best(self, cart, uses=None, now=None, advertised_only=False):
+        now = time.time() if now is None else now
+        best, used = None, None
+        for discount, rule in self._candidates(CartView(cart), now):
+            if advertised_only and not rule.advertise:
+                continue
+            if best is not None and (discount < best[0] or (discount == best[0] and rule.code > best[1].code)):
+                continue
+            if rule.per_user_limit and uses is not None:
+                if used is None:
+                    used = uses()
+                if used.get(rule.code, 0) >= rule.per_user_limit:
+                    continue
+            best = (discount, rule)
+        return best
+
+    def check(self, code, cart, uses=None, now=None):
+        # (rule, discount in paise, None) when the code applies, otherwise (rule or None, 0, reason)
+        rule = self.rules.get(code.upper())
+        if rule is None:
+            return None, 0, "unknown"
+        now = time.time() if now is None else now
+        if rule.starts is not None and now < rule.starts:
+            return rule, 0, "not_started"
+        if rule.expires is not None and now >= rule.expires:
+            return rule, 0, "expired"
+        base = rule.base(CartView(cart))
+        if not base:
+            return rule, 0, "out_of_scope"
+        if base < rule.min_order:
+            return rule, 0, "min_order"
+        if rule.per_user_limit and uses is not None and uses().get(rule.code, 0) >= rule.per_user_limit:
+            return rule, 0, "used_up"
+        return rule, rule.discount(base), None
 
 # --- GLOBAL STATE ---
 bot_running = False
-user_sessions = {}
-user_carts = {}
-user_orders = {}
-order_counter = 1000
+bot_application = None
+bot_loop = None
+bot_thread_id = None
+user_sessions = BoundedStore("sessions", SESSION_TTL, SESSION_MAX_ENTRIES, session_has_state, state_backend)
+user_carts = BoundedStore("carts", CART_IDLE_TTL, CART_MAX_ENTRIES, bool, state_backend, Cart.to_json, Cart.from_json)
 
 # --- E-COMMERCE DATA (INDIAN CONTEXT) ---
-PRODUCT_CATALOG = {
-    "electronics": {
-        "name": "📱 Electronics",
-        "products": {
-            "smartphone": {"name": "Flagship Smartphone", "price": 49999.00, "description": "High-end smartphone with advanced features", "customizable": ["color", "storage"]},
-            "laptop": {"name": "Ultraportable Laptop", "price": 69999.00, "description": "Lightweight laptop for productivity", "customizable": ["color", "ram"]},
-            "wireless_earbuds": {"name": "Premium Wireless Earbuds", "price": 8999.00, "description": "Noise-cancelling wireless earbuds", "customizable": ["color"]},
-            "smartwatch": {"name": "Fitness Smartwatch", "price": 12999.00, "description": "Advanced fitness tracking smartwatch", "customizable": ["color", "strap"]},
-        }
-    },
-    "clothing": {
-        "name": "👕 Apparel",
-        "products": {
-            "tshirt": {"name": "Classic T-Shirt", "price": 499.00, "description": "100% Cotton, comfortable fit", "customizable": ["size", "color"]},
-            "jeans": {"name": "Slim Fit Jeans", "price": 1299.00, "description": "Durable denim, modern style", "customizable": ["size", "color"]},
-            "hoodie": {"name": "Premium Hoodie", "price": 1899.00, "description": "Warm and comfortable hoodie", "customizable": ["size", "color"]},
-            "polo_shirt": {"name": "Polo Shirt", "price": 899.00, "description": "Smart casual polo shirt", "customizable": ["size", "color"]},
-        }
-    },
-    "accessories": {
-        "name": "👜 Accessories",
-        "products": {
-            "leather_wallet": {"name": "Genuine Leather Wallet", "price": 1899.00, "description": "Handcrafted leather wallet with RFID protection", "customizable": ["color", "material"]},
-            "sunglasses": {"name": "UV Protection Sunglasses", "price": 2299.00, "description": "Stylish sunglasses with 100% UV protection", "customizable": ["color"]},
-            "backpack": {"name": "Travel Backpack", "price": 2799.00, "description": "Durable backpack with laptop compartment", "customizable": ["color", "size"]},
-            "wristwatch": {"name": "Classic Analog Watch", "price": 4999.00, "description": "Elegant timepiece with leather strap", "customizable": ["color", "strap"]},
-        }
-    },
-    "home_decor": {
-        "name": "🏠 Home & Decor",
-        "products": {
-            "table_lamp": {"name": "Modern Table Lamp", "price": 1599.00, "description": "Stylish LED table lamp", "customizable": ["color"]},
-            "wall_art": {"name": "Abstract Wall Art", "price": 999.00, "description": "Beautiful canvas wall art", "customizable": ["size", "color"]},
-            "cushion_cover": {"name": "Designer Cushion Cover", "price": 299.00, "description": "Premium quality cushion cover", "customizable": ["size", "color", "material"]},
-            "photo_frame": {"name": "Wooden Photo Frame", "price": 599.00, "description": "Handcrafted wooden photo frame", "customizable": ["size", "color"]},
-        }
-    }
-}
+CATALOG_FILE = os.getenv("CATALOG_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json"))
+CATALOG_RELOAD_INTERVAL = float(os.getenv("CATALOG_RELOAD_INTERVAL", 5))
 
-CUSTOMIZATION_OPTIONS = {
-    "size": ["XS", "S", "M", "L", "XL", "XXL"],
-    "color": ["Black", "White", "Red", "Blue", "Green", "Yellow", "Pink", "Purple", "Gray", "Brown"],
-    "material": ["Cotton", "Leather", "Polyester", "Wool", "Silk", "Canvas"],
-    "storage": ["64GB", "128GB", "256GB", "512GB", "1TB"],
-    "ram": ["8GB", "16GB", "32GB"],
-    "strap": ["Leather", "Metal", "Silicone", "Fabric"]
-}
+SEARCH_TOKEN_RE = re.compile(r"[a-z0-9]+")
+SEARCH_FIELD_WEIGHTS = {"name": 3.0, "category": 2.0, "description": 1.0, "options": 0.5}
+SEARCH_PREFIX_FACTOR = 0.7
+SEARCH_FUZZY_FACTOR = 0.5
+SEARCH_MAX_EXPANSIONS = 50
+# Typo matches kept per query term, the most common tokens first
+SEARCH_MAX_FUZZY = 8
 
-ACTIVE_OFFERS = {
-    "INDIAAFFIRM": {"discount": 10, "description": "10% off on all orders", "min_order": 0},
-    "FESTIVESAVE": {"discount_amount": 500, "description": "₹500 off on orders above ₹5000", "min_order": 5000},
-    "WELCOME15": {"discount": 15, "description": "15% off for new customers", "min_order": 0},
-    "BULK20": {"discount": 20, "description": "20% off on orders above ₹10000", "min_order": 10000},
-    "STUDENT25": {"discount": 25, "description": "25% student discount", "min_order": 0},
-    "SAVE1000": {"discount_amount": 1000, "description": "₹1000 off on orders above ₹15000", "min_order": 15000},
-}
+def search_tokens(text):
+    return SEARCH_TOKEN_RE.findall(text.lower())
+
+def _deletion_variants(token):
+    return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+class SearchIndex:
+    # Inverted index over product name, category, description and customization values.
+    # Prefix matches come from a sorted vocabulary; typo tolerance (one edit) from a
+    # symmetric-deletion table built alongside it.
+    def __init__(self, products, options):
+        # Indexing in name order makes the product index double as the tie-break rank
+        self.products = sorted(products, key=lambda p: p["name"])
+        self.postings = {}
+        for idx, product in enumerate(self.products):
+            weights = {}
+            fields = {
+                "name": product["name"],
+                "category": product["category_name"],
+                "description": product.get("description", ""),
+                "options": " ".join(v for opt in product.get("customizable", []) for v in options[opt]),
+            }
+            for field, text in fields.items():
+                for token in search_tokens(text):
+                    weights[token] = max(weights.get(token, 0.0), SEARCH_FIELD_WEIGHTS[field])
+            for token, weight in weights.items():
+                self.postings.setdefault(token, {})[idx] = weight
+        self.vocabulary = sorted(self.postings)
+        self.variants = {}
+        for token in self.vocabulary:
+            if len(token) >= 4:
+                self.variants.setdefault(token, set()).add(token)
+                for variant in _deletion_variants(token):
+                    self.variants.setdefault(variant, set()).add(token)
+
+    def _expand(self, term):
+        matches = {term: 1.0} if term in self.postings else {}
+        if len(term) >= 2:
+            start = bisect.bisect_left(self.vocabulary, term)
+            for token in self.vocabulary[start:start + SEARCH_MAX_EXPANSIONS]:
+                if not token.startswith(term):
+                    break
+                matches.setdefault(token, SEARCH_PREFIX_FACTOR)
+        if len(term) >= 4 and len(matches) < SEARCH_MAX_EXPANSIONS:
+            fuzzy = set()
+            for variant in _deletion_variants(term) | {term}:
+                fuzzy.update(self.variants.get(variant, ()))
+            fuzzy.difference_update(matches)
+            keep = min(SEARCH_MAX_FUZZY, SEARCH_MAX_EXPANSIONS - len(matches))
+            for token in sorted(fuzzy, key=lambda token: (-len(self.postings[token]), token))[:keep]:
+                matches[token] = SEARCH_FUZZY_FACTOR
+        return matches
+
+    def _scores(self, expansions):
+        # Best weighted score per product over every token the term expanded to
+        scores = None
+        for token, factor in expansions:
+            postings = self.postings[token]
+            if scores is None:
+                scores = dict(postings) if factor == 1.0 else {idx: w * factor for idx, w in postings.items()}
+                continue
+            for idx, weight in postings.items():
+                score = weight * factor
+                if score > scores.get(idx, 0.0):
+                    scores[idx] = score
+        return scores or {}
+
+    def _scores_within(self, expansions, candidates):
+        # The same scores for the given products only; the key-set intersection runs in C
+        # and walks the smaller side, so a rare term never pays for a common one's postings
+        scores = None
+        for token, factor in expansions:
+            postings = self.postings[token]
+            common = candidates.keys() & postings.keys()
+            if scores is None:
+                scores = {idx: postings[idx] * factor for idx in common}
+                continue
+            for idx in common:
+                score = postings[idx] * factor
+                if score > scores.get(idx, 0.0):
+                    scores[idx] = score
+        return scores or {}
+
+    def search(self, query, limit=200):
+        terms = list(dict.fromkeys(search_tokens(query)))
+        if not terms:
+            return []
+        matched = []
+        for term in terms:
+            expansions = sorted(self._expand(term).items(), key=lambda item: -item[1])
+            matched.append((sum(len(self.postings[token]) for token, _ in expansions), expansions))
+        # Products matching every term first, starting from the rarest term so each further term
+        # only narrows down the products still in the running
+        matched.sort(key=lambda item: item[0])
+        totals = self._scores(matched[0][1])
+        for _, expansions in matched[1:]:
+            if not totals:
+                break
+            totals = {idx: totals[idx] + score for idx, score in self._scores_within(expansions, totals).items()}
+        if not totals and len(matched) > 1:
+            # Nothing matches all of them: fall back to any term
+            for _, expansions in matched:
+                for idx, score in self._scores(expansions).items():
+                    totals[idx] = totals.get(idx, 0.0) + score
+        return [self.products[idx] for idx in self._top(totals, limit)]
+
+    @staticmethod
+    def _top(totals, limit):
+        # Best score first, then index order. The cut-off score comes from a sort of bare floats,
+        # so only the products that can make the page get sorted by key
+        if len(totals) > limit:
+            cut = sorted(totals.values(), reverse=True)[limit - 1]
+            ranked = sorted(idx for idx, score in totals.items() if score >= cut)
+        else:
+            ranked = sorted(totals)
+        # Stable, so equal scores stay in index order
+        ranked.sort(key=totals.__getitem__, reverse=True)
+        return ranked[:limit]
+
+class Catalog:
+    # Never mutated after construction: a reload builds a new Catalog and swaps the
+    # module-level reference, so a handler always sees one consistent version.
+    def __init__(self, data, version=1, mtime=None):
+        self.version = version
+        self.mtime = mtime
+        self.options = {opt_type: list(values) for opt_type, values in data["customization_options"].items()}
+        self.categories = {}
+        self.products = {}
+        for cat_id, cat_data in data["categories"].items():
+            products = []
+            for prod_id, prod in cat_data["products"].items():
+                unknown = [opt for opt in prod.get("customizable", []) if opt not in self.options]
+                if unknown:
+                    raise ValueError(f"Product {cat_id}/{prod_id} uses unknown customization options {unknown}")
+                price = float(prod["price"])
+                detail_text = f"📦 **{prod['name']}**\n\n💰 *Price: ₹{price:.2f}*\n\n📝 **Description:**\n{prod['description']}\n\n"
+                if prod.get("customizable"):
+                    detail_text += "🎨 *This product can be customized.*"
+                product = {
+                    **prod,
+                    "price": price,
+                    "category": cat_id,
+                    "category_name": cat_data["name"],
+                    "product_id": prod_id,
+                    "button_label": f"{prod['name']} - ₹{price:.2f}",
+                    "detail_text": detail_text,
+                }
+                self.products[(cat_id, prod_id)] = product
+                products.append(product)
+            self.categories[cat_id] = {"name": cat_data["name"], "products": products}
+
+        # Dense numeric IDs used in callback payloads
+        self.category_ids = list(self.categories)
+        self.category_index = {cat_id: i for i, cat_id in enumerate(self.category_ids)}
+        self.product_keys = list(self.products)
+        self.product_index = {key: i for i, key in enumerate(self.product_keys)}
+        self.option_types = list(self.options)
+        self.option_type_index = {opt_type: i for i, opt_type in enumerate(self.option_types)}
+        self.option_value_index = {opt_type: {v: i for i, v in enumerate(values)} for opt_type, values in self.options.items()}
+        self.search_index = SearchIndex(list(self.products.values()), self.options)
+        self.offers = OfferEngine(data.get("offers", {}), self)
+
+    def product(self, category_id, product_id):
+        return self.products.get((category_id, product_id))
+
+def load_catalog(path=CATALOG_FILE, version=1):
+    mtime = os.stat(path).st_mtime
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return Catalog(data, version, mtime)
+
+catalog = load_catalog()
 
 COMPANY_INFO = {
     "name": "TrustyLads®",
@@ -101,34 +1116,325 @@ COMPANY_INFO = {
     "why_choose": "✅ Premium Quality Products\n✅ Fast & Reliable Shipping Across India\n✅ Cash on Delivery (COD) Available\n✅ 30-Day Money Back Guarantee\n✅ 24/7 Customer Support\n✅ Secure Payment Processing"
 }
 
+# --- LIVE STATISTICS & READ MODEL ---
+# Bot state has a single owner, the bot loop. Only that thread mutates carts, sessions and
+# counters; the web threads never touch them and instead read an immutable snapshot that the
+# owner republishes after changes. Publishing swaps one reference, so readers take no lock.
+# stats_version only moves when the stats themselves differ from the previous snapshot's
+StateSnapshot = namedtuple("StateSnapshot", "version published_at stats sections stats_version")
+
+class LiveStats:
+    # Updated in O(1) by the cart/session/order mutators so the dashboard never rescans state
+    def __init__(self):
+        self._day = datetime.now().date()
+        self._counters = {
+            "total_orders": 0,
+            "total_revenue": 0.0,
+            "orders_today": 0,
+            "revenue_today": 0.0,
+            "total_products": 0,
+            "active_carts": 0,
+            "items_in_carts": 0,
+            "carts_abandoned": 0,
+        }
+
+    def _roll_day(self):
+        today = datetime.now().date()
+        if today != self._day:
+            self._day = today
+            self._counters["orders_today"] = 0
+            self._counters["revenue_today"] = 0.0
+
+    def incr(self, name, amount=1):
+        self._counters[name] += amount
+        read_model.mark_dirty()
+
+    def set(self, name, value):
+        self._counters[name] = value
+        read_model.mark_dirty()
+
+    def record_order(self, total):
+        self._roll_day()
+        c = self._counters
+        c["total_orders"] += 1
+        c["total_revenue"] += total
+        c["orders_today"] += 1
+        c["revenue_today"] += total
+        read_model.mark_dirty()
+
+    def record_cart_cleared(self, item_count, ordered):
+        c = self._counters
+        c["active_carts"] -= 1
+        c["items_in_carts"] -= item_count
+        if not ordered:
+            c["carts_abandoned"] += 1
+        read_model.mark_dirty()
+
+    def rebuild(self):
+        # Full recount, only done once at startup after state has been restored
+        today = datetime.now().date()
+        totals = order_store.totals(since=today.isoformat())
+        self._day = today
+        c = self._counters
+        c["total_orders"] = totals["orders"]
+        c["total_revenue"] = totals["revenue"]
+        c["orders_today"] = totals["orders_since"]
+        c["revenue_today"] = totals["revenue_since"]
+        # Spilled carts count towards both, so emptying one later never takes either below zero
+        carts = [cart for cart in itertools.chain(user_carts.values(), user_carts.spilled_values()) if cart]
+        c["active_carts"] = len(carts)
+        c["items_in_carts"] = sum(cart.count for cart in carts)
+        read_model.publish()
+
+    def collect(self):
+        self._roll_day()
+        stats = dict(self._counters)
+        stats["day"] = self._day.isoformat()
+        stats["active_users"] = len(user_sessions)
+        stats["total_revenue"] = round(stats["total_revenue"], 2)
+        stats["revenue_today"] = round(stats["revenue_today"], 2)
+        stats["average_order_value"] = round(stats["total_revenue"] / stats["total_orders"], 2) if stats["total_orders"] else 0.0
+        return stats
+
+class ReadModel:
+    def __init__(self):
+        self._current = StateSnapshot(0, time.time(), {}, {}, 0)
+        self._sources = {}
+        self._dirty = False
+        self._loop = None
+        self._owner_thread = None
+        self._changed = Condition()
+
+    def bind(self, loop):
+        self._loop = loop
+        self._owner_thread = get_ident()
+
+    def add_source(self, name, collect):
+        # Extra report sections (caches, stores) collected on the owner thread at publish time
+        self._sources[name] = collect
+
+    def unbind(self):
+        self._loop = self._owner_thread = None
+
+    def mark_dirty(self):
+        # Many mutations in one loop iteration collapse into a single publish
+        if self._dirty:
+            return
+        if self._loop is not None and get_ident() == self._owner_thread:
+            self._dirty = True
+            self._loop.call_soon(self.publish)
+        else:
+            self.publish()
+
+    def publish(self):
+        self._dirty = False
+        previous = self._current
+        stats = live_stats.collect()
+        # Every container in a snapshot is freshly built and never mutated afterwards
+        self._current = StateSnapshot(
+            version=previous.version + 1,
+            published_at=time.time(),
+            stats=stats,
+            sections={name: collect() for name, collect in self._sources.items()},
+            stats_version=previous.stats_version + (stats != previous.stats),
+        )
+        if self._current.stats_version != previous.stats_version:
+            with self._changed:
+                self._changed.notify_all()
+
+    def current(self):
+        return self._current
+
+    def wait_for_stats_change(self, stats_version, timeout):
+        # For web threads (dashboard event stream). The bot loop republishes every second for the
+        # store and queue sections; this only wakes when the stats have changed since stats_version
+        with self._changed:
+            return self._changed.wait_for(lambda: self._current.stats_version != stats_version, timeout)
+
+    def stats(self):
+        stats = self._current.stats
+        if stats and stats["day"] != datetime.now().date().isoformat():
+            # Nothing has been published since midnight; yesterday's "today" figures no longer apply
+            stats = {**stats, "orders_today": 0, "revenue_today": 0.0}
+        return stats
+
+read_model = ReadModel()
+read_model.add_source("session_store", lambda: {"sessions": user_sessions.report(), "carts": user_carts.report()})
+live_stats = LiveStats()
+live_stats.set("total_products", len(catalog.products))
+
+# --- METRICS ---
+# Prometheus text exposition at /metrics. Every series has a single writer thread: the bot
+# loop, or for the two order persistence histograms the order writer thread (only it calls
+# OrderWriter._write; restore() writes its batch without timing it). So recording is a bisect
+# and a few increments with no lock; a scrape copies the values and may miss an observation
+# that is mid-update.
+METRIC_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _metric_labels(names, values, le=None):
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class CounterMetric:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        for labels, value in list(self._values.items()):
+            yield f"{self.name}{_metric_labels(self.labels, labels)} {value}"
+
+class HistogramMetric:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=METRIC_LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [count per bucket..., +Inf count, sum]
+        self._series = {}
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self):
+        for labels, series in list(self._series.items()):
+            series = list(series)
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f"{self.name}_bucket{_metric_labels(self.labels, labels, bound)} {cumulative}"
+            cumulative += series[-2]
+            yield f"{self.name}_bucket{_metric_labels(self.labels, labels, '+Inf')} {cumulative}"
+            yield f"{self.name}_sum{_metric_labels(self.labels, labels)} {series[-1]}"
+            yield f"{self.name}_count{_metric_labels(self.labels, labels)} {cumulative}"
+
+class GaugeMetric:
+    # Read at scrape time. Bot state comes from the published read-model snapshot (snapshot_section);
+    # only counters outside it, like log_sampler.dropped (updated by any thread that logs), are read live
+    kind = "gauge"
+
+    def __init__(self, name, help_text, collect, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.collect = collect
+
+    def render(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            if value is not None:
+                yield f"{self.name}{_metric_labels(self.labels, labels)} {value}"
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+def snapshot_section(section, *path):
+    value = read_model.current().sections.get(section, {})
+    for key in path:
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+metrics = MetricsRegistry()
+handler_seconds = metrics.register(HistogramMetric("trustylads_handler_seconds", "Time spent in bot handlers, by handler and callback route or menu action", ("handler", "action")))
+telegram_api_requests = metrics.register(CounterMetric("trustylads_telegram_api_requests_total", "Bot API calls by method and outcome", ("method", "result")))
+telegram_api_seconds = metrics.register(HistogramMetric("trustylads_telegram_api_seconds", "Bot API call duration by method, one observation per attempt", ("method",)))
+checkout_funnel = metrics.register(CounterMetric("trustylads_checkout_funnel_total", "Checkouts reaching each step", ("step",)))
+order_persist_seconds = metrics.register(HistogramMetric("trustylads_order_persist_seconds", "Time from order submission until it is written to the order store"))
+order_batch_seconds = metrics.register(HistogramMetric("trustylads_order_batch_write_seconds", "Time to write one batch of orders", ("result",)))
+metrics.register(GaugeMetric("trustylads_store_entries", "Entries held in memory by the session and cart stores",
+                       lambda: {(store,): snapshot_section("session_store", store, "size") for store in ("sessions", "carts")}, ("store",)))
+metrics.register(GaugeMetric("trustylads_store_spilled_total", "Entries the session and cart stores have spilled to disk",
+                       lambda: {(store,): snapshot_section("session_store", store, "spilled") for store in ("sessions", "carts")}, ("store",)))
+metrics.register(GaugeMetric("trustylads_update_queue_depth", "Updates queued for the handler workers", lambda: snapshot_section("update_queue", "queued")))
+metrics.register(GaugeMetric("trustylads_send_queue_depth", "Bot API sends waiting in the send scheduler", lambda: snapshot_section("send_queue", "queued")))
+metrics.register(GaugeMetric("trustylads_orders_pending_write", "Orders accepted but not yet in the order store", lambda: snapshot_section("order_writer", "pending")))
+metrics.register(GaugeMetric("trustylads_log_records_sampled_out", "Log records dropped by per-category sampling since start",
+                             lambda: {(category,): count for category, count in list(log_sampler.dropped.items())}, ("category",)))
+metrics.register(GaugeMetric("trustylads_state_snapshot_age_seconds", "Age of the read-model snapshot behind the gauges",
+                       lambda: round(time.time() - read_model.current().published_at, 3)))
+
+def timed_handler(name, handler):
+    # For handlers registered directly (commands); the routers time their own branches
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        with handler_seconds.time(name, "-"):
+            return await handler(update, context)
+    return wrapper
+
+def enter_checkout_step(session, step):
+    session['current_context'] = step
+    checkout_funnel.inc(step)
+
 # --- FLASK WEB DASHBOARD ---
 app = Flask(__name__)
 
-@app.route('/')
-def home():
-    stats = {
-        "active_users": len(user_sessions),
-        "total_orders": sum(len(v) for v in user_orders.values()),
-        "total_products": sum(len(cat["products"]) for cat in PRODUCT_CATALOG.values()),
-        "active_carts": len([cart for cart in user_carts.values() if cart]),
-        "bot_uptime": "Online" if bot_running else "Starting..."
-    }
-    
-    return f"""
+# The page is split into static chunks once; a render only joins them with the stat values, and
+# happens at most once per change in those values. Browsers revalidate with ETag/Last-Modified
+# and get a 304 while nothing changed; an open page follows /dashboard/events (Server-Sent
+# Events) for the stats that changed. Each stream holds a server thread, so streams are capped
+# and closed after DASHBOARD_SSE_MAX_SECONDS (the browser reconnects on its own).
+DASHBOARD_SSE_MAX_CLIENTS = int(os.getenv("DASHBOARD_SSE_MAX_CLIENTS", "3"))
+DASHBOARD_SSE_MAX_SECONDS = float(os.getenv("DASHBOARD_SSE_MAX_SECONDS", "300"))
+DASHBOARD_SSE_HEARTBEAT = float(os.getenv("DASHBOARD_SSE_HEARTBEAT", "15"))
+DASHBOARD_SSE_MIN_INTERVAL = float(os.getenv("DASHBOARD_SSE_MIN_INTERVAL", "1"))
+DASHBOARD_SSE_RETRY_MS = 5000
+
+DASHBOARD_TEMPLATE = """
     <html>
         <head>
             <title>TrustyLads® India E-commerce Bot Dashboard</title>
             <meta name="viewport" content="width=device-width, initial-scale=1">
             <style>
-                body {{ font-family: 'Segoe UI', sans-serif; margin: 0; padding: 20px; 
+                body { font-family: 'Segoe UI', sans-serif; margin: 0; padding: 20px;
                        background: linear-gradient(135deg, #FF9933 0%, #FFFFFF 50%, #138808 100%); 
-                       color: #333; min-height: 100vh; }}
-                .container {{ max-width: 1000px; margin: 0 auto; }}
-                .card {{ background: rgba(255,255,255,0.8); padding: 20px; margin: 20px 0; 
-                        border-radius: 15px; backdrop-filter: blur(10px); border: 1px solid #ddd;}}
-                .stats {{ display: grid; grid-template-columns: repeat(auto-fit, minmax(180px, 1fr)); gap: 15px; }}
-                .stat {{ text-align: center; padding: 15px; background: rgba(255,255,255,0.5); border-radius: 10px; }}
-                .feature {{ margin: 10px 0; padding: 10px; background: rgba(19, 136, 8, 0.1); border-radius: 8px; }}
+                       color: #333; min-height: 100vh; }
+                .container { max-width: 1000px; margin: 0 auto; }
+                .card { background: rgba(255,255,255,0.8); padding: 20px; margin: 20px 0;
+                        border-radius: 15px; backdrop-filter: blur(10px); border: 1px solid #ddd;}
+                .stats { display: grid; grid-template-columns: repeat(auto-fit, minmax(180px, 1fr)); gap: 15px; }
+                .stat { text-align: center; padding: 15px; background: rgba(255,255,255,0.5); border-radius: 10px; }
+                .feature { margin: 10px 0; padding: 10px; background: rgba(19, 136, 8, 0.1); border-radius: 8px; }
             </style>
         </head>
         <body>
@@ -137,11 +1443,14 @@ def home():
                 <div class="card">
                     <h2>📊 Live E-commerce Statistics</h2>
                     <div class="stats">
-                        <div class="stat"><h3>{stats['active_users']}</h3><p>Active Users</p></div>
-                        <div class="stat"><h3>{stats['total_orders']}</h3><p>Total Orders</p></div>
-                        <div class="stat"><h3>{stats['total_products']}</h3><p>Products Available</p></div>
-                        <div class="stat"><h3>{stats['active_carts']}</h3><p>Active Carts</p></div>
-                        <div class="stat"><h3>{'✅' if bot_running else '⏳'}</h3><p>{stats['bot_uptime']}</p></div>
+                        <div class="stat"><h3>{{active_users}}</h3><p>Active Users</p></div>
+                        <div class="stat"><h3>{{total_orders}}</h3><p>Total Orders</p></div>
+                        <div class="stat"><h3>{{total_products}}</h3><p>Products Available</p></div>
+                        <div class="stat"><h3>{{active_carts}}</h3><p>Active Carts</p></div>
+                        <div class="stat"><h3>{{revenue_today}}</h3><p>Revenue Today ({{orders_today}} orders)</p></div>
+                        <div class="stat"><h3>{{average_order_value}}</h3><p>Average Order Value</p></div>
+                        <div class="stat"><h3>{{carts_abandoned}}</h3><p>Carts Abandoned</p></div>
+                        <div class="stat"><h3>{{bot_icon}}</h3><p>{{bot_uptime}}</p></div>
                     </div>
                 </div>
                 <div class="card">
@@ -157,132 +1466,1615 @@ def home():
                 </div>
                 <div class="card">
                     <h2>📈 Business Information</h2>
-                    <p><strong>Company:</strong> {COMPANY_INFO['name']}</p>
-                    <p><strong>Products:</strong> {stats['total_products']} customizable items across 4 categories</p>
-                    <p><strong>Bot Status:</strong> {'✅ Online' if bot_running else '❌ Offline'}</p>
+                    <p><strong>Company:</strong> {{company}}</p>
+                    <p><strong>Products:</strong> {{total_products}} customizable items across 4 categories</p>
+                    <p><strong>Bot Status:</strong> {{bot_status}}</p>
                     <p><a href="/health" style="color: #138808;">Health Check</a> | 
                        <a href="/orders" style="color: #138808;">Order Management</a></p>
                 </div>
             </div>
+            <script>
+                if (window.EventSource) {
+                    new EventSource("/dashboard/events").addEventListener("stats", function (event) {
+                        var changed = JSON.parse(event.data);
+                        for (var name in changed) {
+                            document.querySelectorAll('[data-stat="' + name + '"]').forEach(function (el) { el.textContent = changed[name]; });
+                        }
+                    });
+                }
+            </script>
         </body>
     </html>
     """
 
-@app.route('/health')
-def health_check():
-    return jsonify({
-        "status": "healthy" if bot_running else "starting",
-        "service": "trusty-lads-ecommerce-bot-india-enhanced",
-        "version": "5.0-IN",
-        "features": [
-            "product_catalog", "product_customization", "shopping_cart", "checkout_process", 
-            "order_management", "hidden_promo_codes", "customer_support",
-            "order_history", "company_info_in", "functional_contact_links"
-        ],
-        "active_users": len(user_sessions),
-        "total_orders": sum(len(v) for v in user_orders.values()),
-        "bot_running": bot_running
-    })
+def compile_dashboard(template, static):
+    # -> list of chunks where odd positions are the names of live stats
+    chunks = re.split(r"\{\{(\w+)\}\}", template)
+    for i in range(1, len(chunks), 2):
+        name = chunks[i]
+        if name in static:
+            chunks[i] = static[name]
+        else:
+            # Wrapped so the event stream can find and update the value in place
+            chunks[i - 1] += f'<span data-stat="{name}">'
+            chunks[i + 1] = "</span>" + chunks[i + 1]
+    return chunks
+
+def dashboard_values():
+    stats = read_model.stats()
+    return {
+        "active_users": str(stats["active_users"]),
+        "total_orders": str(stats["total_orders"]),
+        "total_products": str(stats["total_products"]),
+        "active_carts": str(stats["active_carts"]),
+        "revenue_today": f"₹{stats['revenue_today']:.2f}",
+        "orders_today": str(stats["orders_today"]),
+        "average_order_value": f"₹{stats['average_order_value']:.2f}",
+        "carts_abandoned": str(stats["carts_abandoned"]),
+        "bot_icon": "✅" if bot_running else "⏳",
+        "bot_uptime": "Online" if bot_running else "Starting...",
+        "bot_status": "✅ Online" if bot_running else "❌ Offline",
+    }
+
+class DashboardPage:
+    def __init__(self, template, static):
+        self._chunks = compile_dashboard(template, static)
+        # (values, body, etag, last_modified), replaced whole so readers never see a mix
+        self._rendered = (None, b"", "", None)
+
+    def render(self):
+        values = dashboard_values()
+        rendered = self._rendered
+        if values != rendered[0]:
+            chunks = list(self._chunks)
+            for i in range(1, len(chunks), 2):
+                if chunks[i] in values:
+                    chunks[i] = values[chunks[i]]
+            body = "".join(chunks).encode("utf-8")
+            rendered = self._rendered = (values, body, hashlib.sha1(body).hexdigest(), datetime.now(timezone.utc))
+        return rendered
+
+dashboard_page = DashboardPage(DASHBOARD_TEMPLATE, {"company": COMPANY_INFO["name"]})
+dashboard_streams = BoundedSemaphore(DASHBOARD_SSE_MAX_CLIENTS)
+
+@app.route('/')
+def home():
+    _, body, etag, last_modified = dashboard_page.render()
+    response = Response(body, mimetype="text/html")
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # Let browsers keep the page but revalidate on every load
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def dashboard_event_stream():
+    now = time.monotonic()
+    deadline = now + DASHBOARD_SSE_MAX_SECONDS
+    heartbeat_at = now + DASHBOARD_SSE_HEARTBEAT
+    sent = {}
+    yield f"retry: {DASHBOARD_SSE_RETRY_MS}\n\n"
+    while True:
+        stats_version = read_model.current().stats_version
+        values = dashboard_values()
+        changed = {name: value for name, value in values.items() if sent.get(name) != value}
+        if changed:
+            sent = values
+            yield f"event: stats\ndata: {json.dumps(changed, ensure_ascii=False)}\n\n"
+            heartbeat_at = time.monotonic() + DASHBOARD_SSE_HEARTBEAT
+            # Busy periods change the stats many times a second; batch them into one event per interval
+            time.sleep(DASHBOARD_SSE_MIN_INTERVAL)
+        elif time.monotonic() >= heartbeat_at:
+            # Kept on its own timer so a quiet stream still writes, which is how a closed tab is noticed
+            yield ": keep-alive\n\n"
+            heartbeat_at = time.monotonic() + DASHBOARD_SSE_HEARTBEAT
+        now = time.monotonic()
+        if now >= deadline:
+            return
+        read_model.wait_for_stats_change(stats_version, min(heartbeat_at, deadline) - now)
+
+@app.route('/dashboard/events')
+def dashboard_events():
+    if not dashboard_streams.acquire(blocking=False):
+        return Response("Too many live dashboards open\n", status=503, headers={"Retry-After": "30"}, mimetype="text/plain")
+    response = Response(dashboard_event_stream(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.call_on_close(dashboard_streams.release)
+    return response
+
+@app.route('/health')
+def health_check():
+    snapshot = read_model.current()
+    stats = read_model.stats()
+    return jsonify({
+        "status": "healthy" if bot_running else "starting",
+        "service": "trusty-lads-ecommerce-bot-india-enhanced",
+        "version": "5.0-IN",
+        "features": [
+            "product_catalog", "product_customization", "shopping_cart", "checkout_process",
+            "order_management", "hidden_promo_codes", "customer_support",
+            "order_history", "company_info_in", "functional_contact_links"
+        ],
+        "active_users": stats["active_users"],
+        "total_orders": stats["total_orders"],
+        "stats": stats,
+        "session_store": snapshot.sections.get("session_store", {}),
+        "render_cache": snapshot.sections.get("render_cache", {}),
+        "update_queue": snapshot.sections.get("update_queue", {}),
+        "send_queue": snapshot.sections.get("send_queue", {}),
+        "update_recorder": snapshot.sections.get("update_recorder", {}),
+        "order_ids": snapshot.sections.get("order_ids", {}),
+        "order_writer": snapshot.sections.get("order_writer", {}),
+        "state_version": snapshot.version,
+        "bot_running": bot_running
+    })
+
+ORDERS_PAGE_SIZE = 100
+ORDERS_MAX_PAGE_SIZE = 1000
+ORDERS_STREAM_CHUNK = 500
+
+def parse_order_filters(args):
+    criteria = {}
+    if args.get("status"):
+        criteria["status"] = args["status"]
+    if args.get("user_id"):
+        criteria["user_id"] = int(args["user_id"])
+    if args.get("phone"):
+        criteria["phone"] = args["phone"]
+    if args.get("from"):
+        criteria["date_from"] = datetime.fromisoformat(args["from"]).isoformat()
+    if args.get("to"):
+        date_to = datetime.fromisoformat(args["to"])
+        if len(args["to"]) == 10:  # A bare date includes the whole day
+            date_to += timedelta(days=1)
+        criteria["date_to"] = date_to.isoformat()
+    return criteria
+
+def order_matches(order, status=None, user_id=None, phone=None, date_from=None, date_to=None):
+    # The same conditions OrderStore.query_orders puts in its WHERE clause
+    return ((status is None or order["status"] == status)
+            and (user_id is None or order["user_id"] == user_id)
+            and (phone is None or order.get("phone") == phone)
+            and (date_from is None or order["date"] >= date_from)
+            and (date_to is None or order["date"] < date_to))
+
+def query_orders_with_pending(cursor, limit, descending, **criteria):
+    # Orders still queued in the writer are merged in by order number, so keyset cursors keep working
+    pending = [o for o in order_writer.inflight() if order_matches(o, **criteria)]
+    if cursor is not None:
+        pending = [o for o in pending if (order_number(o["order_id"]) < cursor if descending else order_number(o["order_id"]) > cursor)]
+    stored = order_store.query_orders(cursor=cursor, limit=limit, descending=descending, **criteria)
+    if not pending:
+        return stored
+    merged = {o["order_id"]: o for o in pending}
+    merged.update((o["order_id"], o) for o in stored)
+    return sorted(merged.values(), key=lambda o: order_number(o["order_id"]), reverse=descending)[:limit]
+
+def stream_orders_ndjson(criteria, cursor, descending):
+    while True:
+        page = query_orders_with_pending(cursor, ORDERS_STREAM_CHUNK, descending, **criteria)
+        for order in page:
+            yield json.dumps(order, ensure_ascii=False) + "\n"
+        if len(page) < ORDERS_STREAM_CHUNK:
+            return
+        cursor = order_number(page[-1]["order_id"])
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route('/orders')
+def orders_dashboard():
+    args = request.args
+    try:
+        criteria = parse_order_filters(args)
+        cursor = int(args["cursor"]) if args.get("cursor") else None
+        limit = min(max(int(args.get("limit", ORDERS_PAGE_SIZE)), 1), ORDERS_MAX_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+    descending = args.get("order", "desc") != "asc"
+
+    if args.get("format") == "ndjson" or request.accept_mimetypes.best == "application/x-ndjson":
+        return Response(stream_orders_ndjson(criteria, cursor, descending), mimetype="application/x-ndjson")
+
+    orders = query_orders_with_pending(cursor, limit, descending, **criteria)
+    stats = read_model.stats()
+    next_cursor = order_number(orders[-1]["order_id"]) if len(orders) == limit else None
+    return jsonify({
+        "total_orders": stats["total_orders"],
+        "orders": orders,
+        "count": len(orders),
+        "next_cursor": next_cursor,
+        # Same per-user shape as ever (carts in memory); the count includes carts spilled to the backend
+        "active_carts": run_on_bot_loop(active_carts_by_user),
+        "active_cart_count": stats["active_carts"]
+    })
+
+def active_carts_by_user():
+    return {str(user_id): cart.to_legacy() for user_id, cart in user_carts.items() if cart}
+
+SHARD_FORWARD_HEADER = "X-TrustyLads-Forwarded-By"
+
+def update_user_id(data):
+    # Every user-originated update type carries its sender under "from" (or "user" for poll answers)
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("user")
+            if isinstance(sender, dict) and "id" in sender:
+                return sender["id"]
+    return None
+
+def shard_for_user(user_id):
+    return 0 if user_id is None else user_id % WORKER_COUNT
+
+def forward_update(shard, body):
+    # Synchronous, so the owner has queued the update before Telegram gets its answer and sends the next one
+    forward = urllib.request.Request(
+        f"{WORKER_URLS[shard]}{WEBHOOK_PATH}", data=body, method="POST",
+        headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET,
+                 SHARD_FORWARD_HEADER: str(WORKER_INDEX)},
+    )
+    try:
+        with urllib.request.urlopen(forward, timeout=SHARD_FORWARD_TIMEOUT) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError as e:
+        # A non-2xx makes Telegram redeliver the update later
+        logger.error("❌ Could not forward update to worker %s: %s", shard, e)
+        return 502
+
+@app.route(WEBHOOK_PATH, methods=['POST'])
+def telegram_webhook():
+    application, loop = bot_application, bot_loop
+    if BOT_MODE != "webhook" or application is None or loop is None or not bot_running:
+        return jsonify({"error": "bot is not accepting webhook updates"}), 503
+    if not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+        return jsonify({"error": "forbidden"}), 403
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or "update_id" not in data:
+        return jsonify({"error": "invalid update"}), 400
+    if WORKER_COUNT > 1 and not request.headers.get(SHARD_FORWARD_HEADER):
+        shard = shard_for_user(update_user_id(data))
+        if shard != WORKER_INDEX:
+            return "", forward_update(shard, request.get_data())
+
+    try:
+        update = Update.de_json(data, application.bot)
+    except Exception as e:
+        # A 500 would make Telegram redeliver the same broken body forever
+        logger.warning("⚠️ Dropping malformed webhook update %s: %s", data.get("update_id"), e)
+        return jsonify({"error": "invalid update"}), 400
+    # Hand the update to the bot loop and acknowledge straight away; Telegram only needs the 200
+    loop.call_soon_threadsafe(application.update_queue.put_nowait, update)
+    return "", 200
+
+# --- ADMIN PROFILING ---
+# Token-protected endpoints for looking inside the bot thread while it runs. Nothing here
+# costs anything until asked: the sampler thread and tracemalloc only exist between start and
+# stop. Loop lag is always measured, from the 1 s housekeeping tick in run_bot_async.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 300))
+LOOP_LAG_WINDOW = 300
+
+def admin_denied():
+    # None when the request carries the admin token; the endpoints don't exist without one
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "not found"}), 404
+    supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip() or request.headers.get("X-Admin-Token", "")
+    if not hmac.compare_digest(supplied, ADMIN_TOKEN):
+        return jsonify({"error": "forbidden"}), 403
+    return None
+
+def run_on_bot_loop(fn, timeout=10):
+    # Bot state belongs to the bot loop; inspect it there rather than from a web thread
+    loop = bot_loop
+    if loop is None:
+        return fn()
+    async def call():
+        return fn()
+    return asyncio.run_coroutine_threadsafe(call(), loop).result(timeout)
+
+class StackSampler:
+    # Samples one thread's Python stack at a fixed interval and counts identical stacks,
+    # which is exactly the collapsed format flamegraph.pl and speedscope read
+    def __init__(self):
+        self._lock = Lock()
+        self._thread = None
+        self._stop = None
+        self._stacks = {}
+        self.samples = 0
+        self.interval = None
+        self.started_at = None
+        self.stopped_at = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, thread_id, interval, max_seconds=PROFILE_MAX_SECONDS):
+        with self._lock:
+            if self.running:
+                return False
+            self._stacks = {}
+            self.samples = 0
+            self.interval = interval
+            self.started_at, self.stopped_at = time.time(), None
+            self._stop = Event()
+            self._thread = Thread(target=self._run, args=(thread_id, interval, max_seconds), name="bot-profiler", daemon=True)
+            self._thread.start()
+        logger.info("🔬 Profiling bot thread every %.1f ms (for at most %.0fs).", interval * 1000, max_seconds)
+        return True
+
+    def _run(self, thread_id, interval, max_seconds):
+        labels = {}
+        deadline = time.monotonic() + max_seconds
+        while not self._stop.wait(interval) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                stack.append(label)
+                frame = frame.f_back
+            stack.reverse()
+            key = tuple(stack)
+            self._stacks[key] = self._stacks.get(key, 0) + 1
+            self.samples += 1
+        self.stopped_at = time.time()
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread:
+            self._stop.set()
+            thread.join()
+            logger.info("🔬 Profiling stopped after %s samples.", self.samples)
+
+    def collapsed(self):
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in sorted(list(self._stacks.items())))
+
+    def report(self, top=20):
+        leaves = {}
+        for stack, count in list(self._stacks.items()):
+            leaves[stack[-1]] = leaves.get(stack[-1], 0) + count
+        end = self.stopped_at or time.time()
+        return {
+            "running": self.running,
+            "samples": self.samples,
+            "interval_ms": self.interval * 1000 if self.interval else None,
+            "seconds": round(end - self.started_at, 3) if self.started_at else 0.0,
+            "distinct_stacks": len(self._stacks),
+            "top_self": [{"frame": frame, "samples": count, "share": round(count / self.samples, 4)}
+                         for frame, count in heapq.nlargest(top, leaves.items(), key=lambda item: item[1])],
+        }
+
+class LoopLagMonitor:
+    def __init__(self, window=LOOP_LAG_WINDOW):
+        self._recent = deque(maxlen=window)
+        self.histogram = metrics.register(HistogramMetric("trustylads_event_loop_lag_seconds", "How late the bot loop's 1 s tick fires"))
+
+    def record(self, lag):
+        lag = max(lag, 0.0)
+        self._recent.append(lag)
+        self.histogram.observe(lag)
+
+    def report(self):
+        recent = sorted(self._recent)
+        if not recent:
+            return {"ticks": 0}
+        return {
+            "ticks": len(recent),
+            "last_ms": round(self._recent[-1] * 1000, 3),
+            "p50_ms": round(recent[len(recent) // 2] * 1000, 3),
+            "p99_ms": round(recent[min(len(recent) - 1, len(recent) * 99 // 100)] * 1000, 3),
+            "max_ms": round(recent[-1] * 1000, 3),
+        }
+
+def deep_sizeof(root):
+    # Bytes reachable from root through containers and instance attributes (shared objects once)
+    seen, total, stack = set(), 0, [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+        elif hasattr(obj, "__slots__"):
+            stack.extend(getattr(obj, name) for name in obj.__slots__ if hasattr(obj, name))
+        elif hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+    return total
+
+def measure_state_structures():
+    inflight = order_writer.inflight()
+    return {
+        "user_sessions": {"entries": len(user_sessions), "bytes": deep_sizeof(user_sessions.items())},
+        "user_carts": {"entries": len(user_carts), "bytes": deep_sizeof(user_carts.items())},
+        # Orders live in the order store; only those still queued for it are held in memory
+        "orders_inflight": {"entries": len(inflight), "bytes": deep_sizeof(inflight)},
+    }
+
+class MemoryTracer:
+    def __init__(self):
+        self._baseline = None
+
+    def start(self, frames=1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            logger.info("🧠 tracemalloc started (%s frame(s)).", frames)
+        self._baseline = tracemalloc.take_snapshot()
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            logger.info("🧠 tracemalloc stopped.")
+        self._baseline = None
+
+    def report(self, top=15):
+        if not tracemalloc.is_tracing():
+            return {"tracing": False}
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        current, peak = tracemalloc.get_traced_memory()
+        report = {
+            "tracing": True,
+            "current_bytes": current,
+            "peak_bytes": peak,
+            "top": [{"where": str(stat.traceback), "bytes": stat.size, "blocks": stat.count}
+                    for stat in snapshot.statistics("lineno")[:top]],
+        }
+        if self._baseline is not None:
+            report["growth_since_start"] = [{"where": str(stat.traceback), "bytes": stat.size_diff, "blocks": stat.count_diff}
+                                            for stat in snapshot.compare_to(self._baseline, "lineno")[:top]]
+        return report
+
+stack_sampler = StackSampler()
+loop_lag = LoopLagMonitor()
+memory_tracer = MemoryTracer()
+
+@app.route('/admin/profile/start', methods=['POST'])
+def admin_profile_start():
+    denied = admin_denied()
+    if denied:
+        return denied
+    if bot_thread_id is None:
+        return jsonify({"error": "bot is not running"}), 503
+    try:
+        interval = float(request.args.get("interval_ms", PROFILE_INTERVAL_MS)) / 1000
+        seconds = min(float(request.args.get("seconds", PROFILE_MAX_SECONDS)), PROFILE_MAX_SECONDS)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+    if not stack_sampler.start(bot_thread_id, max(interval, 0.001), seconds):
+        return jsonify({"error": "already profiling"}), 409
+    return jsonify(stack_sampler.report())
+
+@app.route('/admin/profile/stop', methods=['POST'])
+def admin_profile_stop():
+    denied = admin_denied()
+    if denied:
+        return denied
+    stack_sampler.stop()
+    return admin_profile_results()
+
+@app.route('/admin/profile')
+def admin_profile_results():
+    denied = admin_denied()
+    if denied:
+        return denied
+    if request.args.get("format", "collapsed") == "json":
+        return jsonify(stack_sampler.report())
+    return Response(stack_sampler.collapsed(), mimetype="text/plain")
+
+@app.route('/admin/memory/start', methods=['POST'])
+def admin_memory_start():
+    denied = admin_denied()
+    if denied:
+        return denied
+    memory_tracer.start(min(max(request.args.get("frames", 1, type=int), 1), 25))
+    return jsonify({"tracing": True})
+
+@app.route('/admin/memory/stop', methods=['POST'])
+def admin_memory_stop():
+    denied = admin_denied()
+    if denied:
+        return denied
+    memory_tracer.stop()
+    return jsonify({"tracing": False})
+
+@app.route('/admin/memory')
+def admin_memory():
+    denied = admin_denied()
+    if denied:
+        return denied
+    return jsonify({"structures": run_on_bot_loop(measure_state_structures), "tracemalloc": memory_tracer.report()})
+
+@app.route('/admin/loop-lag')
+def admin_loop_lag():
+    denied = admin_denied()
+    if denied:
+        return denied
+    return jsonify(loop_lag.report())
+
+# --- USER SESSION & CART MANAGEMENT ---
+def get_user_session(user_id):
+    session = user_sessions.get(user_id)
+    if session is None:
+        session = user_sessions[user_id] = {
+            "first_interaction": datetime.now().isoformat(),
+            "message_count": 0,
+            "current_context": None,
+            "checkout_data": {},
+            "customization_data": {}
+        }
+    return session
+
+def get_user_cart(user_id):
+    cart = user_carts.get(user_id)
+    if cart is None:
+        cart = user_carts[user_id] = Cart()
+    return cart
+
+def add_to_cart(user_id, category, product_id, customizations=None):
+    product = catalog.product(category, product_id)
+    if product is None:
+        raise KeyError(f"Unknown product {category}/{product_id}")
+    cart = get_user_cart(user_id)
+    if not cart:
+        live_stats.incr("active_carts")
+    live_stats.incr("items_in_carts")
+    # Lines keep the price they were added at
+    line = cart.add(category, product_id, product["name"], product["price"], customization_key(customizations))
+    state_journal.append("cart_set", user_id=user_id, line=line.to_json())
+    return line
+
+def set_cart_line_quantity(user_id, line, quantity):
+    cart = get_user_cart(user_id)
+    live_stats.incr("items_in_carts", quantity - line.quantity)
+    cart.set_quantity(line, quantity)
+    if not cart:
+        live_stats.incr("active_carts", -1)
+    state_journal.append("cart_set", user_id=user_id, line=line.to_json())
+
+def calculate_cart_total(user_id):
+    return get_user_cart(user_id).total
+
+async def best_offer(user_id, advertised_only=False):
+    # (discount in paise, OfferRule) of the best offer this user's cart qualifies for, or None
+    uses = await asyncio.to_thread(get_user_promo_uses, user_id)
+    return catalog.offers.best(get_user_cart(user_id), lambda: uses, advertised_only=advertised_only)
+
+async def check_promo_code(user_id, code):
+    uses = await asyncio.to_thread(get_user_promo_uses, user_id)
+    return catalog.offers.check(code, get_user_cart(user_id), lambda: uses)
+
+def clear_user_cart(user_id, ordered=False):
+    cart = user_carts.get(user_id)
+    if cart is not None:
+        if cart:
+            live_stats.record_cart_cleared(cart.count, ordered)
+        cart.clear()
+        user_carts[user_id] = cart
+        state_journal.append("cart_clear", user_id=user_id)
+
+async def load_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs before the handlers: bring the user's session and cart in from the backend off the loop
+    user = update.effective_user
+    if user is None:
+        return
+    await user_sessions.load(user.id)
+    await user_carts.load(user.id)
+
+async def persist_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs after the handlers: write the user's state through so whichever worker sees them next has it
+    user = update.effective_user
+    if user is None:
+        return
+    user_sessions.release(user.id)
+    user_carts.release(user.id)
+    if not state_backend.shared:
+        return
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, user_sessions.persist, user.id)
+        await loop.run_in_executor(None, user_carts.persist, user.id)
+    except (OSError, StateBackendError) as e:
+        logger.error("Error persisting state for user %s: %s", user.id, e)
+
+def save_order(user_id, order_data):
+    order_id = f"{ORDER_ID_PREFIX}{order_ids.allocate()}"
+
+    order = {
+        "order_id": order_id,
+        "user_id": user_id,
+        "date": datetime.now().isoformat(),
+        "status": "Confirmed",
+        **order_data
+    }
+
+    # In flight before it is journaled, so a snapshot triggered by this append already keeps it
+    order_writer.submit(order)
+    state_journal.append("order", order=order)
+    live_stats.record_order(order.get("total", 0))
+    log_event("order", "🧾 Order %s placed by user %s (₹%.2f)", order_id, user_id, order.get("total", 0),
+              order_id=order_id, user_id=user_id, total=order.get("total", 0), promo_code=order.get("promo_code"))
+    return order_id
+
+# --- ORDER PERSISTENCE (WRITE-BEHIND) ---
+ORDERS_DIR = "orders"
+ORDERS_LOG_FILE = "all_orders_in.txt"
+ORDER_QUEUE_SIZE = int(os.getenv("ORDER_QUEUE_SIZE", 1000))
+ORDER_BATCH_SIZE = int(os.getenv("ORDER_BATCH_SIZE", 100))
+ORDER_FLUSH_INTERVAL = float(os.getenv("ORDER_FLUSH_INTERVAL", 0.5))
+# How long finalize_order waits for room in a full queue before asking the customer to try again
+ORDER_SUBMIT_TIMEOUT = float(os.getenv("ORDER_SUBMIT_TIMEOUT", 5))
+# A batch that fails to write is retried with exponential backoff; until then it stays in flight
+ORDER_RETRY_BACKOFF = float(os.getenv("ORDER_RETRY_BACKOFF", 0.5))
+ORDER_RETRY_MAX_BACKOFF = float(os.getenv("ORDER_RETRY_MAX_BACKOFF", 30))
+# Optional file exports alongside the order store: "json" (orders/order_<id>.json) and/or "txt" (all_orders_in.txt)
+ORDER_EXPORTS = {s.strip() for s in os.getenv("ORDER_EXPORTS", "txt").split(",") if s.strip()}
+
+def format_order_log_entry(order):
+    lines = [
+        f"\n--- ORDER {order['order_id']} ---",
+        f"Date: {order['date']}",
+        f"Customer: {order.get('full_name', 'N/A')}",
+        f"Phone: {order.get('phone', 'N/A')}",
+        f"Total: ₹{order.get('total', 0):.2f}",
+        f"Payment: {order.get('payment_method', 'N/A')}",
+        "Items:"
+    ]
+    for item in order.get('items', []):
+        lines.append(f"  - {item['name']} x{item['quantity']} (₹{item['price']:.2f})")
+        if item.get('customizations'):
+            custom_str = ", ".join([f"{k.title()}: {v}" for k,v in item['customizations'].items()])
+            lines.append(f"    Customizations: {custom_str}")
+    lines.append("-" * 30)
+    return "\n".join(lines) + "\n"
+
+def fsync_directory(path):
+    # Makes newly created file names durable; not supported on every platform
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def export_orders_json(orders):
+    # Every file in the batch is written first and then synced, so the disk waits once per batch
+    os.makedirs(ORDERS_DIR, exist_ok=True)
+    files = []
+    try:
+        for order in orders:
+            f = open(os.path.join(ORDERS_DIR, f"order_{order['order_id']}.json"), "w")
+            files.append(f)
+            json.dump(order, f, indent=4)
+            f.flush()
+        for f in files:
+            os.fsync(f.fileno())
+    finally:
+        for f in files:
+            f.close()
+    fsync_directory(ORDERS_DIR)
+
+def export_orders_txt(orders):
+    # One append and one fsync for the whole batch instead of one per order
+    with open(ORDERS_LOG_FILE, "a") as f:
+        f.write("".join(format_order_log_entry(order) for order in orders))
+        f.flush()
+        os.fsync(f.fileno())
+
+def write_order_batch(orders):
+    # The SQLite store is the durable copy and goes first; the shared index is best effort after it
+    order_store.insert_many(orders)
+    if "json" in ORDER_EXPORTS:
+        export_orders_json(orders)
+    if "txt" in ORDER_EXPORTS:
+        export_orders_txt(orders)
+    if order_index is not order_store:
+        order_index.insert_best_effort(orders)
+
+class OrderQueueFull(Exception):
+    pass
+
+class OrderWriter:
+    _STOP = object()
+
+    def __init__(self, sink, maxsize=ORDER_QUEUE_SIZE, batch_size=ORDER_BATCH_SIZE, flush_interval=ORDER_FLUSH_INTERVAL):
+        self.sink = sink
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Bounded: submit() never blocks the bot loop and refuses an order when the queue is full
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._stopping = Event()
+        self._lock = Lock()
+        self._inflight = {}
+        self._submitted_at = {}
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = Thread(target=self._run, name="order-writer", daemon=True)
+            self._thread.start()
+            logger.info("💾 Order writer started.")
+
+    def submit(self, order):
+        # Called on the bot loop: never blocks and never writes inline
+        self.start()
+        with self._lock:
+            self._inflight[order["order_id"]] = order
+            self._submitted_at[order["order_id"]] = time.monotonic()
+        try:
+            self._queue.put_nowait(order)
+        except queue.Full:
+            with self._lock:
+                self._inflight.pop(order["order_id"], None)
+                self._submitted_at.pop(order["order_id"], None)
+            self.rejected += 1
+            logger.warning("⚠️ Order queue full (%s), refusing %s.", self.maxsize, order["order_id"])
+            raise OrderQueueFull(order["order_id"])
+
+    def is_saturated(self):
+        return self._queue.qsize() >= self.maxsize
+
+    async def wait_for_capacity(self, timeout=None, poll_interval=0.05):
+        # True once submit() has room; False if the queue is still full after timeout
+        timeout = ORDER_SUBMIT_TIMEOUT if timeout is None else timeout
+        waited = 0.0
+        while self.is_saturated() and waited < timeout:
+            await asyncio.sleep(poll_interval)
+            waited += poll_interval
+        return not self.is_saturated()
+
+    def pending(self):
+        return len(self._inflight)
+
+    def inflight(self, user_id=None):
+        with self._lock:
+            orders = list(self._inflight.values())
+        if user_id is not None:
+            orders = [o for o in orders if o["user_id"] == user_id]
+        return orders
+
+    def report(self):
+        return {"pending": len(self._inflight), "queued": self._queue.qsize(), "written": self.written, "failed": self.failed,
+                "rejected": self.rejected}
+
+    def flush(self):
+        if self._thread and self._thread.is_alive():
+            self._queue.join()
+
+    def stop(self):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if not thread or not thread.is_alive():
+            return
+        self._stopping.set()
+        self._queue.put(self._STOP)
+        thread.join()
+        logger.info("💾 Order writer drained and stopped (%s orders written).", self.written)
+
+    def _write(self, batch):
+        # Writer thread only, so the order metrics below keep a single writer
+        started = time.perf_counter()
+        try:
+            self.sink(batch)
+        except Exception as e:
+            self.failed += len(batch)
+            order_batch_seconds.observe(time.perf_counter() - started, "error")
+            logger.error("Error saving order batch (%s): %s", ", ".join(o["order_id"] for o in batch), e)
+            return False
+        self.written += len(batch)
+        order_batch_seconds.observe(time.perf_counter() - started, "ok")
+        # Only a written order leaves the in-flight set, and with it the state snapshots
+        now = time.monotonic()
+        with self._lock:
+            for order in batch:
+                self._inflight.pop(order["order_id"], None)
+                submitted_at = self._submitted_at.pop(order["order_id"], None)
+                if submitted_at is not None:
+                    order_persist_seconds.observe(now - submitted_at)
+        return True
+
+    def _write_with_retry(self, batch):
+        delay = ORDER_RETRY_BACKOFF
+        while not self._write(batch):
+            if self._stopping.is_set():
+                # Still in flight, so the shutdown snapshot keeps them and restore() writes them on the next start
+                logger.error("❌ %s orders still unwritten at shutdown; kept in the state snapshot.", len(batch))
+                return
+            self._stopping.wait(delay)
+            delay = min(delay * 2, ORDER_RETRY_MAX_BACKOFF)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = []
+            taken = 1
+            while True:
+                if item is self._STOP:
+                    stopping = True
+                else:
+                    batch.append(item)
+                if stopping or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                    taken += 1
+                except queue.Empty:
+                    break
+            if batch:
+                self._write_with_retry(batch)
+            for _ in range(taken):
+                self._queue.task_done()
+        # Anything submitted after the stop marker is still written before exiting
+        leftover = []
+        while True:
+            try:
+                leftover.append(self._queue.get_nowait())
+                self._queue.task_done()
+            except queue.Empty:
+                break
+        leftover = [o for o in leftover if o is not self._STOP]
+        if leftover:
+            self._write_with_retry(leftover)
+
+order_writer = OrderWriter(write_order_batch)
+read_model.add_source("order_writer", order_writer.report)
+
+# --- ORDER IDS ---
+ORDER_ID_PREFIX = "TL-IN-"
+ORDER_ID_START = 1000
+ORDER_ID_BLOCK = int(os.getenv("ORDER_ID_BLOCK", 100))
+
+class OrderIdAllocator:
+    # Numbers come from a reserved block whose end is made durable before any number in it is
+    # used, so allocating is an in-memory increment and a crash can only leave a gap, never a
+    # repeat. Each block is an INCRBY on one backend counter: a file fsynced by LocalBackend,
+    # or a shared key that gives every worker its own disjoint ranges. Reservations run on a
+    # reserver thread; the bot loop awaits ready() before allocate() and never blocks on one.
+    def __init__(self, backend, block_size=ORDER_ID_BLOCK):
+        self.backend = backend
+        self.block_size = block_size
+        self._next = self._limit = 0
+        self._floor = ORDER_ID_START
+        # Future of the next block, reserved in the background once three quarters of this one are used
+        self._pending = None
+        self._reserver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="order-ids")
+        self.metrics = {"allocated": 0, "blocks_reserved": 0, "late_reservations": 0}
+
+    def observe(self, number):
+        # Never hand out a number at or below one already in use
+        self._floor = max(self._floor, number + 1)
+
+    def has_state(self):
+        return self.backend.get(state_key("order_counter")) is not None
+
+    def _reserve(self):
+        key = state_key("order_counter")
+        while True:
+            end = self.backend.incr(key, self.block_size)
+            if end >= self._floor:
+                self.metrics["blocks_reserved"] += 1
+                return max(end - self.block_size + 1, self._floor), end + 1
+            # The counter is behind numbers already used here: move it up to them, never back
+            self.backend.incr(key, self._floor - 1 - end)
+
+    def _request_block(self):
+        if self._pending is None:
+            self._pending = self._reserver.submit(self._reserve)
+        return self._pending
+
+    def _install(self, future, block):
+        # Several coroutines can be waiting on one reservation; only the first may use it
+        if self._pending is not future:
+            return
+        self._pending = None
+        if block[1] > self._floor and self._next >= self._limit:
+            self._next, self._limit = max(block[0], self._floor), block[1]
+
+    async def ready(self):
+        # Resolves once allocate() has a number to hand out without touching the backend
+        while self._next >= self._limit:
+            late = self._pending is None
+            if late:
+                self.metrics["late_reservations"] += 1
+            future = self._request_block()
+            try:
+                block = await asyncio.wrap_future(future)
+            except Exception as e:
+                if self._pending is future:
+                    self._pending = None
+                if late:
+                    raise
+                # A failed background reservation gets one more try, now that it is needed
+                logger.error("Error reserving order ID block: %s", e)
+                continue
+            self._install(future, block)
+
+    def allocate(self):
+        while self._next >= self._limit:
+            # Callers that skipped ready() (restores, scripts) wait here instead
+            if self._pending is None:
+                self.metrics["late_reservations"] += 1
+            future = self._request_block()
+            try:
+                block = future.result()
+            except Exception:
+                if self._pending is future:
+                    self._pending = None
+                raise
+            self._install(future, block)
+        number = self._next
+        self._next += 1
+        self.metrics["allocated"] += 1
+        if self._limit - self._next == self.block_size // 4:
+            self._request_block()
+        return number
+
+    def report(self):
+        return {"block_size": self.block_size, "remaining_in_block": self._limit - self._next, **self.metrics}
+
+order_ids = OrderIdAllocator(state_backend)
+read_model.add_source("order_ids", order_ids.report)
+
+def observe_exported_order_ids():
+    # Installs that predate the allocator may have JSON exports numbered above anything else we know of
+    if not os.path.isdir(ORDERS_DIR):
+        return
+    for name in os.listdir(ORDERS_DIR):
+        match = re.fullmatch(rf"order_{re.escape(ORDER_ID_PREFIX)}(\d+)\.json", name)
+        if match:
+            order_ids.observe(int(match.group(1)))
+
+# --- STATE JOURNAL & SNAPSHOTS ---
+SNAPSHOT_EVERY = int(os.getenv("SNAPSHOT_EVERY", 10000))
+# Records are written and flushed (and fsynced with JOURNAL_FSYNC) by a journal thread, one batch at a time
+JOURNAL_FSYNC = os.getenv("JOURNAL_FSYNC", "false").lower() == "true"
+# How long finalize_order waits for the order record to be written before telling the user it could not confirm
+JOURNAL_WAIT_TIMEOUT = float(os.getenv("JOURNAL_WAIT_TIMEOUT", 10))
+
+def order_number(order_id):
+    return int(order_id.rsplit("-", 1)[1])
+
+def apply_journal_record(record, recovered_orders):
+    op = record["op"]
+    if op == "cart_set":
+        # Older journals carry the whole item dict under "item"
+        user_carts.setdefault(record["user_id"], Cart()).apply(CartLine.from_json(record.get("line") or record["item"]))
+    elif op == "cart_clear":
+        user_carts[record["user_id"]] = Cart()
+    elif op == "order":
+        order = record["order"]
+        recovered_orders.append(order)
+        order_ids.observe(order_number(order["order_id"]))
+
+class StateJournal:
+    # Mutations are appended to journal-<seq>.jsonl segments; a snapshot taken at seq N
+    # starts a new segment and lets every older segment be deleted once it is on disk.
+    # append() only numbers and encodes the record on the bot loop; the journal thread writes
+    # whatever has queued up with one flush (and fsync) per batch. Callers that must not
+    # acknowledge before the record is written (orders) wait for it with wait_written().
+    _STOP = object()
+
+    def __init__(self, data_dir=DATA_DIR, snapshot_every=SNAPSHOT_EVERY, fsync=JOURNAL_FSYNC):
+        self.data_dir = data_dir
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.snapshot_path = os.path.join(data_dir, "snapshot.json")
+        self.seq = 0
+        self._since_snapshot = 0
+        self._file = None
+        self._snapshot_thread = None
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._written_seq = 0
+        # (first, last) seq of recent batches whose write failed; their waiters get False
+        self._failed = deque(maxlen=64)
+        self._written = Condition()
+
+    def _segment_path(self, start_seq):
+        return os.path.join(self.data_dir, f"journal-{start_seq:012d}.jsonl")
+
+    def _segments(self):
+        if not os.path.isdir(self.data_dir):
+            return []
+        names = sorted(n for n in os.listdir(self.data_dir) if n.startswith("journal-") and n.endswith(".jsonl"))
+        return [os.path.join(self.data_dir, n) for n in names]
+
+    def _open_segment(self, start_seq):
+        if self._file:
+            self._file.close()
+        self._file = open(self._segment_path(start_seq), "a", encoding="utf-8")
+
+    def _rotate(self):
+        # Queued behind the records already appended, so they still land in the old segment
+        if self._thread:
+            self._queue.put(("rotate", self.seq + 1))
+        else:
+            self._open_segment(self.seq + 1)
+
+    def append(self, op, **fields):
+        if self._file is None:
+            return
+        self.seq += 1
+        record = {"seq": self.seq, "op": op, **fields}
+        self._queue.put(("record", self.seq, json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n"))
+        self._since_snapshot += 1
+        if self._since_snapshot >= self.snapshot_every:
+            self.snapshot()
+        return self.seq
+
+    def _write_failed(self, seq):
+        return any(first <= seq <= last for first, last in self._failed)
+
+    def wait_written(self, seq, timeout=None):
+        # Blocking; call it off the bot loop. False if the record could not be written or the
+        # timeout ran out first.
+        with self._written:
+            done = self._written.wait_for(
+                lambda: self._written_seq >= seq or self._write_failed(seq) or self._thread is None, timeout)
+            return bool(done) and not self._write_failed(seq)
+
+    def _start(self):
+        self._thread = Thread(target=self._run, name="state-journal", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            written_seq = None
+            try:
+                for item in items:
+                    if item is self._STOP:
+                        stopping = True
+                    elif item[0] == "rotate":
+                        self._file.flush()
+                        self._open_segment(item[1])
+                    else:
+                        self._file.write(item[2])
+                        written_seq = item[1]
+                self._file.flush()
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+            except OSError as e:
+                # None of the batch can be counted as written, including records that reached the
+                # file before the error: they were never flushed (or fsynced) as a whole
+                seqs = [item[1] for item in items if item is not self._STOP and item[0] == "record"]
+                logger.error("❌ Error writing state journal records %s: %s", seqs and f"{seqs[0]}-{seqs[-1]}", e)
+                if seqs:
+                    with self._written:
+                        self._failed.append((seqs[0], seqs[-1]))
+                        self._written.notify_all()
+                continue
+            if written_seq is not None:
+                with self._written:
+                    self._written_seq = written_seq
+                    self._written.notify_all()
+
+    def _capture_state(self):
+        return {
+            "seq": self.seq,
+            "carts": {str(uid): cart.to_json() for uid, cart in user_carts.items() if cart},
+            # Orders live in the order store; only those not yet flushed there need to be kept
+            "pending_orders": order_writer.inflight(),
+        }
+
+    def _write_snapshot(self, state):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, separators=(",", ":"), ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        current = self._segment_path(state["seq"] + 1)
+        for path in self._segments():
+            if path < current:
+                os.remove(path)
+
+    def _write_snapshot_logged(self, state):
+        try:
+            started = time.monotonic()
+            self._write_snapshot(state)
+            logger.info("📸 Snapshot at seq %s written in %.2fs.", state["seq"], time.monotonic() - started)
+        except Exception as e:
+            logger.error("Error writing state snapshot: %s", e)
+
+    def snapshot(self, background=True):
+        if self._snapshot_thread and self._snapshot_thread.is_alive():
+            if background:
+                return
+            self._snapshot_thread.join()
+        # Capture on the caller's thread so the copy is consistent; serialize elsewhere.
+        state = self._capture_state()
+        self._since_snapshot = 0
+        self._rotate()
+        if background:
+            self._snapshot_thread = Thread(target=self._write_snapshot_logged, args=(state,), name="state-snapshot", daemon=True)
+            self._snapshot_thread.start()
+        else:
+            self._write_snapshot_logged(state)
+
+    def restore(self):
+        started = time.monotonic()
+        os.makedirs(self.data_dir, exist_ok=True)
+        recovered_orders = []
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                state = json.load(f)
+            self.seq = state["seq"]
+            if "order_counter" in state:
+                order_ids.observe(state["order_counter"] - 1)
+            for uid, cart in state["carts"].items():
+                user_carts[int(uid)] = Cart.from_json(cart)
+            recovered_orders.extend(state.get("pending_orders", []))
+            for orders in state.get("orders", {}).values():
+                recovered_orders.extend(orders)
+
+        replayed = 0
+        for path in self._segments():
+            with open(path, "rb") as f:
+                for raw in f:
+                    try:
+                        record = json.loads(raw)
+                    except ValueError:
+                        # A torn final write from a crash; everything before it is intact
+                        logger.warning("⚠️ Ignoring truncated journal record in %s", path)
+                        break
+                    if record["seq"] <= self.seq:
+                        continue
+                    apply_journal_record(record, recovered_orders)
+                    self.seq = record["seq"]
+                    replayed += 1
+
+        # Orders acknowledged before a crash but never flushed to the store
+        known = order_store.existing_ids([o["order_id"] for o in recovered_orders])
+        missing = [o for o in recovered_orders if o["order_id"] not in known]
+        if missing:
+            write_order_batch(missing)
+            logger.info("♻️ Recovered %s unflushed orders from the journal.", len(missing))
+        order_ids.observe(order_store.max_order_number() or 0)
+        if not order_ids.has_state():
+            observe_exported_order_ids()
+        live_stats.rebuild()
+        self._since_snapshot = replayed
+        self._open_segment(self.seq + 1)
+        self._start()
+        logger.info("♻️ Restored state at seq %s (%s journal records replayed) in %.2fs.", self.seq, replayed, time.monotonic() - started)
+        if replayed >= self.snapshot_every:
+            self.snapshot()
+
+    def close(self):
+        if self._file is None:
+            return
+        self.snapshot(background=False)
+        if self._thread:
+            self._queue.put(self._STOP)
+            self._thread.join()
+            with self._written:
+                self._thread = None
+                self._written.notify_all()
+        self._file.close()
+        self._file = None
+
+state_journal = StateJournal()
+
+# --- ORDER STORE (SQLITE) ---
+ORDER_DB_PATH = os.getenv("ORDER_DB_PATH", os.path.join(DATA_DIR, "orders.db"))
+# Attempts per batch when writing the shared order index, and how many unindexed orders to carry over
+SHARED_INDEX_RETRIES = int(os.getenv("SHARED_INDEX_RETRIES", 3))
+SHARED_INDEX_BACKOFF = float(os.getenv("SHARED_INDEX_BACKOFF", 0.2))
+SHARED_INDEX_BACKLOG = int(os.getenv("SHARED_INDEX_BACKLOG", 10000))
+# Shared by the bot thread, the order writer and waitress's worker threads
+ORDER_DB_POOL_SIZE = int(os.getenv("ORDER_DB_POOL_SIZE", 12))
+
+ORDER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    seq INTEGER PRIMARY KEY,
+    order_id TEXT NOT NULL UNIQUE,
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    status TEXT NOT NULL,
+    phone TEXT,
+    total REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id, seq);
+CREATE INDEX IF NOT EXISTS idx_orders_date ON orders (date);
+CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, date);
+CREATE INDEX IF NOT EXISTS idx_orders_phone ON orders (phone);
+"""
+
+# Statements are kept as constants so each pooled connection's statement cache reuses them
+SQL_INSERT_ORDER = "INSERT OR IGNORE INTO orders (seq, order_id, user_id, date, status, phone, total, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+SQL_USER_ORDERS = "SELECT data FROM orders WHERE user_id = ? ORDER BY seq DESC LIMIT ? OFFSET ?"
+SQL_COUNT_USER_ORDERS = "SELECT COUNT(*) FROM orders WHERE user_id = ?"
+SQL_ORDER_BY_ID = "SELECT data FROM orders WHERE order_id = ?"
+SQL_COUNT_ORDERS = "SELECT COUNT(*) FROM orders"
+SQL_MAX_SEQ = "SELECT MAX(seq) FROM orders"
+SQL_USER_PROMO_USES = "SELECT json_extract(data, '$.promo_code'), COUNT(*) FROM orders WHERE user_id = ? GROUP BY 1"
+SQL_ORDER_TOTALS = "SELECT COUNT(*), COALESCE(SUM(total), 0), COUNT(CASE WHEN date >= ? THEN 1 END), COALESCE(SUM(CASE WHEN date >= ? THEN total END), 0) FROM orders"
+
+class OrderStore:
+    def __init__(self, path=ORDER_DB_PATH, pool_size=ORDER_DB_POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._lock = Lock()
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, cached_statements=64)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(ORDER_SCHEMA)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.pool_size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def insert_many(self, orders):
+        rows = [(
+            order_number(o["order_id"]), o["order_id"], o["user_id"], o["date"], o["status"],
+            o.get("phone"), o.get("total", 0), json.dumps(o, ensure_ascii=False)
+        ) for o in orders]
+        with self.connection() as conn:
+            with conn:
+                conn.executemany(SQL_INSERT_ORDER, rows)
+
+    def recent_for_user(self, user_id, limit=5, offset=0):
+        # Newest first
+        with self.connection() as conn:
+            rows = conn.execute(SQL_USER_ORDERS, (user_id, limit, offset)).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def count_for_user(self, user_id):
+        with self.connection() as conn:
+            return conn.execute(SQL_COUNT_USER_ORDERS, (user_id,)).fetchone()[0]
+
+    def promo_uses(self, user_id, codes=None):
+        with self.connection() as conn:
+            rows = conn.execute(SQL_USER_PROMO_USES, (user_id,)).fetchall()
+        return {code: count for code, count in rows if code and (codes is None or code in codes)}
+
+    def get(self, order_id):
+        with self.connection() as conn:
+            row = conn.execute(SQL_ORDER_BY_ID, (order_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def existing_ids(self, order_ids, chunk_size=500):
+        found = set()
+        with self.connection() as conn:
+            for i in range(0, len(order_ids), chunk_size):
+                chunk = order_ids[i:i + chunk_size]
+                placeholders = ",".join("?" * len(chunk))
+                found.update(row[0] for row in conn.execute(f"SELECT order_id FROM orders WHERE order_id IN ({placeholders})", chunk))
+        return found
+
+    def count(self):
+        with self.connection() as conn:
+            return conn.execute(SQL_COUNT_ORDERS).fetchone()[0]
+
+    def totals(self, since):
+        with self.connection() as conn:
+            orders, revenue, orders_since, revenue_since = conn.execute(SQL_ORDER_TOTALS, (since, since)).fetchone()
+        return {"orders": orders, "revenue": revenue, "orders_since": orders_since, "revenue_since": revenue_since}
+
+    def max_order_number(self):
+        with self.connection() as conn:
+            return conn.execute(SQL_MAX_SEQ).fetchone()[0]
+
+    def unindexed(self, user_id):
+        # As the order index it is written in the same transaction as the orders themselves
+        return []
+
+    def query_orders(self, cursor=None, limit=100, descending=True, status=None, user_id=None, phone=None, date_from=None, date_to=None):
+        # Keyset pagination on seq: the cursor is the seq of the last order already returned
+        clauses, params = [], []
+        if cursor is not None:
+            clauses.append("seq < ?" if descending else "seq > ?")
+            params.append(cursor)
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if user_id is not None:
+            clauses.append("user_id = ?")
+            params.append(user_id)
+        if phone:
+            clauses.append("phone = ?")
+            params.append(phone)
+        if date_from:
+            clauses.append("date >= ?")
+            params.append(date_from)
+        if date_to:
+            clauses.append("date < ?")
+            params.append(date_to)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        sql = f"SELECT data FROM orders {where} ORDER BY seq {'DESC' if descending else 'ASC'} LIMIT ?"
+        params.append(limit)
+        with self.connection() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+order_store = OrderStore()
+
+class SharedOrderIndex:
+    # The part of OrderStore the bot handlers use, kept in the shared backend so any worker
+    # can show a user's history; the dashboard still reads this worker's SQLite store.
+    # Every write is idempotent (SET, ZADD, SADD), so a batch can be retried whole after a failure.
+    def __init__(self, backend, retries=SHARED_INDEX_RETRIES, backlog_limit=SHARED_INDEX_BACKLOG):
+        self.backend = backend
+        self.retries = retries
+        self.backlog_limit = backlog_limit
+        # Orders already in SQLite that the index has not taken yet; retried with the next batch
+        self._backlog = []
+        self._lock = Lock()
+
+    def insert_many(self, orders):
+        self.backend.set_many({state_key("order", o["order_id"]): o for o in orders})
+        by_user = {}
+        for o in orders:
+            by_user.setdefault(o["user_id"], {})[o["order_id"]] = order_number(o["order_id"])
+        for user_id, scores in by_user.items():
+            self.backend.zadd(state_key("user_orders", user_id), scores)
+        for o in orders:
+            if o.get("promo_code") not in (None, "None"):
+                self.backend.sadd(state_key("promo_orders", o["user_id"], o["promo_code"]), o["order_id"])
+
+    def insert_best_effort(self, orders):
+        # Runs on the order writer thread, so the backoff between attempts never reaches the bot loop
+        with self._lock:
+            batch = self._backlog + list(orders)
+        for attempt in range(self.retries):
+            try:
+                self.insert_many(batch)
+                with self._lock:
+                    self._backlog = []
+                return True
+            except (OSError, StateBackendError) as e:
+                error = e
+                time.sleep(SHARED_INDEX_BACKOFF * 2 ** attempt)
+        if len(batch) > self.backlog_limit:
+            logger.error("❌ Shared order index backlog over %s; %s oldest orders will only be in SQLite.", self.backlog_limit, len(batch) - self.backlog_limit)
+            batch = batch[-self.backlog_limit:]
+        with self._lock:
+            self._backlog = batch
+        logger.error("❌ Could not index %s orders in the shared backend, retrying with the next batch: %s", len(batch), error)
+        return False
+
+    def existing_ids(self, order_ids):
+        found = self.backend.mget([state_key("order", order_id) for order_id in order_ids])
+        return {order_id for order_id, order in zip(order_ids, found) if order is not None}
 
-@app.route('/orders')
-def orders_dashboard():
-    return jsonify({
-        "total_orders": sum(len(v) for v in user_orders.values()),
-        "orders": user_orders,
-        "active_carts": {str(k): v for k, v in user_carts.items() if v}
-    })
+    def unindexed(self, user_id):
+        with self._lock:
+            return [o for o in self._backlog if o["user_id"] == user_id]
 
-# --- USER SESSION & CART MANAGEMENT ---
-def get_user_session(user_id):
-    if user_id not in user_sessions:
-        user_sessions[user_id] = {
-            "first_interaction": datetime.now(),
-            "message_count": 0,
-            "current_context": None,
-            "checkout_data": {},
-            "customization_data": {}
-        }
-    return user_sessions[user_id]
+    def get(self, order_id):
+        return self.backend.get(state_key("order", order_id))
 
-def get_user_cart(user_id):
-    if user_id not in user_carts:
-        user_carts[user_id] = {}
-    return user_carts[user_id]
+    def count_for_user(self, user_id):
+        return self.backend.zcard(state_key("user_orders", user_id))
 
-def add_to_cart(user_id, category, product_id, customizations=None):
-    cart = get_user_cart(user_id)
-    custom_key_part = ""
-    if customizations:
-        sorted_customs = sorted(customizations.items())
-        custom_key_part = "_" + "_".join([f"{k}-{v}" for k, v in sorted_customs])
-    
-    item_key = f"{category}_{product_id}{custom_key_part}"
-    
-    if item_key in cart:
-        cart[item_key]["quantity"] += 1
-    else:
-        product = PRODUCT_CATALOG[category]["products"][product_id]
-        cart[item_key] = {
-            "name": product["name"],
-            "price": product["price"],
-            "quantity": 1,
-            "category": category,
-            "product_id": product_id,
-            "customizations": customizations or {}
-        }
-    return cart[item_key]
+    def promo_uses(self, user_id, codes):
+        codes = list(codes)
+        counts = self.backend.scard_many([state_key("promo_orders", user_id, code) for code in codes])
+        return {code: count for code, count in zip(codes, counts) if count}
 
-def calculate_cart_total(user_id):
-    cart = get_user_cart(user_id)
-    total = sum(item["price"] * item["quantity"] for item in cart.values())
-    return round(total, 2)
+    def recent_for_user(self, user_id, limit=5, offset=0):
+        # Newest first
+        order_ids = self.backend.zrevrange(state_key("user_orders", user_id), offset, offset + limit - 1)
+        orders = self.backend.mget([state_key("order", order_id) for order_id in order_ids])
+        return [o for o in orders if o is not None]
 
-def clear_user_cart(user_id):
-    if user_id in user_carts:
-        user_carts[user_id] = {}
+# What the handlers read a user's orders from. A local install's SQLite store already is that
+# index; a copy in LocalBackend would only add a file per order.
+order_index = SharedOrderIndex(state_backend) if state_backend.shared else order_store
 
-def save_order(user_id, order_data):
-    global order_counter
-    order_id = f"TL-IN-{order_counter}"
-    order_counter += 1
-    
-    order = {
-        "order_id": order_id,
-        "user_id": user_id,
-        "date": datetime.now().isoformat(),
-        "status": "Confirmed",
-        **order_data
-    }
-    
-    if user_id not in user_orders:
-        user_orders[user_id] = []
-    user_orders[user_id].append(order)
-    
-    try:
-        os.makedirs("orders", exist_ok=True)
-        with open(f"orders/order_{order_id}.json", "w") as f:
-            json.dump(order, f, indent=4)
-        
-        with open("all_orders_in.txt", "a") as f:
-            f.write(f"\n--- ORDER {order_id} ---\n")
-            f.write(f"Date: {order['date']}\n")
-            f.write(f"Customer: {order_data.get('full_name', 'N/A')}\n")
-            f.write(f"Phone: {order_data.get('phone', 'N/A')}\n")
-            f.write(f"Total: ₹{order_data.get('total', 0):.2f}\n")
-            f.write(f"Payment: {order_data.get('payment_method', 'N/A')}\n")
-            f.write("Items:\n")
-            for item in order_data.get('items', []):
-                f.write(f"  - {item['name']} x{item['quantity']} (₹{item['price']:.2f})\n")
-                if item.get('customizations'):
-                    custom_str = ", ".join([f"{k.title()}: {v}" for k,v in item['customizations'].items()])
-                    f.write(f"    Customizations: {custom_str}\n")
-            f.write("-" * 30 + "\n")
-    except Exception as e:
-        logger.error(f"Error saving order file: {e}")
-    
-    return order_id
+def unstored_orders(source, orders):
+    # One batched lookup for all of them; an order can be written between inflight() and here
+    if not orders:
+        return []
+    stored = source.existing_ids([o["order_id"] for o in orders])
+    return [o for o in orders if o["order_id"] not in stored]
+
+def get_user_orders_page(user_id, page, page_size):
+    # Blocking; handlers call it through asyncio.to_thread.
+    # Orders still queued in the writer are the newest, so they lead the first pages
+    stored_total = order_index.count_for_user(user_id)
+    # Orders the index has not taken yet (a backend outage) are pending whatever it holds of them
+    pending = unstored_orders(order_index, order_writer.inflight(user_id)) + order_index.unindexed(user_id)
+    pending.sort(key=lambda o: order_number(o["order_id"]), reverse=True)
+    total = stored_total + len(pending)
+    page = page_bounds(total, page, page_size)[0]
+    start, end = page * page_size, (page + 1) * page_size
+    orders = pending[start:end]
+    if len(orders) < page_size:
+        offset = max(start - len(pending), 0)
+        pending_ids = {o["order_id"] for o in pending}
+        orders += [o for o in order_index.recent_for_user(user_id, page_size - len(orders), offset) if o["order_id"] not in pending_ids]
+    # Each page reads oldest to newest, like the original five-order summary
+    orders.reverse()
+    return orders, total
+
+def get_user_promo_uses(user_id):
+    # Blocking, like get_user_orders_page. Only capped offers need counting; orders still in
+    # the writer queue, or not yet taken by the index, count too
+    codes = catalog.offers.capped_codes
+    if not codes:
+        return {}
+    uses = order_index.promo_uses(user_id, codes)
+    pending = unstored_orders(order_index, order_writer.inflight(user_id)) + order_index.unindexed(user_id)
+    for o in pending:
+        code = o.get("promo_code")
+        if code in codes:
+            uses[code] = uses.get(code, 0) + 1
+    return uses
 
 # --- UI & KEYBOARDS ---
+KEYBOARD_PAGE_SIZE = int(os.getenv("KEYBOARD_PAGE_SIZE", 8))
+ORDERS_PER_PAGE = 5
+
+def page_bounds(total, page, page_size=KEYBOARD_PAGE_SIZE):
+    total_pages = max(1, -(-total // page_size))
+    page = min(max(page, 0), total_pages - 1)
+    return page, total_pages, page * page_size, (page + 1) * page_size
+
+def page_nav_row(route, page, total_pages, *route_values):
+    # The page number always comes last in the route's parameters
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ Previous", callback_data=encode_callback(route, *route_values, page - 1)))
+    if page < total_pages - 1:
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=encode_callback(route, *route_values, page + 1)))
+    return nav
+
+def remember_page(user_id, screen, page):
+    get_user_session(user_id).setdefault('pages', {})[screen] = page
+
+def recall_page(user_id, screen):
+    return get_user_session(user_id).get('pages', {}).get(screen, 0)
+
+# Screens are cached per catalog version; anything built for an older catalog is dropped
+# on the first lookup after a reload.
+class RenderCache:
+    def __init__(self):
+        self._version = None
+        self._screens = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        if self._version != catalog.version:
+            self._screens = {}
+            self._version = catalog.version
+        screen = self._screens.get(key)
+        if screen is None:
+            self.misses += 1
+            screen = self._screens[key] = build()
+        else:
+            self.hits += 1
+        return screen
+
+    def report(self):
+        return {"catalog_version": self._version, "screens": len(self._screens), "hits": self.hits, "misses": self.misses}
+
+render_cache = RenderCache()
+read_model.add_source("render_cache", render_cache.report)
+
+def render_browse_screen():
+    def build():
+        keyboard = [
+            [InlineKeyboardButton(cat_data["name"], callback_data=encode_callback("category", cat_id))]
+            for cat_id, cat_data in catalog.categories.items()
+        ]
+        keyboard.append([InlineKeyboardButton("🔙 Back to Main Menu", callback_data=encode_callback("back_to_menu"))])
+        catalog_text = "🛒 **Product Catalog**\n\nChoose a category to browse our premium customizable products:"
+        return catalog_text, InlineKeyboardMarkup(keyboard)
+    return render_cache.get(("browse",), build)
+
+def render_category_screen(category_id, page=0):
+    category_data = catalog.categories[category_id]
+    page, total_pages, start, end = page_bounds(len(category_data["products"]), page)
+    def build():
+        keyboard = [
+            [InlineKeyboardButton(prod["button_label"], callback_data=encode_callback("product", category_id, prod["product_id"]))]
+            for prod in category_data["products"][start:end]
+        ]
+        nav = page_nav_row("category_page", page, total_pages, category_id)
+        if nav:
+            keyboard.append(nav)
+        keyboard.append([InlineKeyboardButton("🔙 Back to Categories", callback_data=encode_callback("browse_products"))])
+        category_text = f"🛒 **{category_data['name']}**\n\nSelect a product to view details and customize:"
+        if total_pages > 1:
+            category_text += f"\n\n*Page {page + 1} of {total_pages}*"
+        return category_text, InlineKeyboardMarkup(keyboard)
+    return page, render_cache.get(("category", category_id, page), build)
+
+def render_product_screen(category_id, product_id):
+    def build():
+        product = catalog.product(category_id, product_id)
+        keyboard = []
+        if product.get('customizable'):
+            keyboard.append([InlineKeyboardButton("🎨 Customize & Add to Cart", callback_data=encode_callback("customize", category_id, product_id))])
+        else:
+            keyboard.append([InlineKeyboardButton("🛒 Add to Cart", callback_data=encode_callback("add_cart", category_id, product_id))])
+
+        keyboard.extend([
+            [InlineKeyboardButton("🔙 Back to Category", callback_data=encode_callback("category", category_id))],
+            [InlineKeyboardButton("🛍️ View Cart", callback_data=encode_callback("view_cart"))]
+        ])
+        return product["detail_text"], InlineKeyboardMarkup(keyboard)
+    return render_cache.get(("product", category_id, product_id), build)
+
+def render_option_keyboard(option_type, category_id, product_id, page=0):
+    options = catalog.options[option_type]
+    page, total_pages, start, end = page_bounds(len(options), page)
+    def build():
+        keyboard = [
+            [InlineKeyboardButton(opt, callback_data=encode_callback("select", option_type, opt))] for opt in options[start:end]
+        ]
+        nav = page_nav_row("option_page", page, total_pages)
+        if nav:
+            keyboard.append(nav)
+        keyboard.append([InlineKeyboardButton("🔙 Back to Product", callback_data=encode_callback("product", category_id, product_id))])
+        return InlineKeyboardMarkup(keyboard)
+    return render_cache.get(("options", option_type, category_id, product_id, page), build)
+
 def get_main_menu_keyboard():
     keyboard = [
         [KeyboardButton("🛒 Browse Products"), KeyboardButton("🛍️ View Cart")],
@@ -291,11 +3083,276 @@ def get_main_menu_keyboard():
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+# --- OUTBOUND SEND SCHEDULER ---
+# Every Bot API call that posts into a chat goes through one queue: token buckets keep us under
+# Telegram's global and per-chat limits, checkout messages go ahead of browse screens, an edit still
+# waiting to go out is replaced by a newer edit of the same message, and flood control or network
+# errors are retried with jittered backoff instead of surfacing as "unexpected error" replies.
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 30))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", 3))
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", 20 / 60))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", 4))
+SEND_BACKOFF_BASE = float(os.getenv("SEND_BACKOFF_BASE", 0.5))
+SEND_MAX_BUCKETS = 10000
+
+PRIORITY_CHECKOUT, PRIORITY_DEFAULT, PRIORITY_BROWSE = 0, 1, 2
+PRIORITY_NAMES = {PRIORITY_CHECKOUT: "checkout", PRIORITY_DEFAULT: "default", PRIORITY_BROWSE: "browse"}
+current_send_priority = contextvars.ContextVar("current_send_priority", default=PRIORITY_DEFAULT)
+
+def send_priority(level):
+    # Handler decorator: messages sent while the handler runs are queued at this priority
+    def decorate(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            token = current_send_priority.set(level)
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                current_send_priority.reset(token)
+        return wrapper
+    return decorate
+
+def is_throttled_endpoint(endpoint):
+    return endpoint.startswith(("send", "edit", "copy", "forward")) and endpoint != "sendChatAction"
+
+def is_idempotent_endpoint(endpoint):
+    # Safe to repeat after a timeout, when we cannot tell whether Telegram acted on the first try
+    return endpoint.startswith(("edit", "answer", "delete", "get", "set"))
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp", "paused_until")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait_time(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class SendJob:
+    __slots__ = ("priority", "chat_id", "endpoint", "callback", "args", "kwargs", "coalesce_key", "future", "queued_at")
+
+    def __init__(self, priority, chat_id, endpoint, callback, args, kwargs, coalesce_key):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.endpoint = endpoint
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.coalesce_key = coalesce_key
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+
+class SendScheduler(BaseRateLimiter):
+    # Each chat's messages leave in the order they were queued, one request in flight per chat;
+    # priority decides which chat is served next when the global bucket is the bottleneck.
+    def __init__(self):
+        self._task = None
+        self._wake = None
+        self._reset()
+        self.metrics = {"sent": 0, "failed": 0, "retries": 0, "retry_after": 0, "coalesced": 0,
+                        "queue_ms_total": 0.0, "queue_ms_max": 0.0,
+                        "by_priority": {name: 0 for name in PRIORITY_NAMES.values()}}
+
+    def _reset(self):
+        self._chats = {}     # chat_id -> deque of jobs not yet sent, oldest first
+        self._busy = set()   # chats with a request in flight
+        self._ready = []     # heap of (priority, seq, chat_id)
+        self._delayed = []   # heap of (ready_at, seq, chat_id) for chats out of tokens
+        self._edits = {}     # (chat_id, message_id) -> queued edit that a newer edit may replace
+        self._buckets = {}
+        self._global = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self._seq = 0
+        self._sending = set()
+
+    async def initialize(self):
+        # Called by both the bot and the application
+        if self._task is not None:
+            return
+        self._reset()
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, *self._sending, return_exceptions=True)
+        self._task = None
+        for jobs in self._chats.values():
+            for job in jobs:
+                job.future.cancel()
+        self._reset()
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) >= SEND_MAX_BUCKETS:
+                # Forget chats whose bucket has refilled; a fresh bucket starts full anyway
+                now = time.monotonic()
+                self._buckets = {c: b for c, b in self._buckets.items() if b.wait_time(now) > 0 or b.tokens < b.capacity}
+            group = isinstance(chat_id, int) and chat_id < 0
+            rate = SEND_GROUP_RATE if group else SEND_CHAT_RATE
+            bucket = self._buckets[chat_id] = TokenBucket(rate, SEND_CHAT_BURST)
+        return bucket
+
+    def _schedule(self, chat_id):
+        self._seq += 1
+        heapq.heappush(self._ready, (self._chats[chat_id][0].priority, self._seq, chat_id))
+        self._wake.set()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if self._task is None or chat_id is None or not is_throttled_endpoint(endpoint):
+            return await self._call(callback, args, kwargs, endpoint, chat_id)
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else current_send_priority.get()
+        coalesce_key = (chat_id, data["message_id"]) if endpoint.startswith("edit") and data.get("message_id") else None
+        jobs = self._chats.get(chat_id)
+        job = self._edits.get(coalesce_key) if coalesce_key else None
+        if job is not None and job.endpoint == endpoint and jobs and jobs[-1] is job:
+            # Still queued and nothing queued after it, so sending only the newest content changes nothing else
+            job.callback, job.args, job.kwargs = callback, args, kwargs
+            self.metrics["coalesced"] += 1
+        else:
+            job = SendJob(priority, chat_id, endpoint, callback, args, kwargs, coalesce_key)
+            if jobs is None:
+                jobs = self._chats[chat_id] = deque()
+            jobs.append(job)
+            if coalesce_key:
+                self._edits[coalesce_key] = job
+            if len(jobs) == 1 and chat_id not in self._busy:
+                self._schedule(chat_id)
+        return await asyncio.shield(job.future)
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                self._schedule(heapq.heappop(self._delayed)[2])
+            timeout = None
+            if self._ready:
+                timeout = self._global.wait_time(now)
+                if timeout <= 0:
+                    self._send_next(now)
+                    continue
+            if self._delayed:
+                until_ready = self._delayed[0][0] - now
+                timeout = until_ready if timeout is None else min(timeout, until_ready)
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _send_next(self, now):
+        chat_id = heapq.heappop(self._ready)[2]
+        bucket = self._bucket(chat_id)
+        wait = bucket.wait_time(now)
+        if wait > 0:
+            self._seq += 1
+            heapq.heappush(self._delayed, (now + wait, self._seq, chat_id))
+            return
+        jobs = self._chats[chat_id]
+        job = jobs.popleft()
+        if not jobs:
+            del self._chats[chat_id]
+        if job.coalesce_key and self._edits.get(job.coalesce_key) is job:
+            del self._edits[job.coalesce_key]
+        bucket.take()
+        self._global.take()
+        self._busy.add(chat_id)
+        waited = (now - job.queued_at) * 1000
+        self.metrics["queue_ms_total"] += waited
+        self.metrics["queue_ms_max"] = max(self.metrics["queue_ms_max"], waited)
+        self.metrics["by_priority"][PRIORITY_NAMES.get(job.priority, "default")] += 1
+        task = asyncio.create_task(self._send(job))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send(self, job):
+        try:
+            result = await self._call(job.callback, job.args, job.kwargs, job.endpoint, job.chat_id)
+            self.metrics["sent"] += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        except Exception as e:
+            self.metrics["failed"] += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            self._busy.discard(job.chat_id)
+            if job.chat_id in self._chats:
+                self._schedule(job.chat_id)
+
+    async def _call(self, callback, args, kwargs, endpoint, chat_id):
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            started = time.perf_counter()
+            result = "error"
+            try:
+                response = await callback(*args, **kwargs)
+                result = "ok"
+                return response
+            except RetryAfter as e:
+                result = "retry_after"
+                if attempt == SEND_MAX_RETRIES:
+                    raise
+                self.metrics["retry_after"] += 1
+                delay = e.retry_after + random.uniform(0, SEND_BACKOFF_BASE)
+                # Hold the whole chat (or everything, for calls outside a chat) until the ban lifts
+                (self._bucket(chat_id) if chat_id is not None else self._global).pause(delay)
+            except BadRequest:
+                result = "bad_request"
+                raise
+            except NetworkError as e:
+                result = "timed_out" if isinstance(e, TimedOut) else "network_error"
+                if attempt == SEND_MAX_RETRIES or (isinstance(e, TimedOut) and not is_idempotent_endpoint(endpoint)):
+                    raise
+                delay = random.uniform(0, SEND_BACKOFF_BASE * 2 ** attempt)
+            finally:
+                telegram_api_requests.inc(endpoint, result)
+                telegram_api_seconds.observe(time.perf_counter() - started, endpoint)
+            self.metrics["retries"] += 1
+            logger.warning("⏳ Retrying %s for chat %s in %.2fs (attempt %s).", endpoint, chat_id, delay, attempt + 2)
+            await asyncio.sleep(delay)
+
+    def report(self):
+        dispatched = sum(self.metrics["by_priority"].values())
+        return {
+            "queued": sum(len(jobs) for jobs in self._chats.values()),
+            "chats_waiting": len(self._chats),
+            "in_flight": len(self._busy),
+            "sent": self.metrics["sent"],
+            "failed": self.metrics["failed"],
+            "retries": self.metrics["retries"],
+            "retry_after": self.metrics["retry_after"],
+            "coalesced": self.metrics["coalesced"],
+            "avg_queue_ms": round(self.metrics["queue_ms_total"] / dispatched, 2) if dispatched else 0.0,
+            "max_queue_ms": round(self.metrics["queue_ms_max"], 2),
+            "by_priority": dict(self.metrics["by_priority"]),
+        }
+
+send_scheduler = SendScheduler()
+read_model.add_source("send_queue", send_scheduler.report)
+
 # --- BOT COMMAND HANDLERS ---
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     get_user_session(user.id)['current_context'] = "main_menu"
-    logger.info(f"👋 User started bot: {user.first_name} (ID: {user.id})")
+    log_event("session", "👋 User started bot: %s (ID: %s)", user.first_name, user.id, user_id=user.id)
     
     welcome_message = f"""
 🎉 **Welcome to TrustyLads®, {user.first_name}!**
@@ -316,7 +3373,7 @@ Have a promo code? Apply it during checkout for amazing discounts!
 
 👆 *Use the menu buttons below to start shopping!*
     """
-    await update.message.reply_text(
+    await update.effective_message.reply_text(
         welcome_message, 
         parse_mode='Markdown', 
         reply_markup=get_main_menu_keyboard()
@@ -334,6 +3391,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 5.  **Checkout**: Go to "🛍️ View Cart" and proceed to checkout.
 6.  **Track**: Use "📦 My Orders" to see your order history.
 
+**🔍 Search:**
+Type what you're looking for (e.g. `leather wallet`) or use `/search <keyword>`.
+
 **ℹ️ Information:**
 • **About Us**: Learn about TrustyLads®.
 • **Contact Support**: Get help from our team via Phone, WhatsApp, or Email.
@@ -346,45 +3406,50 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     await update.message.reply_text(help_text, parse_mode='Markdown')
 
+@send_priority(PRIORITY_BROWSE)
 async def browse_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton(cat_data["name"], callback_data=f"category_{cat_id}")]
-        for cat_id, cat_data in PRODUCT_CATALOG.items()
-    ]
-    keyboard.append([InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_menu")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    catalog_text = "🛒 **Product Catalog**\n\nChoose a category to browse our premium customizable products:"
+    catalog_text, reply_markup = render_browse_screen()
     
     if update.callback_query:
         await update.callback_query.edit_message_text(catalog_text, parse_mode='Markdown', reply_markup=reply_markup)
     else:
         await update.message.reply_text(catalog_text, parse_mode='Markdown', reply_markup=reply_markup)
 
-async def view_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def view_cart(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
     user_id = update.effective_user.id
     cart = get_user_cart(user_id)
     
     if not cart:
         cart_text = "🛍️ **Your Cart is Empty**\n\nStart shopping to add customized items!"
-        keyboard = [[InlineKeyboardButton("🛒 Start Shopping", callback_data="browse_products")]]
+        keyboard = [[InlineKeyboardButton("🛒 Start Shopping", callback_data=encode_callback("browse_products"))]]
     else:
+        page, total_pages, start, end = page_bounds(len(cart), page)
+        remember_page(user_id, "cart", page)
         cart_text = "🛍️ **Your Shopping Cart**\n\n"
-        total = 0
-        for item in cart.values():
-            item_total = item["price"] * item["quantity"]
-            total += item_total
-            cart_text += f"• **{item['name']}**\n"
-            if item.get('customizations'):
-                customs = ", ".join([f"{k.title()}: {v}" for k, v in item['customizations'].items()])
-                cart_text += f"  🎨 *Customizations: {customs}*\n"
-            cart_text += f"  *Quantity: {item['quantity']} × ₹{item['price']:.2f} = ₹{item_total:.2f}*\n\n"
+        if total_pages > 1:
+            cart_text = f"🛍️ **Your Shopping Cart** (page {page + 1} of {total_pages})\n\n"
+        # Line buttons carry the cart revision so a tap on an outdated cart screen is not applied
+        revision = cart.revision & 0xFFFF
+        keyboard = []
+        for index, line in enumerate(itertools.islice(cart, start, end), start):
+            cart_text += f"{index + 1}. **{line.name}**\n"
+            if line.customizations:
+                cart_text += f"  🎨 *Customizations: {format_customizations(line.customizations)}*\n"
+            cart_text += f"  *Quantity: {line.quantity} × ₹{line.price:.2f} = ₹{line.line_total:.2f}*\n\n"
+            keyboard.append([
+                InlineKeyboardButton(f"➖ {index + 1}. {line.name}", callback_data=encode_callback("cart_decrement", index, revision)),
+                InlineKeyboardButton("➕", callback_data=encode_callback("cart_increment", index, revision)),
+                InlineKeyboardButton("🗑️", callback_data=encode_callback("cart_remove", index, revision)),
+            ])
         
-        cart_text += f"💰 **Total: ₹{total:.2f}**"
-        keyboard = [
-            [InlineKeyboardButton("💳 Proceed to Checkout", callback_data="start_checkout")],
-            [InlineKeyboardButton("🛒 Continue Shopping", callback_data="browse_products")],
-            [InlineKeyboardButton("🗑️ Clear Cart", callback_data="clear_cart")]
+        cart_text += f"💰 **Total: ₹{cart.total:.2f}** ({cart.count} items)"
+        nav = page_nav_row("cart_page", page, total_pages)
+        if nav:
+            keyboard.append(nav)
+        keyboard += [
+            [InlineKeyboardButton("💳 Proceed to Checkout", callback_data=encode_callback("start_checkout"))],
+            [InlineKeyboardButton("🛒 Continue Shopping", callback_data=encode_callback("browse_products"))],
+            [InlineKeyboardButton("🗑️ Clear Cart", callback_data=encode_callback("clear_cart"))]
         ]
 
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -393,22 +3458,32 @@ async def view_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(cart_text, parse_mode='Markdown', reply_markup=reply_markup)
 
-async def my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = None):
     user_id = update.effective_user.id
-    orders = user_orders.get(user_id, [])
+    if page is None:
+        page = recall_page(user_id, "orders")
+    orders, total = await asyncio.to_thread(get_user_orders_page, user_id, page, ORDERS_PER_PAGE)
+    page, total_pages, _, _ = page_bounds(total, page, ORDERS_PER_PAGE)
+    remember_page(user_id, "orders", page)
     
     if not orders:
         orders_text = "📦 **No Orders Yet**\n\nYou haven't placed any orders. Start shopping to see your orders here!"
-        keyboard = [[InlineKeyboardButton("🛒 Start Shopping", callback_data="browse_products")]]
+        keyboard = [[InlineKeyboardButton("🛒 Start Shopping", callback_data=encode_callback("browse_products"))]]
     else:
         orders_text = "📦 **Your Recent Orders**\n\n"
-        for order in orders[-5:]:  # Show last 5 orders
+        if total_pages > 1:
+            orders_text = f"📦 **Your Orders** (page {page + 1} of {total_pages})\n\n"
+        for order in orders:
             order_date = datetime.fromisoformat(order['date']).strftime("%B %d, %Y")
             orders_text += f"🔸 **Order {order['order_id']}**\n"
             orders_text += f"   *Date*: {order_date}\n"
             orders_text += f"   *Total*: ₹{order['total']:.2f}\n"
             orders_text += f"   *Status*: {order['status']}\n\n"
-        keyboard = [[InlineKeyboardButton("🛒 Shop Again", callback_data="browse_products")]]
+        keyboard = []
+        nav = page_nav_row("orders_page", page, total_pages)
+        if nav:
+            keyboard.append(nav)
+        keyboard.append([InlineKeyboardButton("🛒 Shop Again", callback_data=encode_callback("browse_products"))])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     if update.callback_query:
@@ -416,6 +3491,7 @@ async def my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(orders_text, parse_mode='Markdown', reply_markup=reply_markup)
 
+@send_priority(PRIORITY_BROWSE)
 async def about_us(update: Update, context: ContextTypes.DEFAULT_TYPE):
     about_text = f"""
 ℹ️ **About TrustyLads® India**
@@ -436,8 +3512,8 @@ async def about_us(update: Update, context: ContextTypes.DEFAULT_TYPE):
 *We are committed to providing you with premium quality products and a seamless shopping experience.*
     """
     keyboard = [
-        [InlineKeyboardButton("📞 Contact Support", callback_data="contact_support")],
-        [InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_menu")]
+        [InlineKeyboardButton("📞 Contact Support", callback_data=encode_callback("contact_support"))],
+        [InlineKeyboardButton("🔙 Back to Main Menu", callback_data=encode_callback("back_to_menu"))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     if update.callback_query:
@@ -467,7 +3543,7 @@ Our team is here to help with order issues, product questions, or any other inqu
         [InlineKeyboardButton("📞 Call Now", url=f"tel:{clean_tel_phone}")],
         [InlineKeyboardButton("💬 WhatsApp", url=f"https://wa.me/{clean_wa_phone}")],
         [InlineKeyboardButton("📧 Send Email", url=f"mailto:{COMPANY_INFO['email']}")],
-        [InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_menu")]
+        [InlineKeyboardButton("🔙 Back to Main Menu", callback_data=encode_callback("back_to_menu"))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     if update.callback_query:
@@ -476,60 +3552,42 @@ Our team is here to help with order issues, product questions, or any other inqu
         await update.message.reply_text(support_text, parse_mode='Markdown', reply_markup=reply_markup)
 
 # --- BOT CALLBACK & MESSAGE HANDLERS ---
-async def handle_category_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, category_id: str):
+@send_priority(PRIORITY_BROWSE)
+async def handle_category_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, category_id: str, page: int = None):
     query = update.callback_query
-    if category_id not in PRODUCT_CATALOG:
+    if category_id not in catalog.categories:
         await query.edit_message_text("❌ Invalid category. Please try again.")
         return
     
-    category_data = PRODUCT_CATALOG[category_id]
-    
-    keyboard = [
-        [InlineKeyboardButton(f"{prod['name']} - ₹{prod['price']:.2f}", callback_data=f"product_{category_id}_{prod_id}")]
-        for prod_id, prod in category_data["products"].items()
-    ]
-    keyboard.append([InlineKeyboardButton("🔙 Back to Categories", callback_data="browse_products")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    category_text = f"🛒 **{category_data['name']}**\n\nSelect a product to view details and customize:"
+    # Coming back to a category reopens the page the user was last on
+    screen = f"category:{category_id}"
+    if page is None:
+        page = recall_page(query.from_user.id, screen)
+    page, (category_text, reply_markup) = render_category_screen(category_id, page)
+    remember_page(query.from_user.id, screen, page)
     await query.edit_message_text(category_text, parse_mode='Markdown', reply_markup=reply_markup)
 
+@send_priority(PRIORITY_BROWSE)
 async def handle_product_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, category_id: str, product_id: str):
     query = update.callback_query
-    if category_id not in PRODUCT_CATALOG or product_id not in PRODUCT_CATALOG[category_id]["products"]:
+    if catalog.product(category_id, product_id) is None:
         await query.edit_message_text("❌ Invalid product or category. Please try again.")
         return
     
-    product = PRODUCT_CATALOG[category_id]["products"][product_id]
-    
-    product_text = f"📦 **{product['name']}**\n\n"
-    product_text += f"💰 *Price: ₹{product['price']:.2f}*\n\n"
-    product_text += f"📝 **Description:**\n{product['description']}\n\n"
-    
-    keyboard = []
-    if product.get('customizable'):
-        product_text += "🎨 *This product can be customized.*"
-        keyboard.append([InlineKeyboardButton("🎨 Customize & Add to Cart", callback_data=f"customize_{category_id}_{product_id}")])
-    else:
-        keyboard.append([InlineKeyboardButton("🛒 Add to Cart", callback_data=f"add_cart_{category_id}_{product_id}")])
-    
-    keyboard.extend([
-        [InlineKeyboardButton("🔙 Back to Category", callback_data=f"category_{category_id}")],
-        [InlineKeyboardButton("🛍️ View Cart", callback_data="view_cart")]
-    ])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    product_text, reply_markup = render_product_screen(category_id, product_id)
     await query.edit_message_text(product_text, parse_mode='Markdown', reply_markup=reply_markup)
 
+@send_priority(PRIORITY_BROWSE)
 async def handle_product_customization(update: Update, context: ContextTypes.DEFAULT_TYPE, category_id: str, product_id: str):
     query = update.callback_query
     user_id = query.from_user.id
     
-    if category_id not in PRODUCT_CATALOG or product_id not in PRODUCT_CATALOG[category_id]["products"]:
+    product = catalog.product(category_id, product_id)
+    if product is None:
         await query.edit_message_text("❌ Invalid product or category. Please try again.")
         return
     
     session = get_user_session(user_id)
-    product = PRODUCT_CATALOG[category_id]["products"][product_id]
     customizable_options = product.get('customizable', [])
     
     session['customization_data'] = {
@@ -539,9 +3597,10 @@ async def handle_product_customization(update: Update, context: ContextTypes.DEF
         'current_option_index': 0,
         'selections': {}
     }
-    logger.info(f"Starting customization for user {user_id}: {category_id}/{product_id}")
+    log_event("customization", "Starting customization for user %s: %s/%s", user_id, category_id, product_id, user_id=user_id)
     await show_customization_option(update, context)
 
+@send_priority(PRIORITY_BROWSE)
 async def show_customization_option(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
@@ -550,7 +3609,7 @@ async def show_customization_option(update: Update, context: ContextTypes.DEFAUL
     custom_data = session.get('customization_data', {})
     if not custom_data:
         await query.edit_message_text("❌ Session expired. Please try again.", 
-                                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Start Shopping", callback_data="browse_products")]]))
+                                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Start Shopping", callback_data=encode_callback("browse_products"))]]))
         return
     
     idx = custom_data['current_option_index']
@@ -560,7 +3619,12 @@ async def show_customization_option(update: Update, context: ContextTypes.DEFAUL
         return
         
     option_type = custom_data['options'][idx]
-    product = PRODUCT_CATALOG[custom_data['category_id']]["products"][custom_data['product_id']]
+    product = catalog.product(custom_data['category_id'], custom_data['product_id'])
+    if product is None:
+        session.pop('customization_data', None)
+        await query.edit_message_text("❌ This product is no longer available.",
+                                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Start Shopping", callback_data=encode_callback("browse_products"))]]))
+        return
     
     custom_text = f"🎨 **Customize {product['name']}**\n\n"
     custom_text += f"*Step {idx + 1} of {len(custom_data['options'])}: Select {option_type.title()}*\n\n"
@@ -569,20 +3633,23 @@ async def show_customization_option(update: Update, context: ContextTypes.DEFAUL
         selections_str = ", ".join([f"{k.title()}: {v}" for k, v in custom_data['selections'].items()])
         custom_text += f"✅ *Current choice(s): {selections_str}*\n\n"
 
-    options = CUSTOMIZATION_OPTIONS.get(option_type, [])
-    if not options:
-        logger.error(f"No options found for option_type: {option_type}")
+    if not catalog.options.get(option_type):
+        logger.error("No options found for option_type: %s", option_type)
         await query.edit_message_text("❌ Error: No customization options available for this product. Please try again.")
         return
     
-    keyboard = [
-        [InlineKeyboardButton(opt, callback_data=f"select_{option_type}_{opt}")] for opt in options
-    ]
-    keyboard.append([InlineKeyboardButton("🔙 Back to Product", callback_data=f"product_{custom_data['category_id']}_{custom_data['product_id']}")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = render_option_keyboard(option_type, custom_data['category_id'], custom_data['product_id'], custom_data.get('option_page', 0))
     
     await query.edit_message_text(custom_text, parse_mode='Markdown', reply_markup=reply_markup)
 
+@send_priority(PRIORITY_BROWSE)
+async def handle_option_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int):
+    custom_data = get_user_session(update.callback_query.from_user.id).get('customization_data')
+    if custom_data:
+        custom_data['option_page'] = page
+    await show_customization_option(update, context)
+
+@send_priority(PRIORITY_BROWSE)
 async def handle_customization_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, option_type: str, selected_value: str):
     query = update.callback_query
     user_id = query.from_user.id
@@ -591,12 +3658,13 @@ async def handle_customization_selection(update: Update, context: ContextTypes.D
     custom_data = session.get('customization_data', {})
     if not custom_data:
         await query.edit_message_text("❌ Session expired. Please try again.", 
-                                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Start Shopping", callback_data="browse_products")]]))
+                                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Start Shopping", callback_data=encode_callback("browse_products"))]]))
         return
     
     custom_data['selections'][option_type] = selected_value
     custom_data['current_option_index'] += 1
-    logger.info(f"User {user_id} selected {option_type}: {selected_value}")
+    custom_data['option_page'] = 0
+    log_event("customization", "User %s selected %s: %s", user_id, option_type, selected_value, user_id=user_id)
     await show_customization_option(update, context)
 
 async def add_customized_product_to_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -612,6 +3680,9 @@ async def add_customized_product_to_cart(update: Update, context: ContextTypes.D
     category_id = custom_data['category_id']
     product_id = custom_data['product_id']
     selections = custom_data['selections']
+    if catalog.product(category_id, product_id) is None:
+        await query.edit_message_text("❌ This product is no longer available.")
+        return
     
     added_item = add_to_cart(user_id, category_id, product_id, selections)
     await show_add_to_cart_confirmation(query, added_item, user_id)
@@ -623,40 +3694,39 @@ async def handle_add_to_cart(update: Update, context: ContextTypes.DEFAULT_TYPE,
     await show_add_to_cart_confirmation(query, added_item, user_id)
 
 async def show_add_to_cart_confirmation(query, added_item, user_id):
-    cart_total = calculate_cart_total(user_id)
-    cart_count = sum(item["quantity"] for item in get_user_cart(user_id).values())
+    cart = get_user_cart(user_id)
     
     success_text = f"✅ **Added to Cart!**\n\n"
-    success_text += f"**{added_item['name']}**\n"
-    if added_item.get('customizations'):
-        customs = ", ".join([f"{k.title()}: {v}" for k, v in added_item['customizations'].items()])
-        success_text += f"  🎨 *Customizations: {customs}*\n"
+    success_text += f"**{added_item.name}**\n"
+    if added_item.customizations:
+        success_text += f"  🎨 *Customizations: {format_customizations(added_item.customizations)}*\n"
     
     success_text += f"\n🛍️ **Cart Summary:**\n"
-    success_text += f"   *Items*: {cart_count}\n"
-    success_text += f"   *Total*: ₹{cart_total:.2f}\n\n"
+    success_text += f"   *Items*: {cart.count}\n"
+    success_text += f"   *Total*: ₹{cart.total:.2f}\n\n"
     success_text += "What would you like to do next?"
     
     keyboard = [
-        [InlineKeyboardButton("🛒 Continue Shopping", callback_data=f"category_{added_item['category']}")],
-        [InlineKeyboardButton("🛍️ View Cart", callback_data="view_cart")],
-        [InlineKeyboardButton("💳 Checkout Now", callback_data="start_checkout")]
+        [InlineKeyboardButton("🛒 Continue Shopping", callback_data=encode_callback("category", added_item.category))],
+        [InlineKeyboardButton("🛍️ View Cart", callback_data=encode_callback("view_cart"))],
+        [InlineKeyboardButton("💳 Checkout Now", callback_data=encode_callback("start_checkout"))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(success_text, parse_mode='Markdown', reply_markup=reply_markup)
 
 # --- CHECKOUT PROCESS ---
+@send_priority(PRIORITY_CHECKOUT)
 async def start_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = query.from_user.id
     
     if not get_user_cart(user_id):
         await query.edit_message_text("Your cart is empty! Add items before checking out.", 
-                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Start Shopping", callback_data="browse_products")]]))
+                                      reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Start Shopping", callback_data=encode_callback("browse_products"))]]))
         return
     
     session = get_user_session(user_id)
-    session['current_context'] = "checkout_name"
+    enter_checkout_step(session, "checkout_name")
     session['checkout_data'] = {}
     
     await query.edit_message_text(
@@ -664,6 +3734,7 @@ async def start_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+@send_priority(PRIORITY_CHECKOUT)
 async def process_checkout_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     session = get_user_session(user_id)
@@ -673,7 +3744,7 @@ async def process_checkout_step(update: Update, context: ContextTypes.DEFAULT_TY
     
     if current_context == "checkout_name":
         session['checkout_data']['full_name'] = message_text
-        session['current_context'] = "checkout_phone"
+        enter_checkout_step(session, "checkout_phone")
         await update.message.reply_text(f"✅ Name: {message_text}\n\n📝 **Checkout Step 2 of 3**\n\nPlease enter your **10-digit Indian mobile number**:", parse_mode='Markdown')
     
     elif current_context == "checkout_phone":
@@ -681,12 +3752,12 @@ async def process_checkout_step(update: Update, context: ContextTypes.DEFAULT_TY
             await update.message.reply_text("❌ Invalid number. Please enter a valid 10-digit mobile number.")
             return
         session['checkout_data']['phone'] = message_text
-        session['current_context'] = "checkout_address"
+        enter_checkout_step(session, "checkout_address")
         await update.message.reply_text(f"✅ Phone: {message_text}\n\n📝 **Checkout Step 3 of 3**\n\nPlease enter your **complete delivery address, including Pincode**:", parse_mode='Markdown')
     
     elif current_context == "checkout_address":
         session['checkout_data']['address'] = message_text
-        session['current_context'] = "checkout_confirmation"
+        enter_checkout_step(session, "checkout_confirmation")
         await show_checkout_confirmation(update, context)
         
     elif current_context == "checkout_promo":
@@ -696,23 +3767,22 @@ async def process_checkout_step(update: Update, context: ContextTypes.DEFAULT_TY
         if promo_code == "SKIP":
             session['checkout_data']['final_total'] = cart_total
             await finalize_order(update, context)
-        elif promo_code in ACTIVE_OFFERS:
-            offer = ACTIVE_OFFERS[promo_code]
-            if cart_total >= offer['min_order']:
-                discount = offer.get("discount", 0)
-                discount_amount = offer.get("discount_amount", cart_total * (discount / 100))
-                
-                session['checkout_data']['promo_code'] = promo_code
+        else:
+            rule, discount_paise, reason = await check_promo_code(user_id, promo_code)
+            if reason is None:
+                discount_amount = discount_paise / 100
+                session['checkout_data']['promo_code'] = rule.code
                 session['checkout_data']['discount'] = round(discount_amount, 2)
                 session['checkout_data']['final_total'] = round(max(cart_total - discount_amount, 0), 2)
                 
-                await update.message.reply_text(f"✅ Promo code '{promo_code}' applied!", parse_mode='Markdown')
+                await update.message.reply_text(f"✅ Promo code '{rule.code}' applied!", parse_mode='Markdown')
                 await finalize_order(update, context)
+            elif reason == "unknown":
+                await update.message.reply_text("❌ Invalid promo code. Type 'SKIP' to proceed without one, or try another code.")
             else:
-                await update.message.reply_text(f"❌ Minimum order of ₹{offer['min_order']:.2f} required. Type 'SKIP' or enter a different code.")
-        else:
-            await update.message.reply_text("❌ Invalid promo code. Type 'SKIP' to proceed without one, or try another code.")
+                await update.message.reply_text(f"{PROMO_REJECTIONS[reason].format(code=rule.code, min_order=rule.min_order / 100)} Type 'SKIP' or enter a different code.")
 
+@send_priority(PRIORITY_CHECKOUT)
 async def show_checkout_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     checkout_data = get_user_session(user_id).get('checkout_data', {})
@@ -725,35 +3795,47 @@ async def show_checkout_confirmation(update: Update, context: ContextTypes.DEFAU
     confirmation_text += f"• **Address:** {checkout_data.get('address', 'N/A')}\n\n"
     
     confirmation_text += "🛍️ **Items:**\n"
-    for item in cart.values():
-        confirmation_text += f"• {item['name']} x{item['quantity']}\n"
-        if item.get('customizations'):
-            customs = ", ".join([f"{k.title()}: {v}" for k, v in item['customizations'].items()])
-            confirmation_text += f"  🎨 *({customs})*\n"
+    for line in cart:
+        confirmation_text += f"• {line.name} x{line.quantity}\n"
+        if line.customizations:
+            confirmation_text += f"  🎨 *({format_customizations(line.customizations)})*\n"
     
-    confirmation_text += f"\n💰 **Total: ₹{calculate_cart_total(user_id):.2f}**\n\n"
+    confirmation_text += f"\n💰 **Total: ₹{cart.total:.2f}**\n\n"
     
     keyboard = [
-        [InlineKeyboardButton("✅ Confirm & Select Payment", callback_data="confirm_details")],
-        [InlineKeyboardButton("✏️ Make Corrections", callback_data="make_corrections")]
+        [InlineKeyboardButton("✅ Confirm & Select Payment", callback_data=encode_callback("confirm_details"))],
+        [InlineKeyboardButton("✏️ Make Corrections", callback_data=encode_callback("make_corrections"))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await update.message.reply_text(confirmation_text, parse_mode='Markdown', reply_markup=reply_markup)
 
+PROMO_REJECTIONS = {
+    "min_order": "❌ Minimum order of ₹{min_order:.2f} required.",
+    "expired": "❌ Promo code '{code}' has expired.",
+    "not_started": "❌ Promo code '{code}' isn't active yet.",
+    "out_of_scope": "❌ Promo code '{code}' doesn't apply to the items in your cart.",
+    "used_up": "❌ You've already used promo code '{code}' the maximum number of times.",
+}
+
+@send_priority(PRIORITY_CHECKOUT)
 async def handle_payment_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, payment_method: str):
     query = update.callback_query
     user_id = query.from_user.id
     session = get_user_session(user_id)
     
     session['checkout_data']['payment_method'] = payment_method
-    session['current_context'] = "checkout_promo"
+    enter_checkout_step(session, "checkout_promo")
     
     promo_text = f"✅ Payment Method: **{payment_method}**\n\n"
     promo_text += "🎁 If you have a promo code, enter it now. Otherwise, type `SKIP` to complete your order."
+    suggestion = await best_offer(user_id, advertised_only=True)
+    if suggestion:
+        promo_text += f"\n\n💡 Tip: code `{suggestion[1].code}` saves you ₹{suggestion[0] / 100:.2f} on this order."
     
     await query.edit_message_text(promo_text, parse_mode='Markdown')
 
+@send_priority(PRIORITY_CHECKOUT)
 async def finalize_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     session = get_user_session(user_id)
@@ -761,11 +3843,11 @@ async def finalize_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cart = get_user_cart(user_id)
     
     order_items = [{
-        "name": item["name"], "price": item["price"], "quantity": item["quantity"],
-        "total": item["price"] * item["quantity"], "customizations": item.get("customizations", {})
-    } for item in cart.values()]
+        "name": line.name, "price": line.price, "quantity": line.quantity,
+        "total": line.line_total, "customizations": dict(line.customizations)
+    } for line in cart]
     
-    subtotal = calculate_cart_total(user_id)
+    subtotal = cart.total
     discount = checkout_data.get('discount', 0)
     final_total = checkout_data.get('final_total', subtotal)
     
@@ -776,10 +3858,31 @@ async def finalize_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "promo_code": checkout_data.get('promo_code', 'None')
     }
     
+    await order_ids.ready()
+    if not await order_writer.wait_for_capacity():
+        # The checkout is left as it is, so the same reply places the order once there is room
+        await update.message.reply_text("⏳ We're receiving a lot of orders right now and couldn't take yours yet. "
+                                        "Please send your last reply again in a minute.")
+        return
+    # Nothing awaits between the capacity check and submit(), so the room is still there
     order_id = save_order(user_id, order_data)
-    clear_user_cart(user_id)
+    clear_user_cart(user_id, ordered=True)
+    # The new order is on the first page of the history
+    remember_page(user_id, "orders", 0)
+    # The confirmation below is the acknowledgement, so the order must be in the journal first
+    journaled = await asyncio.get_running_loop().run_in_executor(
+        None, state_journal.wait_written, state_journal.seq, JOURNAL_WAIT_TIMEOUT)
     session['current_context'] = "main_menu"
     session['checkout_data'] = {}
+    if not journaled:
+        # The order is already handed to the order writer, so asking the user to submit again could
+        # place it twice; point them at /orders instead
+        logger.error("Order %s for user %s was not confirmed in the state journal", order_id, user_id)
+        await update.message.reply_text(
+            f"⚠️ We received order `{order_id}` but could not confirm it right now.\n\n"
+            "Please check /orders in a few minutes before ordering again.", parse_mode='Markdown')
+        return
+    checkout_funnel.inc("finalized")
 
     confirmation_text = f"✅ **Order Confirmed!**\n\n"
     confirmation_text += f"Thank you for your purchase, {order_data['full_name']}.\n\n"
@@ -801,80 +3904,325 @@ async def finalize_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     confirmation_text += "Your order will be delivered in **5-7 business days** across India. You'll receive tracking info via SMS within 48 hours.\n\n"
     confirmation_text += "Thank you for shopping with TrustyLads®! 🙏"
     
-    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("📦 My Orders", callback_data="my_orders")]])
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("📦 My Orders", callback_data=encode_callback("my_orders"))]])
     await update.message.reply_text(confirmation_text, parse_mode='Markdown', reply_markup=reply_markup)
 
+# --- PRODUCT SEARCH ---
+SEARCH_PAGE_SIZE = KEYBOARD_PAGE_SIZE
+SEARCH_MAX_RESULTS = 200
+
+def render_search_results(query, results, page):
+    page, total_pages, start, end = page_bounds(len(results), page, SEARCH_PAGE_SIZE)
+    shown_query = re.sub(r"[*_`\[\]]", "", query)
+
+    search_text = f"🔍 **Results for \"{shown_query}\"**\n\n{len(results)} product(s) found"
+    if total_pages > 1:
+        search_text += f" (page {page + 1} of {total_pages})"
+    search_text += ". Select one to view details:"
+
+    keyboard = [
+        [InlineKeyboardButton(prod["button_label"], callback_data=encode_callback("product", prod["category"], prod["product_id"]))]
+        for prod in results[start:end]
+    ]
+    nav = page_nav_row("search_page", page, total_pages)
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("🛒 Browse Categories", callback_data=encode_callback("browse_products"))])
+    return page, search_text, InlineKeyboardMarkup(keyboard)
+
+@send_priority(PRIORITY_BROWSE)
+async def run_search(update: Update, context: ContextTypes.DEFAULT_TYPE, query: str, reply_if_empty=True):
+    results = catalog.search_index.search(query, limit=SEARCH_MAX_RESULTS)
+    if not results:
+        if reply_if_empty:
+            await update.message.reply_text("😕 No products matched your search. Try another word or browse our categories.",
+                                            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Browse Categories", callback_data=encode_callback("browse_products"))]]))
+        return False
+
+    user_id = update.effective_user.id
+    session = get_user_session(user_id)
+    # Searching for the same thing again reopens the page the user was last on
+    previous = session.get('search')
+    page = recall_page(user_id, "search") if previous and previous['query'] == query else 0
+    session['search'] = {
+        'query': query,
+        'catalog_version': catalog.version,
+        'results': [[prod["category"], prod["product_id"]] for prod in results]
+    }
+    page, search_text, reply_markup = render_search_results(query, results, page)
+    remember_page(user_id, "search", page)
+    await update.message.reply_text(search_text, parse_mode='Markdown', reply_markup=reply_markup)
+    return True
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = " ".join(context.args).strip()
+    if not query:
+        await update.message.reply_text("🔍 Usage: /search <product name or keyword>\n\nExample: /search leather wallet")
+        return
+    await run_search(update, context, query)
+
+@send_priority(PRIORITY_BROWSE)
+async def handle_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int):
+    query = update.callback_query
+    search = get_user_session(query.from_user.id).get('search')
+    if not search:
+        await query.edit_message_text("⌛ This search has expired. Type what you are looking for to search again.")
+        return
+
+    if search['catalog_version'] == catalog.version:
+        results = [catalog.product(cat_id, prod_id) for cat_id, prod_id in search['results']]
+        results = [prod for prod in results if prod]
+    else:
+        results = catalog.search_index.search(search['query'], limit=SEARCH_MAX_RESULTS)
+        search['catalog_version'] = catalog.version
+        search['results'] = [[prod["category"], prod["product_id"]] for prod in results]
+
+    page, search_text, reply_markup = render_search_results(search['query'], results, page)
+    remember_page(query.from_user.id, "search", page)
+    await query.edit_message_text(search_text, parse_mode='Markdown', reply_markup=reply_markup)
+
+# --- CALLBACK ROUTING ---
+# callback_data is a url-safe base64 string of: format version, action code, low byte of the
+# catalog version, then varint arguments. Categories, products and option values travel as
+# numeric indexes, so payloads stay a few bytes long whatever the catalog's IDs look like.
+CALLBACK_FORMAT_VERSION = 1
+
+class InvalidCallback(Exception):
+    pass
+
+def _lookup(sequence, index):
+    if index >= len(sequence):
+        raise InvalidCallback(f"index {index} out of range")
+    return sequence[index]
+
+# name: (values taken when encoding, integers on the wire, encode, decode, tied to catalog version)
+CALLBACK_PARAMS = {
+    "category": (1, 1,
+                 lambda ids, cat_id: [ids.category_index[cat_id]],
+                 lambda ids, n: (_lookup(ids.category_ids, n[0]),), True),
+    "product": (2, 1,
+                lambda ids, cat_id, prod_id: [ids.product_index[(cat_id, prod_id)]],
+                lambda ids, n: _lookup(ids.product_keys, n[0]), True),
+    "option": (2, 2,
+               lambda ids, opt_type, value: [ids.option_type_index[opt_type], ids.option_value_index[opt_type][value]],
+               lambda ids, n: (_lookup(ids.option_types, n[0]), _lookup(ids.options[ids.option_types[n[0]]], n[1])), True),
+    "int": (1, 1,
+            lambda ids, value: [value],
+            lambda ids, n: (n[0],), False),
+}
+
+def _write_varint(out, value):
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+def _read_varints(payload):
+    values, current, shift = [], 0, 0
+    for byte in payload:
+        current |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            if shift > 35:
+                raise InvalidCallback("varint too long")
+        else:
+            values.append(current)
+            current, shift = 0, 0
+    if shift:
+        raise InvalidCallback("truncated varint")
+    return values
+
+class CallbackRoute:
+    __slots__ = ("name", "code", "handler", "params", "catalog_bound", "answer")
+
+    def __init__(self, name, code, handler, params, catalog_bound, answer):
+        self.name = name
+        self.code = code
+        self.handler = handler
+        self.params = params
+        self.catalog_bound = catalog_bound
+        self.answer = answer
+
+class CallbackRouter:
+    def __init__(self):
+        self._by_name = {}
+        self._by_code = {}
+
+    def register(self, name, code, handler, params=(), answer=True):
+        if name in self._by_name or code in self._by_code or not 0 < code < 256:
+            raise ValueError(f"Invalid or duplicate callback route {name!r} ({code})")
+        catalog_bound = any(CALLBACK_PARAMS[param][4] for param in params)
+        route = CallbackRoute(name, code, handler, tuple(params), catalog_bound, answer)
+        self._by_name[name] = route
+        self._by_code[code] = route
+
+    def encode(self, name, *values):
+        route = self._by_name[name]
+        ids = catalog
+        out = bytearray((CALLBACK_FORMAT_VERSION, route.code, ids.version & 0xFF))
+        pos = 0
+        for param in route.params:
+            taken, _, encode, _, _ = CALLBACK_PARAMS[param]
+            for number in encode(ids, *values[pos:pos + taken]):
+                _write_varint(out, number)
+            pos += taken
+        if pos != len(values):
+            raise ValueError(f"Wrong number of values for callback {name!r}")
+        return base64.urlsafe_b64encode(bytes(out)).rstrip(b"=").decode("ascii")
+
+    def decode(self, data):
+        try:
+            raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+        except (ValueError, TypeError):
+            raise InvalidCallback("not base64")
+        if len(raw) < 3 or raw[0] != CALLBACK_FORMAT_VERSION:
+            raise InvalidCallback("unknown format")
+        route = self._by_code.get(raw[1])
+        if route is None:
+            raise InvalidCallback(f"unknown action {raw[1]}")
+        ids = catalog
+        if route.catalog_bound and raw[2] != ids.version & 0xFF:
+            raise InvalidCallback("catalog has changed")
+        numbers = _read_varints(raw[3:])
+        args, pos = [], 0
+        for param in route.params:
+            _, width, _, decode, _ = CALLBACK_PARAMS[param]
+            if pos + width > len(numbers):
+                raise InvalidCallback("missing arguments")
+            args.extend(decode(ids, numbers[pos:pos + width]))
+            pos += width
+        if pos != len(numbers):
+            raise InvalidCallback("unexpected arguments")
+        return route, args
+
+callback_router = CallbackRouter()
+encode_callback = callback_router.encode
+
+async def handle_clear_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    clear_user_cart(update.callback_query.from_user.id)
+    await update.callback_query.edit_message_text("🗑️ **Cart Cleared!**", parse_mode='Markdown',
+                                                  reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Start Shopping", callback_data=encode_callback("browse_products"))]]))
+
+async def change_cart_line(update: Update, context: ContextTypes.DEFAULT_TYPE, index: int, revision: int, change):
+    user_id = update.effective_user.id
+    cart = get_user_cart(user_id)
+    # A button from an older rendering of the cart just brings the current one up
+    line = cart.line_at(index) if revision == cart.revision & 0xFFFF else None
+    if line is not None:
+        change(user_id, line)
+    await view_cart(update, context, recall_page(user_id, "cart"))
+
+def increment_cart_line(user_id, line):
+    # Another one at today's price; that is its own line if the product has been repriced
+    if catalog.product(line.category, line.product_id) is not None:
+        add_to_cart(user_id, line.category, line.product_id, dict(line.customizations))
+
+async def handle_cart_decrement(update: Update, context: ContextTypes.DEFAULT_TYPE, index: int, revision: int):
+    await change_cart_line(update, context, index, revision, lambda user_id, line: set_cart_line_quantity(user_id, line, line.quantity - 1))
+
+async def handle_cart_increment(update: Update, context: ContextTypes.DEFAULT_TYPE, index: int, revision: int):
+    await change_cart_line(update, context, index, revision, increment_cart_line)
+
+async def handle_cart_remove(update: Update, context: ContextTypes.DEFAULT_TYPE, index: int, revision: int):
+    await change_cart_line(update, context, index, revision, lambda user_id, line: set_cart_line_quantity(user_id, line, 0))
+
+@send_priority(PRIORITY_CHECKOUT)
+async def handle_confirm_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    keyboard = [
+        [InlineKeyboardButton("💰 Cash on Delivery (COD)", callback_data=encode_callback("pay_cod"))],
+        [InlineKeyboardButton("💳 Online Payment (Coming Soon)", callback_data=encode_callback("pay_online"))]
+    ]
+    await update.callback_query.edit_message_text("💳 Please select your payment method:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+@send_priority(PRIORITY_CHECKOUT)
+async def handle_make_corrections(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    get_user_session(update.callback_query.from_user.id)['current_context'] = "main_menu"
+    await handle_back_to_menu(update, context)
+
+async def handle_back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.message.delete()
+    await start_command(update, context)
+
+@send_priority(PRIORITY_CHECKOUT)
+async def handle_cod_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await handle_payment_selection(update, context, "Cash on Delivery (COD)")
+
+@send_priority(PRIORITY_CHECKOUT)
+async def handle_online_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer("This payment method is not yet available.", show_alert=True)
+
+# Codes are part of the wire format: never reuse or renumber one, only add new ones
+callback_router.register("category", 1, handle_category_selection, ["category"])
+callback_router.register("product", 2, handle_product_selection, ["product"])
+callback_router.register("customize", 3, handle_product_customization, ["product"])
+callback_router.register("select", 4, handle_customization_selection, ["option"])
+callback_router.register("add_cart", 5, handle_add_to_cart, ["product"])
+callback_router.register("browse_products", 6, browse_products)
+callback_router.register("view_cart", 7, view_cart)
+callback_router.register("clear_cart", 8, handle_clear_cart)
+callback_router.register("start_checkout", 9, start_checkout)
+callback_router.register("confirm_details", 10, handle_confirm_details)
+callback_router.register("make_corrections", 11, handle_make_corrections)
+callback_router.register("pay_cod", 12, handle_cod_payment)
+callback_router.register("pay_online", 13, handle_online_payment, answer=False)
+callback_router.register("contact_support", 14, contact_support)
+callback_router.register("back_to_menu", 15, handle_back_to_menu)
+callback_router.register("my_orders", 16, my_orders)
+callback_router.register("about_us", 17, about_us)
+callback_router.register("search_page", 18, handle_search_page, ["int"])
+callback_router.register("category_page", 19, handle_category_selection, ["category", "int"])
+callback_router.register("option_page", 20, handle_option_page, ["int"])
+callback_router.register("orders_page", 21, my_orders, ["int"])
+callback_router.register("cart_page", 22, view_cart, ["int"])
+callback_router.register("cart_decrement", 23, handle_cart_decrement, ["int", "int"])
+callback_router.register("cart_increment", 24, handle_cart_increment, ["int", "int"])
+callback_router.register("cart_remove", 25, handle_cart_remove, ["int", "int"])
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    
     data = query.data
-    user_id = query.from_user.id
+    started = time.perf_counter()
     
     try:
-        logger.info(f"Processing callback data: {data}")
-        if data.startswith("category_"):
-            await handle_category_selection(update, context, data.split("_", 1)[1])
-        elif data.startswith("product_"):
-            _, category_id, product_id = data.split("_", 2)
-            await handle_product_selection(update, context, category_id, product_id)
-        elif data.startswith("customize_"):
-            _, category_id, product_id = data.split("_", 2)
-            await handle_product_customization(update, context, category_id, product_id)
-        elif data.startswith("select_"):
-            _, option_type, selected_value = data.split("_", 2)
-            await handle_customization_selection(update, context, option_type, selected_value)
-        elif data.startswith("add_cart_"):
-            _, category_id, product_id = data.split("_", 2)
-            await handle_add_to_cart(update, context, category_id, product_id)
-        elif data == "browse_products":
-            await browse_products(update, context)
-        elif data == "view_cart":
-            await view_cart(update, context)
-        elif data == "clear_cart":
-            clear_user_cart(user_id)
-            await query.edit_message_text("🗑️ **Cart Cleared!**", parse_mode='Markdown', 
-                                         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Start Shopping", callback_data="browse_products")]]))
-        elif data == "start_checkout":
-            await start_checkout(update, context)
-        elif data == "confirm_details":
-            keyboard = [
-                [InlineKeyboardButton("💰 Cash on Delivery (COD)", callback_data="payment_COD")],
-                [InlineKeyboardButton("💳 Online Payment (Coming Soon)", callback_data="payment_online_disabled")]
-            ]
-            await query.edit_message_text("💳 Please select your payment method:", reply_markup=InlineKeyboardMarkup(keyboard))
-        elif data == "make_corrections":
-            get_user_session(user_id)['current_context'] = "main_menu"
-            await query.message.delete()
-            await start_command(update, context)
-        elif data.startswith("payment_"):
-            if data == "payment_COD":
-                await handle_payment_selection(update, context, "Cash on Delivery (COD)")
-            else:
-                await query.answer("This payment method is not yet available.", show_alert=True)
-        elif data == "contact_support":
-            await contact_support(update, context)
-        elif data == "back_to_menu":
-            await query.message.delete()
-            await start_command(update, context)
-        elif data == "my_orders":
-            await my_orders(update, context)
-        elif data == "about_us":
-            await about_us(update, context)
+        route, args = callback_router.decode(data)
+    except InvalidCallback as e:
+        log_event("callback", "Rejected callback data %r: %s", data, e, user_id=query.from_user.id)
+        await query.answer()
+        try:
+            await query.edit_message_text("⌛ This menu is out of date. Please start browsing again.",
+                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Start Shopping", callback_data=encode_callback("browse_products"))]]))
+        except Exception:
+            pass
+        handler_seconds.observe(time.perf_counter() - started, "button_callback", "invalid")
+        return
+
+    if route.answer:
+        await query.answer()
+    try:
+        log_event("callback", "Processing callback: %s %s", route.name, args, route=route.name, user_id=query.from_user.id)
+        await route.handler(update, context, *args)
     except Exception as e:
-        logger.error(f"Error in button_callback: {e}", exc_info=True)
+        logger.error("Error in button_callback: %s", e, exc_info=True)
         try:
             await query.edit_message_text("❌ An unexpected error occurred. Please try again or type /start to reset.")
-        except:
+        except Exception:
             pass
+    finally:
+        handler_seconds.observe(time.perf_counter() - started, "button_callback", route.name)
 
 async def handle_menu_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message_text = update.message.text
     user_id = update.effective_user.id
     session = get_user_session(user_id)
     
-    if 'checkout' in session.get('current_context', ''):
-        await process_checkout_step(update, context)
+    current_context = session.get('current_context') or ''
+    if 'checkout' in current_context:
+        with handler_seconds.time("handle_menu_buttons", current_context):
+            await process_checkout_step(update, context)
         return
     
     menu_actions = {
@@ -887,9 +4235,303 @@ async def handle_menu_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     action = menu_actions.get(message_text)
     if action:
-        await action(update, context)
-    else:
-        await update.message.reply_text("I didn't understand that. Please use the menu buttons or type /help.")
+        with handler_seconds.time("handle_menu_buttons", action.__name__):
+            await action(update, context)
+        return
+    with handler_seconds.time("handle_menu_buttons", "search"):
+        if not await run_search(update, context, message_text, reply_if_empty=False):
+            await update.message.reply_text("I didn't understand that. Please use the menu buttons or type /help.")
+
+# --- CATALOG HOT RELOAD ---
+def install_catalog(new_catalog):
+    global catalog
+    catalog = new_catalog
+    live_stats.set("total_products", len(new_catalog.products))
+    update_recorder.catalog_changed(new_catalog.version)
+    logger.info("📚 Catalog v%s installed (%s products).", new_catalog.version, len(new_catalog.products))
+
+async def watch_catalog():
+    # Parsing happens off the event loop; the swap itself is a single assignment on it
+    loop = asyncio.get_running_loop()
+    seen_mtime = catalog.mtime
+    while True:
+        await asyncio.sleep(CATALOG_RELOAD_INTERVAL)
+        try:
+            mtime = os.stat(CATALOG_FILE).st_mtime
+        except OSError as e:
+            logger.warning("⚠️ Cannot stat catalog file: %s", e)
+            continue
+        if mtime == seen_mtime:
+            continue
+        seen_mtime = mtime
+        try:
+            new_catalog = await loop.run_in_executor(None, load_catalog, CATALOG_FILE, catalog.version + 1)
+        except Exception as e:
+            logger.error("❌ Catalog reload failed, keeping v%s: %s", catalog.version, e)
+            continue
+        install_catalog(new_catalog)
+
+# --- UPDATE RECORDER ---
+# Opt-in (UPDATE_RECORD_FILE): every incoming update is reduced to who, when and what they
+# tapped or typed, with user IDs replaced by keyed hashes and checkout answers masked, and
+# written as gzipped JSON lines by a background thread. Each run starts a new file; the one
+# before is kept beside it with its time in the name. benchmarks/replay.py plays files back.
+UPDATE_RECORD_FILE = os.getenv("UPDATE_RECORD_FILE", "")
+# Set a fixed salt to keep pseudonyms stable across restarts; by default they change every run
+UPDATE_RECORD_SALT = os.getenv("UPDATE_RECORD_SALT", "").encode() or os.urandom(16)
+UPDATE_RECORD_LIMIT = int(os.getenv("UPDATE_RECORD_LIMIT", 1_000_000))
+UPDATE_RECORD_FORMAT = 1
+# Replies to these prompts are names, phone numbers and addresses
+RECORD_MASKED_CONTEXTS = {"checkout_name", "checkout_phone", "checkout_address"}
+
+def mask_text(text):
+    # Keeps the shape (length, spacing, digits) so validation behaves the same on replay
+    return "".join("9" if c.isdigit() else c if c.isspace() else "x" for c in text)
+
+class UpdateRecorder:
+    _STOP = object()
+
+    def __init__(self, path, salt, limit=UPDATE_RECORD_LIMIT, queue_size=10000):
+        self.path = path
+        self.salt = salt
+        self.limit = limit
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._started = None
+        self.recorded = 0
+        self.dropped = 0
+        self.skipped = 0
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def pseudonym(self, user_id):
+        return int.from_bytes(hmac.new(self.salt, str(user_id).encode(), "sha256").digest()[:5], "big") + 1
+
+    def start(self):
+        if not self.enabled or self._thread:
+            return
+        self._started = time.monotonic()
+        self._thread = Thread(target=self._run, name="update-recorder", daemon=True)
+        self._thread.start()
+        self._offer({"format": UPDATE_RECORD_FORMAT, "started": datetime.now().isoformat(), "catalog_version": catalog.version})
+        logger.info("🎙️ Recording updates to %s", self.path)
+
+    def _offer(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            # Never slow the bot down for the sake of the recording
+            self.dropped += 1
+
+    def _elapsed_ms(self):
+        return int((time.monotonic() - self._started) * 1000)
+
+    def record(self, update):
+        if self._thread is None or self.recorded >= self.limit:
+            return
+        user = update.effective_user
+        if update.callback_query and update.callback_query.data is not None and user:
+            record = ["c", self._elapsed_ms(), self.pseudonym(user.id), update.callback_query.data]
+        elif update.message and update.message.text is not None and user:
+            text = update.message.text
+            if not text.startswith("/"):
+                session = user_sessions.get(user.id) if user_sessions.cached(user.id) else None
+                if session is None or session.get("current_context") in RECORD_MASKED_CONTEXTS:
+                    text = mask_text(text)
+            record = ["m", self._elapsed_ms(), self.pseudonym(user.id), text]
+        else:
+            self.skipped += 1
+            return
+        self.recorded += 1
+        self._offer(record)
+        if self.recorded == self.limit:
+            logger.warning("🎙️ Update recording reached its limit of %s updates.", self.limit)
+
+    def catalog_changed(self, version):
+        # Callback data carries the catalog version, so replay needs to know when it moved
+        if self._thread is not None:
+            self._offer(["v", self._elapsed_ms(), 0, version])
+
+    def _set_aside_previous(self):
+        # One run per file: replay reads a single header and timeline, and a crashed run leaves
+        # a gzip stream that nothing appended after it could be read past
+        if not os.path.exists(self.path):
+            return
+        root, ext = os.path.splitext(self.path)
+        if ext == ".gz":
+            root, inner = os.path.splitext(root)
+            ext = inner + ext
+        stamp = datetime.fromtimestamp(os.path.getmtime(self.path)).strftime("%Y%m%d-%H%M%S")
+        previous = f"{root}-{stamp}{ext}"
+        os.replace(self.path, previous)
+        logger.info("🎙️ Previous recording moved to %s", previous)
+
+    def _run(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            self._set_aside_previous()
+            with gzip.open(self.path, "wt", encoding="utf-8") as f:
+                stopping = False
+                while not stopping:
+                    batch = [self._queue.get()]
+                    while len(batch) < 500:
+                        try:
+                            batch.append(self._queue.get_nowait())
+                        except queue.Empty:
+                            break
+                    stopping = batch[-1] is self._STOP
+                    f.write("".join(json.dumps(r, separators=(",", ":"), ensure_ascii=False) + "\n" for r in batch if r is not self._STOP))
+                    f.flush()
+        except OSError as e:
+            logger.error("❌ Update recording stopped: %s", e)
+
+    def stop(self):
+        thread, self._thread = self._thread, None
+        if thread:
+            self._queue.put(self._STOP)
+            thread.join()
+            logger.info("🎙️ Update recording closed (%s recorded, %s dropped).", self.recorded, self.dropped)
+
+    def report(self):
+        return {"enabled": self._thread is not None, "recorded": self.recorded, "dropped": self.dropped, "skipped": self.skipped}
+
+update_recorder = UpdateRecorder(UPDATE_RECORD_FILE, UPDATE_RECORD_SALT)
+read_model.add_source("update_recorder", update_recorder.report)
+
+# --- CONCURRENT UPDATE PROCESSING ---
+# Updates from different users are handled side by side by a fixed pool of workers; each
+# user's own updates still run one at a time, in arrival order, so checkout steps never race.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 32))
+UPDATE_QUEUE_LIMIT = int(os.getenv("UPDATE_QUEUE_LIMIT", 10000))
+
+def update_serial_key(update):
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return ("chat", update.effective_chat.id)
+    # Nothing to order it against
+    return object()
+
+class UpdateScheduler:
+    def __init__(self, workers=UPDATE_WORKERS, queue_limit=UPDATE_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        # key -> deque of (update, process, queued_at); the head is in flight or waiting for a worker
+        self._pending = {}
+        self._ready = None
+        self._has_room = None
+        self._idle = None
+        self._tasks = []
+        self._queued = 0
+        self._busy = 0
+        self.metrics = {"processed": 0, "failed": 0, "throttled": 0, "max_depth": 0, "wait_ms_total": 0.0}
+
+    @property
+    def running(self):
+        return bool(self._tasks)
+
+    def start(self):
+        self._ready = asyncio.Queue()
+        self._has_room = asyncio.Event()
+        self._has_room.set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info("🧵 Update scheduler started with %s workers.", self.workers)
+
+    async def submit(self, update, process):
+        # Past the limit the fetcher waits here, leaving further updates in the application queue
+        while self._queued >= self.queue_limit:
+            self.metrics["throttled"] += 1
+            self._has_room.clear()
+            await self._has_room.wait()
+        key = update_serial_key(update)
+        self._queued += 1
+        self._idle.clear()
+        self.metrics["max_depth"] = max(self.metrics["max_depth"], self._queued)
+        item = (update, process, time.monotonic())
+        backlog = self._pending.get(key)
+        if backlog is None:
+            self._pending[key] = deque([item])
+            self._ready.put_nowait(key)
+        else:
+            backlog.append(item)
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            backlog = self._pending[key]
+            update, process, queued_at = backlog[0]
+            self.metrics["wait_ms_total"] += (time.monotonic() - queued_at) * 1000
+            self._busy += 1
+            try:
+                await process(update)
+                self.metrics["processed"] += 1
+            except Exception as e:
+                self.metrics["failed"] += 1
+                logger.error("Error processing update for %r: %s", key, e, exc_info=True)
+            finally:
+                self._busy -= 1
+                backlog.popleft()
+                self._queued -= 1
+                self._has_room.set()
+                # Requeue behind other users rather than draining this one's backlog first
+                if backlog:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+                if not self._queued:
+                    self._idle.set()
+
+    async def join(self):
+        if self._idle:
+            await self._idle.wait()
+
+    async def stop(self, timeout=10):
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("⚠️ Dropping %s queued updates on shutdown.", self._queued)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def report(self):
+        done = self.metrics["processed"] + self.metrics["failed"]
+        return {
+            "workers": self.workers,
+            "busy_workers": self._busy,
+            "queued": self._queued,
+            "users_queued": len(self._pending),
+            "queue_limit": self.queue_limit,
+            "processed": self.metrics["processed"],
+            "failed": self.metrics["failed"],
+            "throttled": self.metrics["throttled"],
+            "max_depth": self.metrics["max_depth"],
+            "avg_wait_ms": round(self.metrics["wait_ms_total"] / done, 2) if done else 0.0,
+        }
+
+update_scheduler = UpdateScheduler()
+read_model.add_source("update_queue", update_scheduler.report)
+
+class ConcurrentApplication(Application):
+    # PTB's fetcher awaits process_update once per update; handing the update to the scheduler
+    # instead lets it move on to the next one. Without a running scheduler nothing changes.
+    async def process_update(self, update):
+        if update_recorder.enabled:
+            update_recorder.record(update)
+        if update_scheduler.running:
+            await update_scheduler.submit(update, super().process_update)
+        else:
+            await super().process_update(update)
 
 # --- BOT & SERVER INITIALIZATION ---
 async def clear_existing_webhooks(bot: "telegram.Bot"):
@@ -897,42 +4539,89 @@ async def clear_existing_webhooks(bot: "telegram.Bot"):
         await bot.delete_webhook(drop_pending_updates=True)
         logger.info("✅ Cleared existing webhooks.")
     except Exception as e:
-        logger.warning(f"⚠️ Could not clear webhooks: {e}")
+        logger.warning("⚠️ Could not clear webhooks: %s", e)
+
+def build_application(token=BOT_TOKEN, request=None):
+    builder = ApplicationBuilder().token(token).application_class(ConcurrentApplication).rate_limiter(send_scheduler)
+    if request is not None:
+        builder = builder.request(request)
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None)
+    application = builder.build()
+
+    application.add_handler(CommandHandler("start", timed_handler("start_command", start_command)))
+    application.add_handler(CommandHandler("help", timed_handler("help_command", help_command)))
+    application.add_handler(CommandHandler("search", timed_handler("search_command", search_command)))
+    application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_menu_buttons))
+    application.add_handler(TypeHandler(Update, load_user_state), group=-1)
+    application.add_handler(TypeHandler(Update, persist_user_state), group=1)
+    return application
 
 async def run_bot_async():
-    global bot_running
+    global bot_running, bot_application, bot_loop, bot_thread_id
     if not BOT_TOKEN:
         logger.critical("❌ CRITICAL: BOT_TOKEN not found! The bot cannot start.")
         return
+    if BOT_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET):
+        logger.critical("❌ CRITICAL: BOT_MODE=webhook needs both WEBHOOK_URL and WEBHOOK_SECRET.")
+        return
+    if WORKER_COUNT > 1 and not (BOT_MODE == "webhook" and state_backend.shared and len(WORKER_URLS) == WORKER_COUNT):
+        logger.critical("❌ CRITICAL: WORKER_COUNT > 1 needs BOT_MODE=webhook, a shared STATE_BACKEND_URL and one WORKER_URLS entry per worker.")
+        return
 
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
-    
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CallbackQueryHandler(button_callback))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_menu_buttons))
+    application = build_application()
     
+    catalog_watcher = None
     try:
-        await clear_existing_webhooks(application.bot)
+        order_writer.start()
+        update_scheduler.start()
+        update_recorder.start()
         await application.initialize()
-        await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        if BOT_MODE == "webhook" and WORKER_INDEX == 0:
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES
+            )
+            logger.info("🪝 Webhook registered at %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+        else:
+            await clear_existing_webhooks(application.bot)
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
         await application.start()
+        bot_application, bot_loop, bot_thread_id = application, asyncio.get_running_loop(), get_ident()
         bot_running = True
-        logger.info(f"🚀 Bot @{application.bot.username} is now running!")
+        catalog_watcher = asyncio.create_task(watch_catalog())
+        logger.info("🚀 Bot @%s is now running!", application.bot.username)
+        read_model.bind(bot_loop)
         while bot_running:
+            tick = time.monotonic()
             await asyncio.sleep(1)
+            loop_lag.record(time.monotonic() - tick - 1)
+            # Session-store and cache metrics change on every access; refresh them once a tick
+            read_model.publish()
     except (Conflict, TimedOut, NetworkError) as e:
-        logger.error(f"❌ Network/Conflict error, retrying in 15s: {e}")
+        logger.error("❌ Network/Conflict error, retrying in 15s: %s", e)
         await asyncio.sleep(15)
     except Exception as e:
-        logger.critical(f"❌ A critical error occurred in the bot loop: {e}", exc_info=True)
+        logger.critical("❌ A critical error occurred in the bot loop: %s", e, exc_info=True)
     finally:
         bot_running = False
+        bot_application = bot_loop = bot_thread_id = None
+        stack_sampler.stop()
+        read_model.unbind()
+        if catalog_watcher:
+            catalog_watcher.cancel()
         if application.updater and application.updater.running:
             await application.updater.stop()
+        await update_scheduler.stop()
+        update_recorder.stop()
         if application.running:
             await application.stop()
         await application.shutdown()
+        order_writer.stop()
+        state_journal.close()
+        user_sessions.flush()
+        user_carts.flush()
+        state_backend.close()
         logger.info("🛑 Bot has been stopped.")
 
 def run_bot_thread():
@@ -948,7 +4637,7 @@ def run_bot_thread():
 
 def run_flask():
     port = int(os.environ.get('PORT', 5000))
-    logger.info(f"🌐 Starting Flask server on http://0.0.0.0:{port}")
+    logger.info("🌐 Starting Flask server on http://0.0.0.0:%s", port)
     try:
         from waitress import serve
         serve(app, host='0.0.0.0', port=port, threads=8)
@@ -958,6 +4647,7 @@ def run_flask():
 
 if __name__ == '__main__':
     logger.info("🚀 Initializing TrustyLads® India E-commerce Bot...")
+    state_journal.restore()
     bot_thread = Thread(target=run_bot_thread, daemon=True)
     bot_thread.start()
     
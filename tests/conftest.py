@@ -0,0 +1,42 @@
+import asyncio
+import os
+import sys
+from threading import Thread
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from fakebot import FakeRequest, import_bot  # noqa: E402
+from resp_server import RespServer  # noqa: E402
+
+# main reads its configuration at import time, so the whole suite shares one scratch directory
+bot = import_bot(prefix="tests-")
+
+@pytest.fixture
+def bot_loop():
+    # A bot loop of its own in a thread, the way run_bot_thread runs it next to Flask
+    loop = asyncio.new_event_loop()
+    thread = Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    loop.close()
+
+@pytest.fixture
+def run(bot_loop):
+    def run(coro, timeout=10):
+        return asyncio.run_coroutine_threadsafe(coro, bot_loop).result(timeout)
+    return run
+
+@pytest.fixture
+def fake_telegram():
+    return FakeRequest()
+
+@pytest.fixture
+def resp_server():
+    # A Redis stand-in on a free port, for RespBackend and anything running on a shared backend
+    server = RespServer().start()
+    yield server
+    server.stop()
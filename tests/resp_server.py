@@ -0,0 +1,224 @@
+"""A small in-process RESP server standing in for Redis in the state backend tests.
+
+It speaks enough of the protocol for RespBackend: strings with PX expiry, INCRBY, lists,
+sorted sets, sets, SCAN with MATCH/COUNT paging, AUTH and SELECT. Each database is a dict.
+"""
+import asyncio
+import re
+import time
+from collections import Counter
+from threading import Thread
+
+class RespError(Exception):
+    pass
+
+def glob_to_regex(pattern):
+    # Redis globs: * ? [...] with backslash escapes
+    out, i = [], 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern):
+            i += 1
+            out.append(re.escape(pattern[i]))
+        elif char == "*":
+            out.append(".*")
+        elif char == "?":
+            out.append(".")
+        elif char == "[":
+            end = pattern.find("]", i)
+            out.append(pattern[i:end + 1] if end > i else re.escape(char))
+            i = end if end > i else i
+        else:
+            out.append(re.escape(char))
+        i += 1
+    return re.compile("".join(out), re.S)
+
+class RespServer:
+    def __init__(self, password=None):
+        self.password = password
+        self.databases = {}
+        self.expiry = {}
+        self.commands = Counter()
+        self.connections = 0
+        self.max_connections = 0
+        self.url = None
+        self._writers = set()
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._loop.run_forever, name="resp-server", daemon=True)
+        self._server = None
+
+    def start(self):
+        self._thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self._serve, "127.0.0.1", 0), self._loop).result(5)
+        port = self._server.sockets[0].getsockname()[1]
+        self.url = f"redis://127.0.0.1:{port}/0"
+        return self
+
+    def stop(self):
+        async def close():
+            self._server.close()
+            await self._drop()
+            await self._server.wait_closed()
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result(5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(5)
+
+    def drop_connections(self):
+        # What a server restart or an idle timeout looks like to pooled clients
+        asyncio.run_coroutine_threadsafe(self._drop(), self._loop).result(5)
+
+    async def _drop(self):
+        for writer in list(self._writers):
+            writer.close()
+        self._writers.clear()
+
+    def db(self, index=0):
+        return self.databases.setdefault(index, {})
+
+    async def _serve(self, reader, writer):
+        self._writers.add(writer)
+        self.connections += 1
+        self.max_connections = max(self.max_connections, self.connections)
+        client = {"db": 0, "authed": self.password is None}
+        try:
+            while True:
+                command = await self._read_command(reader)
+                if command is None:
+                    return
+                writer.write(self._encode(self._execute(client, command)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections -= 1
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            raise ConnectionError(f"inline commands are not supported: {line!r}")
+        command = []
+        for _ in range(int(line[1:-2])):
+            size = int((await reader.readline())[1:-2])
+            command.append((await reader.readexactly(size + 2))[:-2])
+        return command
+
+    def _encode(self, value):
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, RespError):
+            return b"-%s\r\n" % str(value).encode()
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, bytes):
+            return b"$%d\r\n%s\r\n" % (len(value), value)
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(self._encode(v) for v in value)
+        return b"+%s\r\n" % value.encode()
+
+    def _live(self, data, key):
+        deadline = self.expiry.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            data.pop(key, None)
+            self.expiry.pop(key, None)
+        return data.get(key)
+
+    def _execute(self, client, command):
+        name, args = command[0].upper().decode(), command[1:]
+        self.commands[name] += 1
+        if name == "AUTH":
+            if args and args[-1].decode() == self.password:
+                client["authed"] = True
+                return "OK"
+            return RespError("WRONGPASS invalid username-password pair")
+        if not client["authed"]:
+            return RespError("NOAUTH Authentication required.")
+        if name == "SELECT":
+            client["db"] = int(args[0])
+            return "OK"
+        handler = getattr(self, f"_cmd_{name.lower()}", None)
+        if handler is None:
+            return RespError(f"ERR unknown command '{name}'")
+        try:
+            return handler(self.db(client["db"]), *args)
+        except (TypeError, ValueError) as e:
+            return RespError(f"ERR {e}")
+
+    def _cmd_ping(self, data):
+        return "PONG"
+
+    def _cmd_get(self, data, key):
+        return self._live(data, key)
+
+    def _cmd_mget(self, data, *keys):
+        return [self._live(data, key) for key in keys]
+
+    def _cmd_set(self, data, key, value, *options):
+        data[key] = value
+        self.expiry.pop(key, None)
+        if len(options) == 2 and options[0].upper() == b"PX":
+            self.expiry[key] = time.monotonic() + int(options[1]) / 1000
+        return "OK"
+
+    def _cmd_del(self, data, *keys):
+        return sum(data.pop(key, None) is not None for key in keys)
+
+    def _cmd_incrby(self, data, key, amount):
+        value = int(self._live(data, key) or 0) + int(amount)
+        data[key] = str(value).encode()
+        return value
+
+    def _cmd_rpush(self, data, key, *values):
+        items = data.setdefault(key, [])
+        items.extend(values)
+        return len(items)
+
+    def _cmd_llen(self, data, key):
+        return len(self._live(data, key) or [])
+
+    def _cmd_lrange(self, data, key, start, stop):
+        items = self._live(data, key) or []
+        start, stop = int(start), int(stop)
+        start = max(start + len(items), 0) if start < 0 else start
+        stop = stop + len(items) if stop < 0 else stop
+        return items[start:stop + 1]
+
+    def _cmd_zadd(self, data, key, *pairs):
+        scores = data.setdefault(key, {})
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += member not in scores
+            scores[member] = float(score)
+        return added
+
+    def _cmd_zcard(self, data, key):
+        return len(self._live(data, key) or {})
+
+    def _cmd_zrevrange(self, data, key, start, stop):
+        ranked = sorted((self._live(data, key) or {}).items(), key=lambda item: (item[1], item[0]), reverse=True)
+        stop = int(stop)
+        return [member for member, _ in ranked[int(start):None if stop == -1 else stop + 1]]
+
+    def _cmd_sadd(self, data, key, *members):
+        found = data.setdefault(key, set())
+        before = len(found)
+        found.update(members)
+        return len(found) - before
+
+    def _cmd_scard(self, data, key):
+        return len(self._live(data, key) or ())
+
+    def _cmd_scan(self, data, cursor, *options):
+        # The cursor is an offset into the sorted keyspace, so callers must follow it to the end
+        options = dict(zip((o.upper() for o in options[::2]), options[1::2]))
+        pattern = glob_to_regex(options.get(b"MATCH", b"*").decode())
+        count = int(options.get(b"COUNT", 10))
+        keys = sorted(data)
+        start = int(cursor)
+        batch = [k for k in keys[start:start + count] if self._live(data, k) is not None and pattern.fullmatch(k.decode())]
+        following = start + count
+        return [str(following if following < len(keys) else 0).encode(), batch]
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from conftest import bot
+
+def make_cart(quantity=1):
+    cart = bot.Cart()
+    line = cart.add("clothing", "tshirt", "Classic T-Shirt", 499.0, bot.customization_key({"size": "M"}))
+    cart.set_quantity(line, quantity)
+    return cart
+
+def cart_store(backend, max_entries=1):
+    return bot.BoundedStore("carts", 3600, max_entries, bool, backend, bot.Cart.to_json, bot.Cart.from_json)
+
+def session_store(backend, max_entries=1):
+    return bot.BoundedStore("sessions", 3600, max_entries, bot.session_has_state, backend)
+
+def settle(store):
+    for _, future in list(store._spill_order):
+        future.result()
+
+@pytest.fixture
+def backend(tmp_path):
+    return bot.LocalBackend(str(tmp_path / "state"))
+
+async def handle(store, key, change):
+    # What one update does: load() before the handlers, release() after them
+    await store.load(key)
+    try:
+        change(store)
+    finally:
+        store.release(key)
+
+def test_spilled_entry_is_rehydrated(backend):
+    store = cart_store(backend)
+    store[1] = make_cart(2)
+    store[2] = make_cart()
+    settle(store)
+    assert not store.cached(1)
+    assert backend.get(bot.state_key("carts", 1)) is not None
+    asyncio.run(store.load(1))
+    assert store.cached(1) and store.get(1).count == 2
+
+def test_cleared_cart_does_not_come_back_after_restart(backend):
+    store = cart_store(backend)
+    store[1] = make_cart()
+    store[2] = make_cart()
+    settle(store)
+    asyncio.run(handle(store, 1, lambda s: s.get(1).clear()))
+    store.flush()
+    restarted = cart_store(backend)
+    assert restarted.get(1) is None
+
+def test_rehydrated_entry_leaves_no_stored_copy_even_without_flush(backend):
+    # A crash skips flush(); the stored copy must already be gone once the entry is back in memory
+    store = session_store(backend)
+    store[1] = {"current_context": "checkout_promo", "checkout_data": {"full_name": "A"}, "customization_data": {}}
+    store[2] = {"current_context": None, "checkout_data": {}, "customization_data": {}}
+    settle(store)
+    asyncio.run(handle(store, 1, lambda s: s.get(1).update(current_context="main_menu", checkout_data={})))
+    settle(store)
+    assert backend.get(bot.state_key("sessions", 1)) is None
+    assert session_store(backend).get(1) is None
+
+def test_flush_removes_copies_of_entries_that_no_longer_qualify(backend):
+    store = cart_store(backend, max_entries=10)
+    backend.set(bot.state_key("carts", 1), make_cart().to_json())
+    store[1] = bot.Cart()
+    store.flush()
+    assert backend.get(bot.state_key("carts", 1)) is None
+
+def test_pinned_entry_survives_sweeps(backend):
+    store = session_store(backend)
+
+    async def update():
+        await store.load(1)
+        session = store.setdefault(1, {"current_context": "checkout_name", "checkout_data": {}, "customization_data": {}})
+        for other in range(2, 6):
+            store[other] = {"current_context": None, "checkout_data": {}, "customization_data": {}}
+        # Still the live entry, so this write is not lost to an evicted copy
+        session["checkout_data"]["full_name"] = "A"
+        assert store.cached(1)
+        store.release(1)
+
+    asyncio.run(update())
+    store[6] = {}
+    settle(store)
+    assert not store.cached(1)
+    assert asyncio.run(_reload(store, 1))["checkout_data"] == {"full_name": "A"}
+
+async def _reload(store, key):
+    await store.load(key)
+    store.release(key)
+    return store.get(key)
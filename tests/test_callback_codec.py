@@ -0,0 +1,116 @@
+import base64
+import random
+
+import pytest
+
+import fakebot
+from conftest import bot
+from telegram.ext import Application
+
+TELEGRAM_CALLBACK_LIMIT = 64
+
+def sample_values(param):
+    # The largest values each parameter can carry, so the size checks are worst case
+    catalog = bot.catalog
+    if param == "category":
+        return [(catalog.category_ids[0],), (catalog.category_ids[-1],)]
+    if param == "product":
+        return [catalog.product_keys[0], catalog.product_keys[-1]]
+    if param == "option":
+        option = catalog.option_types[-1]
+        return [(catalog.option_types[0], catalog.options[catalog.option_types[0]][0]), (option, catalog.options[option][-1])]
+    return [(0,), (1,), (0xFFFF,), (10 ** 6,)]
+
+def route_cases():
+    for route in bot.callback_router._by_name.values():
+        combos = [()]
+        for param in route.params:
+            combos = [combo + values for combo in combos for values in sample_values(param)]
+        for values in combos:
+            yield pytest.param(route.name, values, id=f"{route.name}{list(values)}")
+
+@pytest.mark.parametrize("name,values", list(route_cases()))
+def test_every_route_round_trips_within_the_limit(name, values):
+    data = bot.encode_callback(name, *values)
+    assert len(data.encode("utf-8")) <= TELEGRAM_CALLBACK_LIMIT
+    route, args = bot.callback_router.decode(data)
+    assert route.name == name
+    assert tuple(args) == tuple(values)
+
+def test_extra_values_are_refused():
+    with pytest.raises(ValueError):
+        bot.encode_callback("view_cart", 1)
+    with pytest.raises(ValueError):
+        bot.encode_callback("orders_page", 1, 2)
+
+def test_catalog_bound_routes_reject_buttons_from_another_catalog(monkeypatch):
+    cat_id, prod_id = bot.catalog.product_keys[0]
+    product = bot.encode_callback("product", cat_id, prod_id)
+    page = bot.encode_callback("orders_page", 2)
+    monkeypatch.setattr(bot, "catalog", bot.load_catalog(bot.CATALOG_FILE, bot.catalog.version + 1))
+    with pytest.raises(bot.InvalidCallback, match="catalog has changed"):
+        bot.callback_router.decode(product)
+    # Buttons that carry no catalog IDs keep working across a reload
+    assert bot.callback_router.decode(page)[1] == [2]
+
+def encode_raw(raw):
+    return base64.urlsafe_b64encode(bytes(raw)).rstrip(b"=").decode("ascii")
+
+def header(code):
+    return [bot.CALLBACK_FORMAT_VERSION, code, bot.catalog.version & 0xFF]
+
+@pytest.mark.parametrize("data,reason", [
+    ("", "unknown format"),
+    ("not base64!", "not base64"),
+    ("é", "not base64"),
+    (encode_raw([bot.CALLBACK_FORMAT_VERSION, 7]), "unknown format"),
+    (encode_raw([bot.CALLBACK_FORMAT_VERSION + 1, 7, 0]), "unknown format"),
+    (encode_raw(header(0)), "unknown action"),
+    (encode_raw(header(255)), "unknown action"),
+    (encode_raw(header(23) + [1]), "missing arguments"),
+    (encode_raw(header(7) + [1]), "unexpected arguments"),
+    (encode_raw(header(18) + [0x80]), "truncated varint"),
+    (encode_raw(header(18) + [0xFF] * 6 + [1]), "varint too long"),
+    (encode_raw(header(1) + [0x7F]), "out of range"),
+    # Plain-text callback data from before the codec
+    ("browse_products", "unknown format"),
+])
+def test_malformed_payloads_are_rejected(data, reason):
+    with pytest.raises(bot.InvalidCallback, match=reason):
+        bot.callback_router.decode(data)
+
+def test_truncated_payloads_never_decode_to_something_else():
+    cat_id, prod_id = bot.catalog.product_keys[-1]
+    option = bot.catalog.option_types[-1]
+    for data in (bot.encode_callback("cart_remove", 300, 0xFFFF), bot.encode_callback("select", option, bot.catalog.options[option][-1]),
+                 bot.encode_callback("category_page", cat_id, 500)):
+        full = bot.callback_router.decode(data)
+        for end in range(len(data)):
+            try:
+                assert bot.callback_router.decode(data[:end]) != full
+            except bot.InvalidCallback:
+                pass
+
+def test_random_garbage_only_raises_invalid_callback():
+    rng = random.Random(8)
+    for _ in range(5000):
+        raw = bytes(rng.randrange(256) for _ in range(rng.randrange(12)))
+        if rng.random() < 0.5 and len(raw) >= 2:
+            raw = bytes(header(raw[1] % 30)) + raw[2:]
+        try:
+            bot.callback_router.decode(encode_raw(raw))
+        except bot.InvalidCallback:
+            pass
+
+def test_stale_button_gets_the_out_of_date_menu(bot_loop, run, fake_telegram):
+    application = bot.build_application(request=fake_telegram)
+
+    async def tap():
+        await application.initialize()
+        factory = fakebot.UpdateFactory(application.bot)
+        await Application.process_update(application, factory.callback(801, "garbage"))
+        await application.shutdown()
+
+    run(tap())
+    assert fake_telegram.calls["answerCallbackQuery"] == 1
+    assert fake_telegram.calls["editMessageText"] == 1
@@ -0,0 +1,119 @@
+import random
+
+from conftest import bot
+
+SIZE_M = bot.customization_key({"size": "M"})
+SIZE_L = bot.customization_key({"size": "L"})
+
+def expected(cart):
+    return sum(line.quantity for line in cart), round(sum(round(line.price * 100) * line.quantity for line in cart))
+
+def test_count_and_subtotal_follow_add_decrement_and_remove():
+    cart = bot.Cart()
+    shirt = cart.add("clothing", "tshirt", "T-Shirt", 499.0, SIZE_M)
+    cart.add("clothing", "tshirt", "T-Shirt", 499.0, SIZE_M)
+    large = cart.add("clothing", "tshirt", "T-Shirt", 499.0, SIZE_L)
+    mug = cart.add("home", "mug", "Mug", 19.99)
+    assert len(cart) == 3 and shirt.quantity == 2
+    assert (cart.count, cart.subtotal_paise) == (4, 2 * 49900 + 49900 + 1999)
+    cart.set_quantity(shirt, shirt.quantity - 1)
+    assert (cart.count, cart.subtotal_paise) == (3, 49900 + 49900 + 1999)
+    cart.set_quantity(large, 0)
+    assert len(cart) == 2 and (cart.count, cart.subtotal_paise) == (2, 49900 + 1999)
+    cart.set_quantity(mug, 0)
+    cart.set_quantity(shirt, 0)
+    assert len(cart) == 0 and (cart.count, cart.subtotal_paise, cart.total) == (0, 0, 0)
+
+def test_repriced_product_gets_its_own_line():
+    cart = bot.Cart()
+    cart.add("home", "mug", "Mug", 199.0)
+    cart.add("home", "mug", "Mug", 149.0)
+    assert len(cart) == 2 and cart.total == 348.0
+
+def test_totals_never_drift():
+    rng = random.Random(18)
+    cart = bot.Cart()
+    prices = [0.1, 0.2, 19.99, 333.33, 1299.5]
+    for _ in range(5000):
+        if cart.lines and rng.random() < 0.45:
+            line = rng.choice(list(cart))
+            cart.set_quantity(line, line.quantity - 1 if rng.random() < 0.8 else 0)
+        else:
+            price = rng.choice(prices)
+            cart.add("c", f"p{price}", "P", price)
+        assert (cart.count, cart.subtotal_paise) == expected(cart)
+    assert cart.total == cart.subtotal_paise / 100
+
+def test_revision_changes_on_every_change():
+    cart = bot.Cart()
+    line = cart.add("home", "mug", "Mug", 199.0)
+    cart.set_quantity(line, 3)
+    cart.clear()
+    assert cart.revision == 3 and (cart.count, cart.subtotal_paise) == (0, 0)
+
+def test_line_at_follows_insertion_order():
+    cart = bot.Cart()
+    first = cart.add("home", "mug", "Mug", 199.0)
+    second = cart.add("clothing", "tshirt", "T-Shirt", 499.0, SIZE_M)
+    assert cart.line_at(0) is first and cart.line_at(1) is second and cart.line_at(2) is None
+
+def test_json_round_trip():
+    cart = bot.Cart()
+    cart.add("clothing", "tshirt", "T-Shirt", 499.0, SIZE_M)
+    cart.add("clothing", "tshirt", "T-Shirt", 499.0, SIZE_M)
+    cart.add("home", "mug", "Mug", 19.99)
+    restored = bot.Cart.from_json(cart.to_json())
+    assert restored.to_json() == cart.to_json()
+    assert (restored.count, restored.subtotal_paise, restored.revision) == (cart.count, cart.subtotal_paise, cart.revision)
+    assert restored.line_at(0).customizations == SIZE_M
+
+LEGACY_ITEMS = [
+    {"category": "clothing", "product_id": "tshirt", "name": "T-Shirt", "price": 499.0, "quantity": 2,
+     "customizations": {"size": "M", "color": "Black"}},
+    {"category": "home", "product_id": "mug", "name": "Mug", "price": 19.99, "quantity": 1},
+]
+
+def check_legacy(cart):
+    assert len(cart) == 2 and cart.count == 3 and cart.subtotal_paise == 2 * 49900 + 1999
+    assert cart.line_at(0).customizations == bot.customization_key({"color": "Black", "size": "M"})
+    assert cart.line_at(1).customizations == ()
+    assert cart.revision == 0
+
+def test_legacy_list_of_item_dicts():
+    check_legacy(bot.Cart.from_json(LEGACY_ITEMS))
+
+def test_legacy_dict_of_item_dicts():
+    check_legacy(bot.Cart.from_json({f"item_{i}": item for i, item in enumerate(LEGACY_ITEMS)}))
+
+def test_legacy_items_with_zero_quantity_are_dropped():
+    cart = bot.Cart.from_json(LEGACY_ITEMS + [dict(LEGACY_ITEMS[1], product_id="bottle", quantity=0)])
+    assert len(cart) == 2
+
+def test_line_json_formats():
+    line = bot.CartLine("clothing", "tshirt", "T-Shirt", 499.0, 2, SIZE_M)
+    restored = bot.CartLine.from_json(line.to_json())
+    assert restored.key == line.key and restored.quantity == 2
+    legacy = bot.CartLine.from_json(LEGACY_ITEMS[0])
+    assert legacy.quantity == 2 and legacy.line_total == 998.0
+
+def test_journal_replay_sets_absolute_quantities():
+    cart = bot.Cart()
+    line = bot.CartLine("home", "mug", "Mug", 19.99, 3)
+    cart.apply(bot.CartLine.from_json(line.to_json()))
+    cart.apply(bot.CartLine("home", "mug", "Mug", 19.99, 1))
+    assert (cart.count, cart.subtotal_paise) == (1, 1999)
+    cart.apply(bot.CartLine("home", "mug", "Mug", 19.99, 0))
+    assert len(cart) == 0 and (cart.count, cart.subtotal_paise) == (0, 0)
+
+def test_legacy_export_reads_back_as_the_same_cart():
+    cart = bot.Cart()
+    cart.add("clothing", "tshirt", "T-Shirt", 499.0, SIZE_M)
+    cart.add("clothing", "tshirt", "T-Shirt", 549.0, SIZE_M)
+    cart.add("home", "mug", "Mug", 19.99)
+    legacy = cart.to_legacy()
+    assert list(legacy) == ["clothing_tshirt_size-M", "clothing_tshirt_size-M@549.0", "home_mug"]
+    assert legacy["home_mug"] == {"name": "Mug", "price": 19.99, "quantity": 1, "category": "home",
+                                  "product_id": "mug", "customizations": {}}
+    restored = bot.Cart.from_json(legacy)
+    assert [line.key for line in restored] == [line.key for line in cart]
+    assert (restored.count, restored.subtotal_paise) == (cart.count, cart.subtotal_paise)
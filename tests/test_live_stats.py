@@ -0,0 +1,31 @@
+import asyncio
+
+from conftest import bot
+
+def test_rebuild_counts_spilled_carts_and_their_items(tmp_path, monkeypatch):
+    carts = bot.BoundedStore("carts", 3600, 1, bool, bot.LocalBackend(str(tmp_path / "state")), bot.Cart.to_json, bot.Cart.from_json)
+    monkeypatch.setattr(bot, "user_carts", carts)
+    monkeypatch.setattr(bot.live_stats, "_counters", dict(bot.live_stats._counters))
+    for user_id, quantity in ((1, 3), (2, 2)):
+        cart = bot.Cart()
+        cart.set_quantity(cart.add("home", "mug", "Mug", 199.0), quantity)
+        carts[user_id] = cart
+    carts[3] = bot.Cart()
+    for _, future in list(carts._spill_order):
+        future.result()
+    assert not carts.cached(1)
+
+    bot.live_stats.rebuild()
+    stats = bot.live_stats.collect()
+    assert (stats["active_carts"], stats["items_in_carts"]) == (2, 5)
+
+    async def clear(user_id):
+        # The way an update does it: bring the cart in, then empty it
+        await carts.load(user_id)
+        bot.clear_user_cart(user_id, ordered=True)
+        carts.release(user_id)
+
+    for user_id in (1, 2):
+        asyncio.run(clear(user_id))
+    stats = bot.live_stats.collect()
+    assert (stats["active_carts"], stats["items_in_carts"]) == (0, 0)
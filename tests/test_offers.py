@@ -0,0 +1,111 @@
+from datetime import datetime
+
+import pytest
+
+from conftest import bot
+
+NOW = datetime(2026, 6, 15, 12, 0).timestamp()
+
+def engine(offers):
+    return bot.OfferEngine(offers, bot.catalog)
+
+def cart(*lines):
+    # (category, product_id, price, quantity)
+    cart = bot.Cart()
+    for category, product_id, price, quantity in lines:
+        line = cart.add(category, product_id, product_id, price)
+        cart.set_quantity(line, quantity)
+    return cart
+
+PHONE = ("electronics", "smartphone", 1000.0, 1)
+SHIRT = ("clothing", "tshirt", 500.0, 2)
+JEANS = ("clothing", "jeans", 800.0, 1)
+
+def test_fixed_amount_wins_over_percent():
+    offers = engine({"BOTH": {"discount": 50, "discount_amount": 100}, "PCT": {"discount": 10}})
+    assert offers.rules["BOTH"].percent is None
+    rule, discount, reason = offers.check("both", cart(PHONE))
+    assert (discount, reason) == (10000, None)
+    assert offers.check("PCT", cart(PHONE))[1] == 10000
+
+def test_percent_is_capped_and_never_exceeds_the_base():
+    offers = engine({"CAP": {"discount": 50, "max_discount": 200}, "FLAT": {"discount_amount": 5000}})
+    assert offers.check("CAP", cart(PHONE))[1] == 20000
+    assert offers.check("FLAT", cart(PHONE))[1] == 100000
+
+def test_offer_needs_a_discount():
+    with pytest.raises(ValueError, match="neither"):
+        engine({"NONE": {"description": "nothing"}})
+
+def test_category_scope_discounts_only_that_category():
+    offers = engine({"CLOTHES": {"discount": 10, "categories": ["clothing"], "min_order": 1500}})
+    assert offers.check("CLOTHES", cart(PHONE, SHIRT, JEANS))[1] == round((1000 + 800) * 100 * 0.10)
+    # The phone counts towards neither the base nor the minimum order
+    assert offers.check("CLOTHES", cart(PHONE, SHIRT))[2] == "min_order"
+    assert offers.check("CLOTHES", cart(PHONE))[2] == "out_of_scope"
+
+def test_product_scope_adds_to_category_scope_without_double_counting():
+    offers = engine({
+        "JEANS": {"discount": 10, "products": ["clothing/jeans"]},
+        "MIXED": {"discount": 10, "categories": ["clothing"], "products": ["clothing/jeans", "electronics/smartphone"]},
+    })
+    assert offers.check("JEANS", cart(PHONE, SHIRT, JEANS))[1] == 8000
+    assert offers.check("MIXED", cart(PHONE, SHIRT, JEANS))[1] == round((1000 + 800 + 1000) * 100 * 0.10)
+
+def test_unknown_scope_fails_the_load():
+    with pytest.raises(ValueError, match="unknown"):
+        engine({"BAD": {"discount": 10, "categories": ["groceries"]}})
+    with pytest.raises(ValueError, match="unknown"):
+        engine({"BAD": {"discount": 10, "products": ["clothing/hat"]}})
+
+def test_validity_window():
+    offers = engine({
+        "LATER": {"discount": 10, "starts": "2026-07-01"},
+        "ENDED": {"discount": 10, "expires": "2026-06-14"},
+        "TODAY": {"discount": 10, "expires": "2026-06-15"},
+        "MIDDAY": {"discount": 10, "expires": "2026-06-15T11:00:00"},
+    })
+    assert offers.check("LATER", cart(PHONE), now=NOW)[2] == "not_started"
+    assert offers.check("ENDED", cart(PHONE), now=NOW)[2] == "expired"
+    # A bare date runs through the end of that day
+    assert offers.check("TODAY", cart(PHONE), now=NOW)[2] is None
+    assert offers.check("MIDDAY", cart(PHONE), now=NOW)[2] == "expired"
+    assert [rule.code for _, rule in offers.evaluate(cart(PHONE), now=NOW)] == ["TODAY"]
+    assert offers.best(cart(PHONE), now=NOW)[1].code == "TODAY"
+
+def test_per_user_limit():
+    offers = engine({"ONCE": {"discount": 20, "per_user_limit": 1}, "ALWAYS": {"discount": 5}})
+    assert offers.capped_codes == ["ONCE"]
+    assert offers.check("ONCE", cart(PHONE), uses=lambda: {})[2] is None
+    assert offers.check("ONCE", cart(PHONE), uses=lambda: {"ONCE": 1})[2] == "used_up"
+    assert offers.best(cart(PHONE), uses=lambda: {})[1].code == "ONCE"
+    assert offers.best(cart(PHONE), uses=lambda: {"ONCE": 1})[1].code == "ALWAYS"
+    assert [rule.code for _, rule in offers.evaluate(cart(PHONE), uses=lambda: {"ONCE": 1})] == ["ALWAYS"]
+
+def test_usage_is_only_looked_up_when_a_capped_rule_could_win():
+    offers = engine({"BIG": {"discount": 20}, "ONCE": {"discount": 5, "per_user_limit": 1}})
+    calls = []
+    assert offers.best(cart(PHONE), uses=lambda: calls.append(1) or {})[1].code == "BIG"
+    assert calls == []
+
+def test_best_breaks_ties_on_the_lowest_code():
+    offers = engine({"ZED": {"discount_amount": 100}, "ALPHA": {"discount": 10}, "MID": {"discount_amount": 100}})
+    assert offers.best(cart(PHONE))[1].code == "ALPHA"
+    assert [rule.code for _, rule in offers.evaluate(cart(PHONE))] == ["ALPHA", "MID", "ZED"]
+
+def test_best_skips_offers_the_cart_is_too_small_for():
+    offers = engine({"SMALL": {"discount": 5}, "BIG": {"discount": 30, "min_order": 5000}})
+    assert offers.best(cart(PHONE))[1].code == "SMALL"
+    assert offers.best(cart(PHONE, PHONE[:3] + (5,)))[1].code == "BIG"
+
+def test_advertised_only():
+    offers = engine({"SECRET": {"discount": 30}, "SHOWN": {"discount": 10, "advertise": True}})
+    assert offers.best(cart(PHONE), advertised_only=True)[1].code == "SHOWN"
+    assert offers.best(cart(PHONE))[1].code == "SECRET"
+
+def test_unknown_code():
+    assert engine({}).check("NOPE", cart(PHONE)) == (None, 0, "unknown")
+
+def test_catalog_offers_compile():
+    assert len(bot.catalog.offers) > 0
+    assert bot.catalog.offers.rules["WELCOME15"].per_user_limit == 0
@@ -0,0 +1,93 @@
+import asyncio
+from threading import Thread
+
+import pytest
+
+from conftest import bot
+
+@pytest.fixture
+def backend(tmp_path):
+    return bot.LocalBackend(str(tmp_path / "state"))
+
+def allocate(allocator, count):
+    # The way finalize_order does it: ready() on the loop, then a synchronous allocate()
+    async def take():
+        numbers = []
+        for _ in range(count):
+            await allocator.ready()
+            numbers.append(allocator.allocate())
+        return numbers
+    return asyncio.run(take())
+
+def counter(backend):
+    return backend.get(bot.state_key("order_counter"))
+
+def test_blocks_are_refilled_when_used_up(backend):
+    allocator = bot.OrderIdAllocator(backend, block_size=4)
+    assert allocate(allocator, 10) == list(range(bot.ORDER_ID_START, bot.ORDER_ID_START + 10))
+    assert allocator.metrics["blocks_reserved"] == 3
+    # Only the first block was waited for; the rest were reserved before they were needed
+    assert allocator.metrics["late_reservations"] == 1
+    assert counter(backend) >= bot.ORDER_ID_START + 9
+
+def test_allocate_without_ready_reserves_inline(backend):
+    allocator = bot.OrderIdAllocator(backend, block_size=3)
+    assert [allocator.allocate() for _ in range(7)] == list(range(bot.ORDER_ID_START, bot.ORDER_ID_START + 7))
+
+def test_restart_after_a_partly_used_block_never_repeats(backend):
+    first = bot.OrderIdAllocator(backend, block_size=10)
+    used = allocate(first, 3)
+    # The rest of that block is lost with the process: a gap, never a repeat
+    restarted = bot.OrderIdAllocator(backend, block_size=10)
+    after = allocate(restarted, 3)
+    assert min(after) > max(used)
+    assert after == list(range(after[0], after[0] + 3))
+    assert after[0] == used[0] + 10
+
+def test_counter_behind_known_orders_is_moved_forward(backend):
+    allocate(bot.OrderIdAllocator(backend, block_size=10), 1)
+    allocator = bot.OrderIdAllocator(backend, block_size=10)
+    # An order store restored from a backup knows of higher numbers than the counter
+    allocator.observe(5000)
+    assert allocate(allocator, 2) == [5001, 5002]
+    restarted = bot.OrderIdAllocator(backend, block_size=10)
+    assert allocate(restarted, 1)[0] > 5002
+
+def test_counter_never_moves_backwards(backend):
+    key = bot.state_key("order_counter")
+    backend.incr(key, 9000)
+    allocator = bot.OrderIdAllocator(backend, block_size=10)
+    allocator.observe(1200)
+    assert allocate(allocator, 1) == [9001]
+    assert counter(backend) == 9010
+
+def run_workers(allocators, count):
+    taken = [[] for _ in allocators]
+
+    def worker(allocator, numbers):
+        numbers.extend(allocator.allocate() for _ in range(count))
+
+    threads = [Thread(target=worker, args=pair) for pair in zip(allocators, taken)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    return taken
+
+def test_two_allocators_on_one_local_backend_never_collide(backend):
+    taken = run_workers([bot.OrderIdAllocator(backend, block_size=7) for _ in range(2)], 500)
+    numbers = [n for batch in taken for n in batch]
+    assert len(numbers) == 1000 and len(set(numbers)) == 1000
+
+def test_workers_on_a_shared_backend_never_collide(resp_server):
+    # Every worker has its own connection pool, as separate processes would
+    backends = [bot.RespBackend(resp_server.url, timeout=2) for _ in range(3)]
+    try:
+        taken = run_workers([bot.OrderIdAllocator(b, block_size=5) for b in backends], 300)
+    finally:
+        for b in backends:
+            b.close()
+    numbers = [n for batch in taken for n in batch]
+    assert len(numbers) == 900 and len(set(numbers)) == 900
+    for batch in taken:
+        assert batch == sorted(batch)
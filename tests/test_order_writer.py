@@ -0,0 +1,101 @@
+import asyncio
+import random
+import time
+from threading import Event
+
+import fakebot
+import pytest
+from conftest import bot
+from telegram.ext import Application
+
+class GatedSink:
+    # Stands in for the order store; holds every batch until opened
+    def __init__(self):
+        self.open = Event()
+        self.written = []
+
+    def __call__(self, batch):
+        self.open.wait(10)
+        self.written.extend(order["order_id"] for order in batch)
+
+def order(n):
+    return {"order_id": f"T-{n}", "user_id": 1, "total": 10.0}
+
+@pytest.fixture
+def writer():
+    sink = GatedSink()
+    writer = bot.OrderWriter(sink, maxsize=3, batch_size=1, flush_interval=0.01)
+    writer.start()
+    yield writer, sink
+    sink.open.set()
+    writer.stop()
+
+def fill(writer, sink):
+    # One order held by the sink, then the queue behind it up to maxsize
+    writer.submit(order(0))
+    while writer._queue.qsize():
+        time.sleep(0.001)
+    for n in range(1, 4):
+        writer.submit(order(n))
+
+def test_full_queue_refuses_orders(writer):
+    writer, sink = writer
+    fill(writer, sink)
+    with pytest.raises(bot.OrderQueueFull):
+        writer.submit(order(99))
+    assert [o["order_id"] for o in writer.inflight()] == ["T-0", "T-1", "T-2", "T-3"]
+    assert writer.report()["rejected"] == 1
+    sink.open.set()
+    writer.flush()
+    assert sink.written == ["T-0", "T-1", "T-2", "T-3"]
+    assert writer.pending() == 0
+
+def test_wait_for_capacity(writer):
+    writer, sink = writer
+    fill(writer, sink)
+    assert asyncio.run(writer.wait_for_capacity(timeout=0.1)) is False
+
+    async def drain_later():
+        asyncio.get_running_loop().call_later(0.05, sink.open.set)
+        return await writer.wait_for_capacity(timeout=5)
+
+    assert asyncio.run(drain_later()) is True
+
+class RecordingRequest(fakebot.FakeRequest):
+    def __init__(self):
+        super().__init__()
+        self.texts = []
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        if url.endswith("/sendMessage"):
+            self.texts.append(request_data.parameters["text"])
+        return await super().do_request(url, method, request_data, **kwargs)
+
+def test_customer_is_asked_to_retry_when_the_queue_is_full(writer, monkeypatch, bot_loop, run):
+    writer, sink = writer
+    monkeypatch.setattr(bot, "order_writer", writer)
+    monkeypatch.setattr(bot, "ORDER_SUBMIT_TIMEOUT", 0.1)
+    telegram = RecordingRequest()
+    application = bot.build_application(request=telegram)
+    user_id = 71_001
+
+    async def checkout():
+        await application.initialize()
+        factory = fakebot.UpdateFactory(application.bot)
+        steps = fakebot.journey(bot, factory, user_id, random.Random(3))
+        for _, update in steps:
+            await Application.process_update(application, update)
+        busy_reply = telegram.texts[-1]
+        sink.open.set()
+        # The same reply again, now that there is room
+        await Application.process_update(application, factory.message(user_id, "SKIP"))
+        await application.shutdown()
+        return busy_reply
+
+    fill(writer, sink)
+    busy_reply = run(checkout(), timeout=30)
+    assert "couldn't take yours yet" in busy_reply
+    assert "Order Confirmed" in telegram.texts[-1]
+    assert sum("Order Confirmed" in text for text in telegram.texts) == 1
+    writer.flush()
+    assert len(sink.written) == 5
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import random
+import time
+from threading import Event, Thread
+
+import fakebot
+from conftest import bot
+from telegram.ext import Application
+
+USERS = 40
+JOURNEYS = 2
+READERS = {"/orders": 2, "/orders?format=ndjson&order=asc": 1, "/health": 2, "/": 1, "/metrics": 1}
+ORDER_KEYS = {"order_id", "user_id", "date", "status", "items", "total"}
+LEGACY_ITEM_KEYS = {"name", "price", "quantity", "category", "product_id", "customizations"}
+
+class Reader(Thread):
+    # Polls one endpoint until told to stop; keeps what it saw so the test can check it afterwards
+    def __init__(self, path, done):
+        super().__init__(daemon=True)
+        self.path, self.done = path, done
+        self.errors, self.requests = [], 0
+
+    def run(self):
+        client = bot.app.test_client()
+        last = {}
+        while not self.done.is_set():
+            try:
+                response = client.get(self.path)
+                assert response.status_code == 200, response.status_code
+                check = CHECKS.get(self.path.split("?")[0])
+                if check:
+                    check(response, last)
+                self.requests += 1
+            except Exception as e:
+                self.errors.append(repr(e))
+                return
+
+def check_health(response, last):
+    data = response.get_json()
+    stats = data["stats"]
+    # Snapshots are only ever replaced by newer ones, and each one is internally consistent
+    assert data["state_version"] >= last.get("version", 0)
+    assert stats["total_orders"] >= last.get("total_orders", 0)
+    last["version"], last["total_orders"] = data["state_version"], stats["total_orders"]
+    expected_aov = round(stats["total_revenue"] / stats["total_orders"], 2) if stats["total_orders"] else 0.0
+    assert abs(stats["average_order_value"] - expected_aov) <= 0.01
+    assert stats["active_carts"] >= 0 and stats["items_in_carts"] >= 0
+    assert stats["orders_today"] <= stats["total_orders"]
+
+def check_orders(response, last):
+    if response.mimetype == "application/x-ndjson":
+        orders = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        numbers = [bot.order_number(o["order_id"]) for o in orders]
+        assert numbers == sorted(set(numbers))
+    else:
+        data = response.get_json()
+        orders = data["orders"]
+        numbers = [bot.order_number(o["order_id"]) for o in orders]
+        assert numbers == sorted(set(numbers), reverse=True)
+        assert data["count"] == len(orders)
+        assert data["active_cart_count"] >= 0
+        for user_id, items in data["active_carts"].items():
+            assert user_id.isdigit() and items
+            assert all(LEGACY_ITEM_KEYS <= item.keys() for item in items.values())
+    for order in orders:
+        assert ORDER_KEYS <= order.keys(), order
+        assert order["items"]
+
+def check_metrics(response, last):
+    assert b"trustylads_" in response.get_data()
+
+CHECKS = {"/health": check_health, "/orders": check_orders, "/metrics": check_metrics}
+
+def test_readers_see_consistent_snapshots_while_the_bot_loop_writes(bot_loop, run, fake_telegram):
+    application = bot.build_application(request=fake_telegram)
+    errors = []
+
+    async def record_error(update, context):
+        errors.append(repr(context.error))
+
+    async def writers():
+        # What run_bot_async does: the loop owns the state and republishes on a tick
+        application.add_error_handler(record_error)
+        await application.initialize()
+        bot.read_model.bind(asyncio.get_running_loop())
+        bot.order_writer.start()
+        factory = fakebot.UpdateFactory(application.bot)
+        rng = random.Random(13)
+        streams = [[update for _ in range(JOURNEYS) for _, update in fakebot.journey(bot, factory, 40_000 + i, rng)]
+                   for i in range(USERS)]
+
+        async def run_user(updates):
+            for update in updates:
+                await Application.process_update(application, update)
+
+        async def tick(stop):
+            while not stop.is_set():
+                bot.read_model.publish()
+                await asyncio.sleep(0.01)
+
+        stop = asyncio.Event()
+        ticker = asyncio.create_task(tick(stop))
+        await asyncio.gather(*(run_user(updates) for updates in streams))
+        stop.set()
+        await ticker
+        await asyncio.get_running_loop().run_in_executor(None, bot.order_writer.flush)
+        bot.read_model.unbind()
+        await application.shutdown()
+
+    done = Event()
+    readers = [Reader(path, done) for path, count in READERS.items() for _ in range(count)]
+    orders_before = bot.read_model.current().stats.get("total_orders", 0)
+    for reader in readers:
+        reader.start()
+    try:
+        run(writers(), timeout=120)
+    finally:
+        time.sleep(0.1)
+        done.set()
+        for reader in readers:
+            reader.join(10)
+        bot.order_writer.stop()
+
+    assert errors == []
+    for reader in readers:
+        assert reader.errors == [], (reader.path, reader.errors[:3])
+        assert reader.requests > 0, reader.path
+    bot.read_model.publish()
+    assert bot.read_model.current().stats["total_orders"] - orders_before == USERS * JOURNEYS
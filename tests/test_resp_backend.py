@@ -0,0 +1,132 @@
+import asyncio
+from threading import Thread
+
+import pytest
+
+from conftest import bot
+from resp_server import RespServer
+
+@pytest.fixture
+def backend(resp_server):
+    backend = bot.RespBackend(resp_server.url, pool_size=2, timeout=2)
+    yield backend
+    backend.close()
+
+def test_get_set_delete(backend, resp_server):
+    backend.set("k:1", {"items": [1, 2], "name": "Café"}, ttl=60)
+    assert backend.get("k:1") == {"items": [1, 2], "name": "Café"}
+    assert b"k:1" in resp_server.expiry
+    backend.set_many({"k:2": 2, "k:3": None})
+    assert backend.mget(["k:1", "k:missing", "k:2", "k:3"]) == [{"items": [1, 2], "name": "Café"}, None, 2, None]
+    backend.delete("k:1")
+    assert backend.get("k:1") is None
+    assert backend.mget([]) == []
+
+def test_incrby(backend):
+    assert backend.incr("counter") == 1
+    assert backend.incr("counter", 100) == 101
+    assert backend.incr("counter", -1) == 100
+
+def test_pipeline_replies_in_order(backend, resp_server):
+    replies = backend.pipeline([("SET", "a", "1"), ("INCRBY", "a", 4), ("GET", "a"), ("GET", "b")])
+    assert replies == ["OK", 5, b"5", None]
+    assert resp_server.connections <= 1
+
+def test_error_reply_keeps_the_connection(backend, resp_server):
+    backend.get("warm")
+    with pytest.raises(bot.StateBackendError, match="unknown command"):
+        backend.pipeline([("SET", "a", "1"), ("NOSUCHCOMMAND",)])
+    # The connection went back to the pool in sync with the server
+    assert backend.pipeline([("GET", "a")]) == [b"1"]
+    assert resp_server.max_connections == 1
+
+def test_keys_follows_the_scan_cursor(backend):
+    backend.set_many({f"trustylads:carts:{i}": i for i in range(2500)})
+    backend.set_many({"trustylads:sessions:1": 1, "other:carts:1": 1})
+    found = backend.keys("trustylads:carts:")
+    assert sorted(found) == sorted(f"trustylads:carts:{i}" for i in range(2500))
+
+def test_keys_escapes_glob_characters(backend):
+    backend.set_many({"weird[1]*:a": 1, "weird1:b": 2})
+    assert backend.keys("weird[1]*:") == ["weird[1]*:a"]
+
+def test_lists_sorted_sets_and_sets(backend):
+    assert backend.rpush("list", {"n": 1}, {"n": 2}) == 2
+    assert backend.llen("list") == 2
+    assert backend.lrange("list", 0, -1) == [{"n": 1}, {"n": 2}]
+    backend.zadd("z", {"TL-1": 1, "TL-3": 3, "TL-2": 2})
+    assert backend.zcard("z") == 3
+    assert backend.zrevrange("z", 0, 1) == ["TL-3", "TL-2"]
+    backend.sadd("s1", 1, 2, 2)
+    assert backend.scard_many(["s1", "s2"]) == [2, 0]
+
+def test_stale_pooled_connection_is_retried(backend, resp_server):
+    backend.set("k", 1)
+    resp_server.drop_connections()
+    # Reads are idempotent, so the pool retries them once on a fresh connection
+    assert backend.get("k") == 1
+
+def test_increment_is_not_retried_after_a_dropped_connection(backend, resp_server):
+    assert backend.incr("counter") == 1
+    resp_server.drop_connections()
+    # A retry could apply the increment twice; the caller sees the error instead
+    with pytest.raises(OSError):
+        backend.incr("counter")
+    assert backend.incr("counter") == 2
+
+def test_pool_never_opens_more_than_pool_size(backend, resp_server):
+    errors = []
+
+    def worker(n):
+        try:
+            for i in range(50):
+                backend.set(f"w{n}:{i}", i)
+                assert backend.get(f"w{n}:{i}") == i
+        except Exception as e:
+            errors.append(repr(e))
+
+    threads = [Thread(target=worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert errors == []
+    assert resp_server.max_connections <= 2
+
+def test_auth_and_select():
+    server = RespServer(password="s3cret").start()
+    try:
+        url = server.url.replace("redis://", "redis://:s3cret@").rsplit("/", 1)[0] + "/3"
+        backend = bot.RespBackend(url, timeout=2)
+        backend.set("k", "v")
+        assert server.db(3)[b"k"] == b'"v"'
+        assert server.commands["AUTH"] == 1 and server.commands["SELECT"] == 1
+        backend.close()
+        with pytest.raises(bot.StateBackendError, match="WRONGPASS"):
+            bot.RespBackend(url.replace("s3cret", "wrong"), timeout=2).get("k")
+    finally:
+        server.stop()
+
+def test_open_state_backend():
+    assert isinstance(bot.open_state_backend("local"), bot.LocalBackend)
+    assert isinstance(bot.open_state_backend("redis://127.0.0.1:6390/2"), bot.RespBackend)
+    with pytest.raises(ValueError):
+        bot.open_state_backend("memory")
+
+def test_carts_are_shared_between_workers(resp_server):
+    # Two workers' stores on one backend: what one persists, the other loads
+    backend = bot.RespBackend(resp_server.url, timeout=2)
+    first = bot.BoundedStore("carts", 3600, 10, bool, backend, bot.Cart.to_json, bot.Cart.from_json)
+    second = bot.BoundedStore("carts", 3600, 10, bool, backend, bot.Cart.to_json, bot.Cart.from_json)
+    cart = bot.Cart()
+    cart.add("clothing", "tshirt", "Classic T-Shirt", 499.0, bot.customization_key({}))
+    first[1] = cart
+    first.persist(1)
+
+    async def load():
+        await second.load(1)
+        second.release(1)
+
+    asyncio.run(load())
+    assert second.get(1).count == 1
+    backend.close()
@@ -0,0 +1,71 @@
+import random
+
+import pytest
+
+from conftest import bot
+
+WORDS = ["classic", "premium", "leather", "wallet", "cotton", "tshirt", "canvas", "backpack", "steel", "watch",
+         "ceramic", "mug", "wireless", "headphones", "bamboo", "lamp", "quality", "daily", "travel", "slim"]
+OPTIONS = {"color": ["Black", "White", "Red"], "size": ["S", "M", "L"]}
+
+def make_index(count, rng):
+    products = [{
+        "name": " ".join(rng.sample(WORDS, 3)).title() + f" {i}",
+        "category_name": rng.choice(["Bags", "Clothing", "Home Decor", "Electronics"]),
+        "description": " ".join(rng.choice(WORDS) for _ in range(8)),
+        "customizable": rng.sample(list(OPTIONS), rng.randint(0, 2)),
+        "product_id": f"p{i}",
+    } for i in range(count)]
+    return bot.SearchIndex(products, OPTIONS)
+
+def reference_search(index, query, limit):
+    # Every product matching all terms (or any, when none matches all), scored with the best
+    # expansion per term and ranked by score then name; computed the slow, obvious way
+    terms = list(dict.fromkeys(bot.search_tokens(query)))
+    per_term = []
+    for term in terms:
+        scores = {}
+        for token, factor in index._expand(term).items():
+            for idx, weight in index.postings[token].items():
+                scores[idx] = max(scores.get(idx, 0.0), weight * factor)
+        per_term.append(scores)
+    if not per_term:
+        return []
+    matching = set.intersection(*(set(s) for s in per_term)) or set().union(*per_term)
+    totals = {idx: sum(s.get(idx, 0.0) for s in per_term) for idx in matching}
+    ranked = sorted(totals, key=lambda idx: (-totals[idx], idx))[:limit]
+    return [index.products[idx]["product_id"] for idx in ranked]
+
+@pytest.fixture(scope="module")
+def index():
+    return make_index(3000, random.Random(10))
+
+def test_matches_the_reference_on_random_queries(index):
+    rng = random.Random(11)
+    vocabulary = WORDS + ["walet", "lether", "bakpack", "head", "prem", "zzzz", "black", "m", "12"]
+    for _ in range(300):
+        query = " ".join(rng.sample(vocabulary, rng.randint(1, 4)))
+        limit = rng.choice([5, 50, 200, 5000])
+        assert [p["product_id"] for p in index.search(query, limit)] == reference_search(index, query, limit), query
+
+def test_all_terms_first_then_any(index):
+    results = index.search("leather wallet", 5000)
+    assert results and all({"leather", "wallet"} <= set(bot.search_tokens(
+        " ".join((p["name"], p["category_name"], p["description"])))) for p in results)
+    # Nothing has both, so products with either come back
+    assert index.search("wallet zzzzunknown", 10) == index.search("wallet", 10)
+
+def test_typos_and_prefixes(index):
+    assert index.search("walet", 10) and index.search("walet", 10)[0]["product_id"] == index.search("wallet", 10)[0]["product_id"]
+    assert index.search("headph", 10) == index.search("headphones", 10)
+    assert index.search("", 10) == [] and index.search("zzzz", 10) == []
+
+def test_fuzzy_expansions_are_capped():
+    # Many tokens one edit away from the query term; only the most common few are searched
+    products = [{"name": f"tok{c}x item", "category_name": "C", "description": "", "product_id": f"p{i}"}
+                for i, c in enumerate("abcdefghijklmnopqrstuvwxyz")]
+    products.append({"name": "tokbx again", "category_name": "C", "description": "", "product_id": "extra"})
+    index = bot.SearchIndex(products, {})
+    fuzzy = [token for token, factor in index._expand("tokx").items() if factor == bot.SEARCH_FUZZY_FACTOR]
+    assert len(fuzzy) == bot.SEARCH_MAX_FUZZY
+    assert fuzzy[0] == "tokbx"
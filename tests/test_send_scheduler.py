@@ -0,0 +1,176 @@
+import asyncio
+import time
+
+import fakebot
+import pytest
+from conftest import bot
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+
+class RecordingRequest(fakebot.FakeRequest):
+    # Remembers what reached the Bot API and when; `gate` holds sendMessage calls while it is clear
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+        self.retry_after = 0
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[1]
+        params = request_data.parameters if request_data else {}
+        if endpoint in ("sendMessage", "editMessageText"):
+            await self.gate.wait()
+            if self.retry_after:
+                self.retry_after -= 1
+                raise RetryAfter(0.05)
+            self.sent.append((endpoint, params.get("chat_id"), params.get("text"), time.monotonic()))
+        return await super().do_request(url, method, request_data, **kwargs)
+
+@pytest.fixture
+def rates(monkeypatch):
+    def set_rates(global_rate=1000, chat_rate=1000, chat_burst=1000, group_rate=1000):
+        monkeypatch.setattr(bot, "SEND_GLOBAL_RATE", global_rate)
+        monkeypatch.setattr(bot, "SEND_CHAT_RATE", chat_rate)
+        monkeypatch.setattr(bot, "SEND_CHAT_BURST", chat_burst)
+        monkeypatch.setattr(bot, "SEND_GROUP_RATE", group_rate)
+    return set_rates
+
+def run_with_bot(scenario):
+    # scenario(ext_bot, request, scheduler) on a fresh loop, with the scheduler as the bot's rate limiter
+    async def main():
+        request = RecordingRequest()
+        scheduler = bot.SendScheduler()
+        ext_bot = ExtBot("0:test", request=request, get_updates_request=fakebot.FakeRequest(), rate_limiter=scheduler)
+        await ext_bot.initialize()
+        try:
+            await asyncio.wait_for(scenario(ext_bot, request, scheduler), 10)
+        finally:
+            await ext_bot.shutdown()
+        return request, scheduler
+    return asyncio.run(main())
+
+def times(sent, chat_id=None):
+    return [at for _, chat, _, at in sent if chat_id is None or chat == chat_id]
+
+def test_chat_bucket_allows_a_burst_then_the_rate(rates):
+    rates(chat_rate=20, chat_burst=3)
+
+    async def scenario(ext_bot, request, scheduler):
+        await asyncio.gather(*(ext_bot.send_message(1, str(n)) for n in range(7)))
+
+    request, _ = run_with_bot(scenario)
+    sent = times(request.sent)
+    assert [text for _, _, text, _ in request.sent] == [str(n) for n in range(7)]
+    # Three at once, then one every 50 ms: the last four need at least 150 ms after the burst
+    assert sent[2] - sent[0] < 0.04
+    assert sent[6] - sent[2] >= 4 / 20 - 0.06
+    assert all(b - a >= 1 / 20 - 0.02 for a, b in zip(sent[3:], sent[4:]))
+
+def test_group_chats_get_the_group_rate(rates):
+    rates(chat_rate=1000, chat_burst=1, group_rate=10)
+
+    async def scenario(ext_bot, request, scheduler):
+        await asyncio.gather(*(ext_bot.send_message(-100, str(n)) for n in range(3)),
+                             *(ext_bot.send_message(5, str(n)) for n in range(3)))
+
+    request, _ = run_with_bot(scenario)
+    group, private = times(request.sent, -100), times(request.sent, 5)
+    assert group[2] - group[0] >= 2 / 10 - 0.03
+    assert private[2] - private[0] < 0.05
+
+def test_global_bucket_limits_all_chats_together(rates):
+    rates(global_rate=20)
+
+    async def scenario(ext_bot, request, scheduler):
+        await asyncio.gather(*(ext_bot.send_message(chat_id, "hi") for chat_id in range(1, 31)))
+
+    request, _ = run_with_bot(scenario)
+    sent = sorted(times(request.sent))
+    # The bucket holds one second's worth; the ten beyond it leave one every 50 ms
+    assert len(sent) == 30
+    assert sent[19] - sent[0] < 0.04
+    assert sent[29] - sent[0] >= 10 / 20 - 0.06
+
+def test_each_chat_has_one_request_in_flight_in_order(rates):
+    rates()
+
+    async def scenario(ext_bot, request, scheduler):
+        request.gate.clear()
+        tasks = [asyncio.create_task(ext_bot.send_message(chat_id, str(n))) for n in range(5) for chat_id in (1, 2)]
+        await asyncio.sleep(0.05)
+        assert scheduler.report()["in_flight"] == 2 and scheduler.report()["queued"] == 8
+        request.gate.set()
+        await asyncio.gather(*tasks)
+
+    request, _ = run_with_bot(scenario)
+    for chat_id in (1, 2):
+        assert [text for _, chat, text, _ in request.sent if chat == chat_id] == [str(n) for n in range(5)]
+
+def test_higher_priority_goes_first_when_the_global_bucket_is_empty(rates):
+    rates(global_rate=20)
+
+    @bot.send_priority(bot.PRIORITY_CHECKOUT)
+    async def checkout_reply(ext_bot):
+        return await ext_bot.send_message(100, "checkout")
+
+    async def scenario(ext_bot, request, scheduler):
+        scheduler._global.tokens = 0
+        browse = [asyncio.create_task(ext_bot.send_message(chat_id, "browse", rate_limit_args=bot.PRIORITY_BROWSE))
+                  for chat_id in range(1, 6)]
+        default = asyncio.create_task(ext_bot.send_message(50, "default"))
+        await asyncio.gather(checkout_reply(ext_bot), default, *browse)
+
+    request, scheduler = run_with_bot(scenario)
+    assert [text for _, _, text, _ in request.sent] == ["checkout", "default"] + ["browse"] * 5
+    assert scheduler.metrics["by_priority"] == {"checkout": 1, "default": 1, "browse": 5}
+
+def test_queued_edits_to_one_message_are_coalesced(rates):
+    rates()
+
+    async def scenario(ext_bot, request, scheduler):
+        request.gate.clear()
+        # The send holds chat 1 busy while the edits pile up behind it
+        first = asyncio.create_task(ext_bot.send_message(1, "menu"))
+        await asyncio.sleep(0.01)
+        edits = [asyncio.create_task(ext_bot.edit_message_text(f"page {n}", chat_id=1, message_id=7)) for n in range(5)]
+        other = asyncio.create_task(ext_bot.edit_message_text("other", chat_id=1, message_id=8))
+        await asyncio.sleep(0.01)
+        request.gate.set()
+        await asyncio.gather(first, other, *edits)
+
+    request, scheduler = run_with_bot(scenario)
+    assert [text for _, _, text, _ in request.sent] == ["menu", "page 4", "other"]
+    assert scheduler.metrics["coalesced"] == 4
+
+def test_edit_is_not_coalesced_past_a_later_message(rates):
+    rates()
+
+    async def scenario(ext_bot, request, scheduler):
+        request.gate.clear()
+        first = asyncio.create_task(ext_bot.send_message(1, "menu"))
+        await asyncio.sleep(0.01)
+        queued = [asyncio.create_task(ext_bot.edit_message_text("page 1", chat_id=1, message_id=7)),
+                  asyncio.create_task(ext_bot.send_message(1, "notice")),
+                  asyncio.create_task(ext_bot.edit_message_text("page 2", chat_id=1, message_id=7))]
+        await asyncio.sleep(0.01)
+        request.gate.set()
+        await asyncio.gather(first, *queued)
+
+    request, scheduler = run_with_bot(scenario)
+    assert [text for _, _, text, _ in request.sent] == ["menu", "page 1", "notice", "page 2"]
+    assert scheduler.metrics["coalesced"] == 0
+
+def test_retry_after_holds_the_chat_and_retries(rates, monkeypatch):
+    rates()
+    monkeypatch.setattr(bot, "SEND_BACKOFF_BASE", 0.01)
+
+    async def scenario(ext_bot, request, scheduler):
+        request.retry_after = 1
+        started = time.monotonic()
+        await asyncio.gather(ext_bot.send_message(1, "a"), ext_bot.send_message(1, "b"))
+        assert time.monotonic() - started >= 0.05
+
+    request, scheduler = run_with_bot(scenario)
+    assert [text for _, _, text, _ in request.sent] == ["a", "b"]
+    assert scheduler.metrics["retry_after"] == 1 and scheduler.metrics["sent"] == 2
@@ -0,0 +1,79 @@
+import asyncio
+import random
+import time
+
+import fakebot
+import pytest
+from conftest import bot
+from telegram.ext import Application
+
+class FailingFile:
+    # The journal's segment file, with writes failing while `failing` is set
+    def __init__(self, file):
+        self.file = file
+        self.failing = True
+
+    def write(self, data):
+        if self.failing:
+            raise OSError(28, "No space left on device")
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+class RecordingRequest(fakebot.FakeRequest):
+    def __init__(self):
+        super().__init__()
+        self.texts = []
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        if url.endswith("/sendMessage"):
+            self.texts.append(request_data.parameters["text"])
+        return await super().do_request(url, method, request_data, **kwargs)
+
+@pytest.fixture
+def failing_journal(tmp_path, monkeypatch):
+    journal = bot.StateJournal(data_dir=str(tmp_path), snapshot_every=10 ** 6)
+    journal._open_segment(1)
+    journal._file = FailingFile(journal._file)
+    journal._start()
+    yield journal
+    journal._queue.put(journal._STOP)
+    journal._thread.join(5)
+    journal._file.close()
+
+def test_waiters_are_told_when_a_write_fails(failing_journal):
+    seq = failing_journal.append("cart_clear", user_id=1)
+    started = time.monotonic()
+    assert failing_journal.wait_written(seq, timeout=5) is False
+    assert time.monotonic() - started < 1
+    # The journal keeps going once writes work again, and the failed record stays failed
+    failing_journal._file.failing = False
+    later = failing_journal.append("cart_clear", user_id=1)
+    assert failing_journal.wait_written(later, timeout=5) is True
+    assert failing_journal.wait_written(seq, timeout=0) is False
+
+def test_wait_written_times_out(failing_journal):
+    assert failing_journal.wait_written(failing_journal.seq + 1, timeout=0.05) is False
+
+def test_order_is_not_confirmed_when_the_journal_fails(failing_journal, monkeypatch, bot_loop, run):
+    monkeypatch.setattr(bot, "state_journal", failing_journal)
+    telegram = RecordingRequest()
+    application = bot.build_application(request=telegram)
+    user_id = 70_001
+
+    async def checkout():
+        await application.initialize()
+        factory = fakebot.UpdateFactory(application.bot)
+        for _, update in fakebot.journey(bot, factory, user_id, random.Random(7)):
+            await Application.process_update(application, update)
+        await application.shutdown()
+
+    try:
+        run(checkout(), timeout=30)
+    finally:
+        bot.order_writer.flush()
+    assert "could not confirm" in telegram.texts[-1]
+    assert not any("Order Confirmed" in text for text in telegram.texts)
+    # Back at the menu, so replying again cannot place the order a second time
+    assert bot.get_user_session(user_id)["current_context"] == "main_menu"
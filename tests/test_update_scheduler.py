@@ -0,0 +1,126 @@
+import asyncio
+import random
+
+import fakebot
+from conftest import bot
+
+factory = fakebot.UpdateFactory(None)
+
+def run_scenario(coro):
+    return asyncio.run(asyncio.wait_for(coro, 10))
+
+def test_each_users_updates_run_one_at_a_time_in_order():
+    rng = random.Random(15)
+    seen, in_flight = {}, set()
+    concurrency = []
+
+    async def process(update):
+        user_id = update.effective_user.id
+        assert user_id not in in_flight
+        in_flight.add(user_id)
+        concurrency.append(len(in_flight))
+        for _ in range(rng.randrange(4)):
+            await asyncio.sleep(0)
+        seen.setdefault(user_id, []).append(int(update.message.text))
+        in_flight.discard(user_id)
+
+    async def scenario():
+        scheduler = bot.UpdateScheduler(workers=8, queue_limit=1000)
+        scheduler.start()
+        # Users interleaved in a different order each round, each user's own updates numbered in order
+        for n in range(20):
+            for user_id in rng.sample(range(1, 11), 10):
+                await scheduler.submit(factory.message(user_id, str(n)), process)
+        await scheduler.join()
+        await scheduler.stop()
+        return scheduler
+
+    scheduler = run_scenario(scenario())
+    assert seen == {user_id: list(range(20)) for user_id in range(1, 11)}
+    assert max(concurrency) > 1
+    assert scheduler.metrics["processed"] == 200 and scheduler.report()["queued"] == 0
+
+def test_full_queue_holds_the_submitter_back():
+    async def scenario():
+        release = asyncio.Event()
+
+        async def process(update):
+            await release.wait()
+
+        scheduler = bot.UpdateScheduler(workers=2, queue_limit=5)
+        scheduler.start()
+        for user_id in range(5):
+            await scheduler.submit(factory.message(user_id, "hi"), process)
+        blocked = asyncio.create_task(scheduler.submit(factory.message(99, "hi"), process))
+        await asyncio.sleep(0.05)
+        assert not blocked.done()
+        assert scheduler.metrics["throttled"] >= 1
+        release.set()
+        await blocked
+        await scheduler.join()
+        await scheduler.stop()
+        return scheduler
+
+    scheduler = run_scenario(scenario())
+    assert scheduler.metrics["max_depth"] == 5 and scheduler.metrics["processed"] == 6
+
+def test_busy_user_does_not_starve_others():
+    order = []
+
+    async def process(update):
+        order.append(update.effective_user.id)
+        await asyncio.sleep(0)
+
+    async def scenario():
+        scheduler = bot.UpdateScheduler(workers=1, queue_limit=100)
+        scheduler.start()
+        for _ in range(5):
+            await scheduler.submit(factory.message(1, "spam"), process)
+        await scheduler.submit(factory.message(2, "hi"), process)
+        await scheduler.join()
+        await scheduler.stop()
+
+    run_scenario(scenario())
+    # User 1's backlog goes to the back of the line after each update
+    assert order.index(2) <= 2
+
+def test_failed_update_does_not_block_the_users_next_one():
+    handled = []
+
+    async def process(update):
+        if update.message.text == "boom":
+            raise RuntimeError("handler failed")
+        handled.append(update.message.text)
+
+    async def scenario():
+        scheduler = bot.UpdateScheduler(workers=4, queue_limit=100)
+        scheduler.start()
+        for text in ("a", "boom", "b"):
+            await scheduler.submit(factory.message(1, text), process)
+        await scheduler.join()
+        await scheduler.stop()
+        return scheduler
+
+    scheduler = run_scenario(scenario())
+    assert handled == ["a", "b"]
+    assert scheduler.metrics["failed"] == 1 and scheduler.metrics["processed"] == 2
+
+def test_application_hands_updates_to_the_scheduler(bot_loop, run, fake_telegram, monkeypatch):
+    # Through the real handlers against the fake Bot API: many users at once, one reply each
+    monkeypatch.setattr(bot, "update_scheduler", bot.UpdateScheduler(workers=8, queue_limit=4))
+    application = bot.build_application(request=fake_telegram)
+    users = 40
+
+    async def scenario():
+        await application.initialize()
+        bot.update_scheduler.start()
+        factory = fakebot.UpdateFactory(application.bot)
+        for user_id in range(90_000, 90_000 + users):
+            await application.process_update(factory.message(user_id, "/start"))
+        await bot.update_scheduler.stop()
+        await application.shutdown()
+
+    run(scenario(), timeout=30)
+    assert fake_telegram.calls["sendMessage"] == users
+    assert bot.update_scheduler.metrics["processed"] == users
+    assert bot.update_scheduler.metrics["max_depth"] <= 4
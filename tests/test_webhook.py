@@ -0,0 +1,126 @@
+import itertools
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+
+from conftest import bot
+
+SECRET = "test-secret"
+_update_ids = itertools.count(1)
+
+def message(user_id, text):
+    data = {"message_id": 1, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"}, "from": {"id": user_id, "is_bot": False, "first_name": "U"}}
+    if text.startswith("/"):
+        data["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_update_ids), "message": data}
+
+@pytest.fixture
+def webhook(monkeypatch, bot_loop, run, fake_telegram):
+    # Webhook mode against the fake Bot API: Flask on this thread, the application on bot_loop
+    monkeypatch.setattr(bot, "BOT_MODE", "webhook")
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", SECRET)
+    application = bot.build_application(request=fake_telegram)
+    run(application.initialize())
+    run(application.start())
+    monkeypatch.setattr(bot, "bot_application", application)
+    monkeypatch.setattr(bot, "bot_loop", bot_loop)
+    monkeypatch.setattr(bot, "bot_running", True)
+    yield bot.app.test_client()
+    run(application.stop())
+    run(application.shutdown())
+
+def post(client, body, secret=SECRET):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret is not None else {}
+    return client.post(bot.WEBHOOK_PATH, json=body, headers=headers)
+
+def wait_for_reply(fake_telegram, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if fake_telegram.calls["sendMessage"]:
+            return True
+        time.sleep(0.01)
+    return False
+
+def test_update_with_secret_is_handled(webhook, fake_telegram):
+    assert post(webhook, message(501, "/start")).status_code == 200
+    assert wait_for_reply(fake_telegram)
+
+@pytest.mark.parametrize("secret", ["wrong-secret", "", None])
+def test_update_without_secret_is_refused(webhook, fake_telegram, secret):
+    assert post(webhook, message(502, "/start"), secret=secret).status_code == 403
+    assert not wait_for_reply(fake_telegram, timeout=0.3)
+
+@pytest.mark.parametrize("body", [
+    {"update_id": 1, "message": "not a message"},
+    {"update_id": 2, "message": {"text": "no date or chat"}},
+    {"message": {}},
+    ["not", "an", "object"],
+])
+def test_malformed_update_is_rejected(webhook, fake_telegram, body):
+    assert post(webhook, body).status_code == 400
+    assert not wait_for_reply(fake_telegram, timeout=0.3)
+
+def test_webhook_closed_outside_webhook_mode(monkeypatch, webhook):
+    monkeypatch.setattr(bot, "BOT_MODE", "polling")
+    assert post(webhook, message(503, "/start")).status_code == 503
+
+class OtherWorker(ThreadingHTTPServer):
+    # The webhook of the worker that owns shard 1; records what is forwarded to it
+    def __init__(self):
+        self.received = []
+        super().__init__(("127.0.0.1", 0), self.Handler)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            self.server.received.append((self.path, self.headers, json.loads(body)))
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+@pytest.fixture
+def sharded(monkeypatch, webhook):
+    # This process is worker 0 of 2; odd user IDs belong to worker 1
+    other = OtherWorker()
+    Thread(target=other.serve_forever, daemon=True).start()
+    monkeypatch.setattr(bot, "WORKER_COUNT", 2)
+    monkeypatch.setattr(bot, "WORKER_INDEX", 0)
+    monkeypatch.setattr(bot, "WORKER_URLS", ["http://127.0.0.1:1", f"http://127.0.0.1:{other.server_port}"])
+    yield webhook, other
+    other.shutdown()
+    other.server_close()
+
+def test_update_for_another_shard_is_forwarded(sharded, fake_telegram):
+    client, other = sharded
+    body = message(601, "/start")
+    assert post(client, body).status_code == 200
+    path, headers, forwarded = other.received[0]
+    assert path == bot.WEBHOOK_PATH and forwarded == body
+    assert headers["X-Telegram-Bot-Api-Secret-Token"] == SECRET
+    assert headers[bot.SHARD_FORWARD_HEADER] == "0"
+    assert not wait_for_reply(fake_telegram, timeout=0.3)
+
+def test_update_for_this_shard_is_handled_here(sharded, fake_telegram):
+    client, other = sharded
+    assert post(client, message(602, "/start")).status_code == 200
+    assert wait_for_reply(fake_telegram)
+    assert other.received == []
+
+def test_forwarded_update_is_never_forwarded_again(sharded, fake_telegram):
+    client, other = sharded
+    response = client.post(bot.WEBHOOK_PATH, json=message(603, "/start"),
+                           headers={"X-Telegram-Bot-Api-Secret-Token": SECRET, bot.SHARD_FORWARD_HEADER: "1"})
+    assert response.status_code == 200
+    assert wait_for_reply(fake_telegram)
+    assert other.received == []
+
+def test_unreachable_shard_makes_telegram_retry(sharded, monkeypatch):
+    client, other = sharded
+    monkeypatch.setattr(bot, "WORKER_URLS", ["http://127.0.0.1:1", "http://127.0.0.1:1"])
+    assert post(client, message(605, "/start")).status_code == 502